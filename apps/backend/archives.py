@@ -0,0 +1,195 @@
+import math
+import shutil
+import stat
+import tarfile
+import threading
+import zipfile
+from concurrent.futures import Future, ThreadPoolExecutor, wait
+from itertools import chain
+from pathlib import Path, PurePosixPath
+from typing import IO, Callable, Iterator, Optional
+
+from config import (
+    EXTRACT_WORKERS,
+    EXTRACT_BUFFERED_ENTRY_BYTES,
+    EXTRACT_MAX_ENTRIES,
+    EXTRACT_MAX_BYTES,
+    EXTRACT_MAX_RATIO,
+    EXTRACT_MIN_FREE_BYTES,
+)
+from crypto_utils import (
+    DecryptedReader,
+    chunk_sizes,
+    encrypt_chunks_to_file,
+    get_plaintext_size,
+    is_encrypted_file,
+)
+from utils import verify_incoming_path
+
+ZIP_SUFFIXES = (".zip",)
+TAR_SUFFIXES = (".tar", ".tar.gz", ".tgz", ".tar.bz2", ".tbz2", ".tar.xz", ".txz")
+
+# (name, is_dir, size, open, archive bytes read before this entry)
+Entry = tuple[str, bool, int, Callable[[], IO[bytes]], int]
+
+
+def archive_kind(path: Path) -> Optional[str]:
+    name = path.name.lower()
+    if name.endswith(ZIP_SUFFIXES):
+        return "zip"
+    if name.endswith(TAR_SUFFIXES):
+        return "tar"
+    return None
+
+
+def archive_stem(path: Path) -> str:
+    name = path.name
+    for suffix in ZIP_SUFFIXES + TAR_SUFFIXES:
+        if name.lower().endswith(suffix) and len(name) > len(suffix):
+            return name[: -len(suffix)]
+    return name
+
+
+def archive_size(path: Path) -> int:
+    return get_plaintext_size(path) if is_encrypted_file(path) else path.stat().st_size
+
+
+def expansion_limit(size: int, root: Path) -> float:
+    # Checked against what is written, so a bomb is stopped however its
+    # headers describe it.
+    if EXTRACT_MAX_BYTES is not None:
+        return EXTRACT_MAX_BYTES or math.inf
+    free = shutil.disk_usage(root.parent).free - EXTRACT_MIN_FREE_BYTES
+    return max(0, min(size * EXTRACT_MAX_RATIO, free))
+
+
+def _zip_entries(reader) -> Iterator[Entry]:
+    with zipfile.ZipFile(reader) as archive:
+        position = 0
+        for info in archive.infolist():
+            if not stat.S_ISLNK(info.external_attr >> 16):
+                yield (
+                    info.filename,
+                    info.is_dir(),
+                    info.file_size,
+                    lambda info=info: archive.open(info),
+                    position,
+                )
+            position += info.compress_size
+
+
+def _tar_entries(reader) -> Iterator[Entry]:
+    # Stream mode reads the archive once, front to back, compressed or not;
+    # each member has to be consumed before the next one is read.
+    with tarfile.open(fileobj=reader, mode="r|*") as archive:
+        for member in archive:
+            # Links and device files are not carried over.
+            if member.isdir() or member.isfile():
+                yield (
+                    member.name,
+                    member.isdir(),
+                    member.size,
+                    lambda member=member: archive.extractfile(member),
+                    reader.tell(),
+                )
+
+
+def _target(parent_path: Path, root: Path, name: str) -> Path:
+    parts = PurePosixPath(name.replace("\\", "/")).parts
+    if not parts or parts[0] == "/" or ".." in parts:
+        raise ValueError(f"Unsafe path in archive: {name}")
+    target = root.joinpath(*parts)
+    if not verify_incoming_path(
+        parent_path, target.relative_to(parent_path)
+    ) or not target.resolve().is_relative_to(root.resolve()):
+        raise ValueError(f"Unsafe path in archive: {name}")
+    return target
+
+
+def _raise_failed(futures: set[Future]) -> None:
+    for future in [f for f in futures if f.done()]:
+        futures.discard(future)
+        future.result()
+
+
+# Unpacks an archive into `root`, decrypting it and encrypting every entry
+# as it streams past; no plaintext reaches the disk. Entries are read one
+# at a time. Small ones are read into memory and encrypted on a thread
+# pool, with a bounded number in flight, so thousands of small files do
+# not wait on each other; larger ones are encrypted as they are read.
+def extract_archive(
+    archive: Path,
+    parent_path: Path,
+    root: Path,
+    on_progress: Callable[[int], None],
+    check: Callable[[], None],
+) -> int:
+    entries = _zip_entries if archive_kind(archive) == "zip" else _tar_entries
+    total = archive_size(archive)
+    limit = expansion_limit(total, root)
+    reader = (
+        DecryptedReader(archive) if is_encrypted_file(archive) else archive.open("rb")
+    )
+    slots = threading.BoundedSemaphore(EXTRACT_WORKERS * 2)
+    pending: set[Future] = set()
+    count, extracted, reported = 0, 0, 0
+    written: set[Path] = set()
+
+    def tally(length: int) -> None:
+        nonlocal extracted
+        extracted += length
+        if extracted > limit:
+            raise ValueError("Archive expands beyond the allowed size")
+
+    def counted(chunks: Iterator[bytes]) -> Iterator[bytes]:
+        for chunk in chunks:
+            tally(len(chunk))
+            yield chunk
+
+    def write_buffered(target: Path, data: bytes) -> None:
+        try:
+            encrypt_chunks_to_file([data], target, reserved=True)
+        finally:
+            slots.release()
+
+    with reader, ThreadPoolExecutor(EXTRACT_WORKERS) as pool:
+        try:
+            for name, is_dir, size, open_entry, position in entries(reader):
+                check()
+                on_progress(position - reported)
+                reported = position
+                count += 1
+                if count > EXTRACT_MAX_ENTRIES:
+                    raise ValueError("Archive has too many entries")
+
+                target = _target(parent_path, root, name)
+                if is_dir:
+                    target.mkdir(parents=True, exist_ok=True)
+                    continue
+                target.parent.mkdir(parents=True, exist_ok=True)
+                if target in written:
+                    # A later entry of the same name wins, once the earlier
+                    # one has been written.
+                    wait(pending)
+                written.add(target)
+
+                with open_entry() as source:
+                    read = iter(lambda: source.read(chunk_sizes.encrypt), b"")
+                    chunks = counted(read)
+                    if size <= EXTRACT_BUFFERED_ENTRY_BYTES:
+                        # Sizes in headers are not trusted.
+                        data = source.read(EXTRACT_BUFFERED_ENTRY_BYTES + 1)
+                        tally(len(data))
+                        if len(data) <= EXTRACT_BUFFERED_ENTRY_BYTES:
+                            slots.acquire()
+                            pending.add(pool.submit(write_buffered, target, data))
+                            _raise_failed(pending)
+                            continue
+                        chunks = chain([data], chunks)
+                    encrypt_chunks_to_file(chunks, target, reserved=True)
+                _raise_failed(pending)
+        finally:
+            wait(pending)
+        _raise_failed(pending)
+    on_progress(max(0, total - reported))
+    return count
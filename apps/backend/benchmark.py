@@ -0,0 +1,439 @@
+import argparse
+import asyncio
+import io
+import json
+import os
+import random
+import shutil
+import statistics
+import tempfile
+import time
+from dataclasses import asdict
+from pathlib import Path
+from typing import Callable, Optional
+
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from config import STATE_PATH, CHUNK_AUTOTUNE_SAMPLE_SIZE
+from crypto_utils import (
+    MAGIC,
+    SALT_LEN,
+    IV_LEN,
+    SIZE_LEN,
+    ChunkSizes,
+    SegmentedWriter,
+    _derive_key,
+    _load_master_key,
+    chunk_sizes,
+    decrypt_stream,
+    decrypt_stream_range,
+    encrypt_upload_to_file,
+    ensure_encrypted_empty_file,
+)
+from locks import FileLock
+from utils import get_directory_contents, write_zip
+
+KiB = 1024
+MiB = 1024 * KiB
+
+DEFAULT_FILE_SIZES = [64 * KiB, 4 * MiB, 64 * MiB]
+DEFAULT_CHUNK_SIZES = [256 * KiB, 1 * MiB, 4 * MiB, 8 * MiB]
+DEFAULT_LISTING_SIZES = [100, 1000, 10000]
+DEFAULT_OPERATIONS = ["encrypt", "decrypt", "range", "legacy", "stream", "zip", "listing"]
+
+RANGE_READ_SIZE = 64 * KiB
+ZIP_FILE_COUNT = 8
+SEGMENT_TOLERANCE = 0.9
+
+AUTOTUNE_PATH = STATE_PATH / "chunk_sizes.json"
+
+
+class MemoryUpload:
+    def __init__(self, data: bytes):
+        self._buffer = io.BytesIO(data)
+
+    async def read(self, size: int = -1) -> bytes:
+        return self._buffer.read(size)
+
+
+class CountingSink(io.RawIOBase):
+    def __init__(self):
+        self._written = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        self._written += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._written
+
+
+def cpu_has_aes() -> Optional[bool]:
+    try:
+        cpuinfo = Path("/proc/cpuinfo").read_text()
+    except OSError:
+        return None
+    for line in cpuinfo.splitlines():
+        if line.startswith(("flags", "Features")):
+            return "aes" in line.split(":", 1)[1].split()
+    return None
+
+
+def environment() -> dict:
+    return {
+        "openssl": default_backend().openssl_version_text(),
+        "cpu_aes": cpu_has_aes(),
+        "cpu_count": os.cpu_count(),
+    }
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def measure(run: Callable[[], int], iterations: int) -> tuple[list[float], int]:
+    timings = []
+    processed = 0
+    for _ in range(iterations):
+        started = time.perf_counter()
+        processed = run()
+        timings.append(time.perf_counter() - started)
+    return timings, processed
+
+
+def summarize(
+    operation: str,
+    file_size: int,
+    chunk_size: Optional[int],
+    timings: list[float],
+    processed: int,
+) -> dict:
+    median = statistics.median(timings)
+    return {
+        "operation": operation,
+        "file_size": file_size,
+        "chunk_size": chunk_size,
+        "iterations": len(timings),
+        "mb_per_s": (processed / MiB) / median if median > 0 else None,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+    }
+
+
+def write_segmented(path: Path, data: bytes, segment_size: int) -> None:
+    path.unlink(missing_ok=True)
+    with SegmentedWriter(path, segment_size=segment_size) as writer:
+        writer.write(data)
+
+
+def write_legacy(path: Path, data: bytes) -> None:
+    salt = os.urandom(SALT_LEN)
+    iv = os.urandom(IV_LEN)
+    key = _derive_key(_load_master_key(), salt)
+    sealed = AESGCM(key).encrypt(iv, data, None)
+    path.write_bytes(MAGIC + salt + iv + len(data).to_bytes(SIZE_LEN, "big") + sealed)
+
+
+def bench_encrypt(workdir: Path, data: bytes, chunk_size: int) -> Callable[[], int]:
+    out_path = workdir / "encrypt.bin"
+
+    def run() -> int:
+        out_path.unlink(missing_ok=True)
+        return asyncio.run(
+            encrypt_upload_to_file(MemoryUpload(data), out_path, chunk_size=chunk_size)
+        )
+
+    return run
+
+
+def bench_decrypt(workdir: Path, data: bytes, chunk_size: int) -> Callable[[], int]:
+    path = workdir / "decrypt.bin"
+    write_segmented(path, data, chunk_size)
+
+    def run() -> int:
+        return sum(len(chunk) for chunk in decrypt_stream(path))
+
+    return run
+
+
+def bench_range(workdir: Path, data: bytes, chunk_size: int) -> Callable[[], int]:
+    path = workdir / "range.bin"
+    write_segmented(path, data, chunk_size)
+    length = min(RANGE_READ_SIZE, len(data))
+    rng = random.Random(0)
+
+    def run() -> int:
+        start = rng.randint(0, len(data) - length)
+        return sum(
+            len(chunk)
+            for chunk in decrypt_stream_range(path, start, start + length - 1)
+        )
+
+    return run
+
+
+def bench_legacy(workdir: Path, data: bytes, chunk_size: int) -> Callable[[], int]:
+    path = workdir / "legacy.bin"
+    write_legacy(path, data)
+
+    def run() -> int:
+        return sum(len(chunk) for chunk in decrypt_stream(path, chunk_size=chunk_size))
+
+    return run
+
+
+def bench_stream(workdir: Path, data: bytes, chunk_size: int) -> Callable[[], int]:
+    path = workdir / "plain.bin"
+    path.write_bytes(data)
+
+    def run() -> int:
+        total = 0
+        with path.open("rb") as f:
+            while True:
+                chunk = f.read(chunk_size)
+                if not chunk:
+                    break
+                total += len(chunk)
+        return total
+
+    return run
+
+
+def bench_zip(workdir: Path, data: bytes) -> Callable[[], int]:
+    folder = workdir / "zip"
+    folder.mkdir(exist_ok=True)
+    for number in range(ZIP_FILE_COUNT):
+        write_segmented(folder / f"file{number}.bin", data, chunk_sizes.segment)
+    item_paths = [{"id": "zip", "name": "zip", "is_dir": True}]
+
+    def run() -> int:
+        write_zip(CountingSink(), item_paths, workdir)
+        return len(data) * ZIP_FILE_COUNT
+
+    return run
+
+
+def bench_listing(workdir: Path, entries: int) -> Callable[[], int]:
+    folder = workdir / f"listing{entries}"
+    folder.mkdir(exist_ok=True)
+    for number in range(entries):
+        ensure_encrypted_empty_file(folder / f"file{number}.txt")
+
+    def run() -> int:
+        return len(get_directory_contents(folder, workdir))
+
+    return run
+
+
+CHUNKED_BENCHMARKS = {
+    "encrypt": bench_encrypt,
+    "decrypt": bench_decrypt,
+    "range": bench_range,
+    "legacy": bench_legacy,
+    "stream": bench_stream,
+}
+
+
+def run_suite(
+    operations: list[str],
+    file_sizes: list[int],
+    chunk_sizes_to_try: list[int],
+    listing_sizes: list[int],
+    iterations: int,
+    workdir: Path,
+    on_result: Optional[Callable[[dict], None]] = None,
+) -> list[dict]:
+    results = []
+
+    def record(result: dict) -> None:
+        results.append(result)
+        if on_result:
+            on_result(result)
+
+    for file_size in file_sizes:
+        data = os.urandom(file_size)
+        for operation in operations:
+            if operation in CHUNKED_BENCHMARKS:
+                for chunk_size in chunk_sizes_to_try:
+                    run = CHUNKED_BENCHMARKS[operation](workdir, data, chunk_size)
+                    timings, processed = measure(run, iterations)
+                    record(summarize(operation, file_size, chunk_size, timings, processed))
+            elif operation == "zip":
+                timings, processed = measure(bench_zip(workdir, data), iterations)
+                record(summarize("zip", file_size, None, timings, processed))
+
+    if "listing" in operations:
+        for entries in listing_sizes:
+            timings, _ = measure(bench_listing(workdir, entries), iterations)
+            result = summarize("listing", entries, None, timings, 0)
+            result["mb_per_s"] = None
+            record(result)
+    return results
+
+
+def _fastest(results: list[dict], operation: str) -> dict:
+    return max(
+        (result for result in results if result["operation"] == operation),
+        key=lambda result: result["mb_per_s"] or 0,
+    )
+
+
+def autotune(
+    sample_size: int = CHUNK_AUTOTUNE_SAMPLE_SIZE,
+    candidates: Optional[list[int]] = None,
+    iterations: int = 3,
+) -> ChunkSizes:
+    candidates = candidates or DEFAULT_CHUNK_SIZES
+    STATE_PATH.mkdir(parents=True, exist_ok=True)
+    workdir = Path(tempfile.mkdtemp(prefix="autotune-", dir=STATE_PATH))
+    try:
+        results = run_suite(
+            ["encrypt", "decrypt", "legacy", "stream"],
+            [sample_size],
+            candidates,
+            [],
+            iterations,
+            workdir,
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    best_decrypt = _fastest(results, "decrypt")["mb_per_s"] or 0
+    segment = min(
+        result["chunk_size"]
+        for result in results
+        if result["operation"] == "decrypt"
+        and (result["mb_per_s"] or 0) >= best_decrypt * SEGMENT_TOLERANCE
+    )
+
+    chunk_sizes.encrypt = _fastest(results, "encrypt")["chunk_size"]
+    chunk_sizes.decrypt = _fastest(results, "legacy")["chunk_size"]
+    chunk_sizes.stream = _fastest(results, "stream")["chunk_size"]
+    chunk_sizes.segment = segment
+    return chunk_sizes
+
+
+def load_or_autotune() -> ChunkSizes:
+    # Workers started by the same supervisor share one tuning run.
+    group = os.getppid()
+    with FileLock("autotune"):
+        try:
+            stored = json.loads(AUTOTUNE_PATH.read_text())
+        except (OSError, ValueError):
+            stored = None
+        if stored and stored.get("group") == group:
+            for name, value in stored["chunk_sizes"].items():
+                setattr(chunk_sizes, name, value)
+            return chunk_sizes
+
+        autotune()
+        AUTOTUNE_PATH.write_text(
+            json.dumps({"group": group, "chunk_sizes": asdict(chunk_sizes)})
+        )
+    return chunk_sizes
+
+
+def _sizes(value: str) -> list[int]:
+    units = {"k": KiB, "m": MiB, "g": 1024 * MiB}
+    sizes = []
+    for part in value.split(","):
+        part = part.strip().lower().rstrip("b")
+        multiplier = units.get(part[-1:], 1)
+        sizes.append(int(float(part.rstrip("kmg")) * multiplier))
+    return sizes
+
+
+def _format_size(size: int) -> str:
+    for unit, scale in (("M", MiB), ("K", KiB)):
+        if size >= scale and size % scale == 0:
+            return f"{size // scale}{unit}"
+    return str(size)
+
+
+def _print_result(result: dict) -> None:
+    chunk = _format_size(result["chunk_size"]) if result["chunk_size"] else "-"
+    size = (
+        str(result["file_size"])
+        if result["operation"] == "listing"
+        else _format_size(result["file_size"])
+    )
+    throughput = f"{result['mb_per_s']:.1f}" if result["mb_per_s"] else "-"
+    print(
+        f"{result['operation']:<8} {size:>8} {chunk:>6} "
+        f"{throughput:>10} {result['p50_ms']:>10.2f} {result['p99_ms']:>10.2f}"
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Benchmark PiDrive crypto, ZIP and listing throughput."
+    )
+    parser.add_argument(
+        "--operations", default=",".join(DEFAULT_OPERATIONS), help="Comma-separated"
+    )
+    parser.add_argument(
+        "--file-sizes",
+        type=_sizes,
+        default=DEFAULT_FILE_SIZES,
+        help="Comma-separated, e.g. 64k,4m,64m",
+    )
+    parser.add_argument(
+        "--chunk-sizes",
+        type=_sizes,
+        default=DEFAULT_CHUNK_SIZES,
+        help="Comma-separated, e.g. 256k,1m,4m",
+    )
+    parser.add_argument(
+        "--listing-sizes",
+        type=lambda value: [int(part) for part in value.split(",")],
+        default=DEFAULT_LISTING_SIZES,
+    )
+    parser.add_argument("--iterations", type=int, default=5)
+    parser.add_argument("--workdir", type=Path, default=None)
+    parser.add_argument("--json", type=Path, default=None, help="Write results here")
+    parser.add_argument(
+        "--autotune", action="store_true", help="Print the chunk sizes autotune picks"
+    )
+    args = parser.parse_args()
+
+    env = environment()
+    print(
+        f"OpenSSL: {env['openssl']}, AES instructions: {env['cpu_aes']}, "
+        f"CPUs: {env['cpu_count']}"
+    )
+
+    if args.autotune:
+        print(autotune(candidates=args.chunk_sizes))
+        return
+
+    workdir = Path(tempfile.mkdtemp(prefix="pidrive-bench-", dir=args.workdir))
+    print(
+        f"{'op':<8} {'size':>8} {'chunk':>6} {'MB/s':>10} {'p50 ms':>10} {'p99 ms':>10}"
+    )
+    try:
+        results = run_suite(
+            args.operations.split(","),
+            args.file_sizes,
+            args.chunk_sizes,
+            args.listing_sizes,
+            args.iterations,
+            workdir,
+            on_result=_print_result,
+        )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.json:
+        args.json.write_text(
+            json.dumps({"environment": env, "results": results}, indent=2)
+        )
+
+
+if __name__ == "__main__":
+    main()
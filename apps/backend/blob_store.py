@@ -0,0 +1,261 @@
+import hashlib
+import hmac
+import os
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+from fastcdc import fastcdc
+
+from config import (
+    BASE_PATH,
+    STATE_PATH,
+    BLOB_PATH,
+    CHUNK_MIN_SIZE,
+    CHUNK_AVG_SIZE,
+    CHUNK_MAX_SIZE,
+    BLOB_GC_GRACE_SECONDS,
+)
+from crypto_utils import (
+    MANIFEST_MAGIC,
+    IV_LEN,
+    SIZE_LEN,
+    _load_master_key,
+)
+from metrics import CRYPTO_BYTES, record_cache
+from profiling import stage
+
+CHUNK_ID_LEN = 32
+CHUNK_COUNT_LEN = 4
+CHUNK_LENGTH_LEN = 4
+MANIFEST_HEADER_LEN = len(MANIFEST_MAGIC) + SIZE_LEN + CHUNK_COUNT_LEN
+MANIFEST_ENTRY_LEN = CHUNK_ID_LEN + CHUNK_LENGTH_LEN
+
+_ENCRYPTED_CHUNKS = CRYPTO_BYTES.labels("encrypt", "chunk")
+_DECRYPTED_CHUNKS = CRYPTO_BYTES.labels("decrypt", "chunk")
+
+
+@lru_cache(maxsize=1)
+def _chunk_keys() -> tuple[bytes, bytes]:
+    master = _load_master_key()
+    keys = []
+    for info in (b"pidrive-self:chunk-id:v1", b"pidrive-self:chunk:v1"):
+        hkdf = HKDF(algorithm=hashes.SHA256(), length=32, salt=None, info=info)
+        keys.append(hkdf.derive(master))
+    return keys[0], keys[1]
+
+
+def chunk_id(data: bytes) -> bytes:
+    id_key, _ = _chunk_keys()
+    return hmac.new(id_key, data, hashlib.sha256).digest()
+
+
+def blob_path(chunk: bytes) -> Path:
+    name = chunk.hex()
+    return BLOB_PATH / name[:2] / name[2:4] / name
+
+
+def put_chunk(data: bytes) -> tuple[bytes, int]:
+    chunk = chunk_id(data)
+    path = blob_path(chunk)
+    exists = path.exists()
+    record_cache("dedup_chunk", exists)
+    if exists:
+        os.utime(path)
+        return chunk, len(data)
+
+    _, enc_key = _chunk_keys()
+    nonce = os.urandom(IV_LEN)
+    with stage("crypto"):
+        sealed = AESGCM(enc_key).encrypt(nonce, data, chunk)
+
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(f"{path.name}.{os.getpid()}.{time.monotonic_ns()}.tmp")
+    with tmp_path.open("wb") as out:
+        out.write(nonce)
+        out.write(sealed)
+    os.replace(tmp_path, path)
+    _ENCRYPTED_CHUNKS.inc(len(data))
+    return chunk, len(data)
+
+
+def get_chunk(chunk: bytes) -> bytes:
+    _, enc_key = _chunk_keys()
+    with blob_path(chunk).open("rb") as f:
+        nonce = f.read(IV_LEN)
+        sealed = f.read()
+    with stage("crypto"):
+        data = AESGCM(enc_key).decrypt(nonce, sealed, chunk)
+    _DECRYPTED_CHUNKS.inc(len(data))
+    return data
+
+
+class ManifestWriter:
+    def __init__(self, out_path: Path, reserved: bool = False):
+        self._out_path = out_path
+        self._reserved = reserved
+        self._entries: list[tuple[bytes, int]] = []
+        self._buffer = bytearray()
+        self._plain_size = 0
+        if not reserved:
+            out_path.open("xb").close()
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self._plain_size += len(data)
+        if len(self._buffer) >= 2 * CHUNK_MAX_SIZE:
+            self._flush(final=False)
+        return len(data)
+
+    def _flush(self, final: bool) -> None:
+        if not self._buffer:
+            return
+        data = bytes(self._buffer)
+        chunks = list(
+            fastcdc(data, CHUNK_MIN_SIZE, CHUNK_AVG_SIZE, CHUNK_MAX_SIZE, fat=True)
+        )
+        consumed = len(data)
+        if not final and len(chunks) > 1:
+            consumed = chunks.pop().offset
+        for piece in chunks:
+            self._entries.append(put_chunk(piece.data))
+        del self._buffer[:consumed]
+
+    def close(self) -> int:
+        self._flush(final=True)
+        write_manifest(self._out_path, self._plain_size, self._entries)
+        return self._plain_size
+
+
+def write_manifest(
+    out_path: Path, plain_size: int, entries: list[tuple[bytes, int]]
+) -> None:
+    with out_path.open("wb") as out:
+        out.write(MANIFEST_MAGIC)
+        out.write(plain_size.to_bytes(SIZE_LEN, "big"))
+        out.write(len(entries).to_bytes(CHUNK_COUNT_LEN, "big"))
+        for chunk, length in entries:
+            out.write(chunk)
+            out.write(length.to_bytes(CHUNK_LENGTH_LEN, "big"))
+
+
+def read_manifest(path: Path) -> tuple[int, list[tuple[bytes, int]]]:
+    with path.open("rb") as f:
+        header = f.read(MANIFEST_HEADER_LEN)
+        if (
+            len(header) != MANIFEST_HEADER_LEN
+            or header[: len(MANIFEST_MAGIC)] != MANIFEST_MAGIC
+        ):
+            raise ValueError("Not a PiDrive manifest")
+        plain_size = int.from_bytes(
+            header[len(MANIFEST_MAGIC) : len(MANIFEST_MAGIC) + SIZE_LEN], "big"
+        )
+        count = int.from_bytes(header[-CHUNK_COUNT_LEN:], "big")
+        body = f.read(count * MANIFEST_ENTRY_LEN)
+    if len(body) != count * MANIFEST_ENTRY_LEN:
+        raise ValueError("Truncated PiDrive manifest")
+    entries = []
+    for offset in range(0, len(body), MANIFEST_ENTRY_LEN):
+        chunk = body[offset : offset + CHUNK_ID_LEN]
+        length = int.from_bytes(
+            body[offset + CHUNK_ID_LEN : offset + MANIFEST_ENTRY_LEN], "big"
+        )
+        entries.append((chunk, length))
+    return plain_size, entries
+
+
+def read_manifest_size(path: Path) -> int:
+    with path.open("rb") as f:
+        header = f.read(len(MANIFEST_MAGIC) + SIZE_LEN)
+    return int.from_bytes(header[len(MANIFEST_MAGIC) :], "big")
+
+
+def iter_manifest(path: Path) -> Iterator[bytes]:
+    _, entries = read_manifest(path)
+    for chunk, _ in entries:
+        yield get_chunk(chunk)
+
+
+def iter_manifest_range(path: Path, start: int, end: int) -> Iterator[bytes]:
+    _, entries = read_manifest(path)
+    produced = 0
+    for chunk, length in entries:
+        next_produced = produced + length
+        if next_produced > start:
+            data = get_chunk(chunk)
+            s = max(0, start - produced)
+            e = min(length, end - produced + 1)
+            yield data[s:e]
+        produced = next_produced
+        if produced > end:
+            break
+
+
+def walk_files(root: Path) -> Iterator[Path]:
+    skip = {str(BLOB_PATH.resolve()), str(STATE_PATH.resolve())}
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames[:] = [
+            name
+            for name in dirnames
+            if str((Path(dirpath) / name).resolve()) not in skip
+        ]
+        for name in filenames:
+            yield Path(dirpath) / name
+
+
+def is_manifest(path: Path) -> bool:
+    try:
+        with path.open("rb") as f:
+            return f.read(len(MANIFEST_MAGIC)) == MANIFEST_MAGIC
+    except OSError:
+        return False
+
+
+def referenced_chunks(root: Path) -> set[bytes]:
+    chunks = set()
+    for path in walk_files(root):
+        if not is_manifest(path):
+            continue
+        try:
+            chunks.update(chunk for chunk, _ in read_manifest(path)[1])
+        except (OSError, ValueError):
+            continue
+    return chunks
+
+
+def physical_chunk_size(chunks: set[bytes]) -> int:
+    total = 0
+    for chunk in chunks:
+        try:
+            total += blob_path(chunk).stat().st_size
+        except OSError:
+            continue
+    return total
+
+
+def collect_garbage() -> int:
+    if not BLOB_PATH.is_dir():
+        return 0
+    live = referenced_chunks(BASE_PATH)
+    cutoff = time.time() - BLOB_GC_GRACE_SECONDS
+    removed = 0
+    for path in _walk_blobs():
+        try:
+            if path.stat().st_mtime > cutoff:
+                continue
+            if path.name.endswith(".tmp") or bytes.fromhex(path.name) not in live:
+                path.unlink()
+                removed += 1
+        except (OSError, ValueError):
+            continue
+    return removed
+
+
+def _walk_blobs() -> Iterator[Path]:
+    for dirpath, _, filenames in os.walk(BLOB_PATH):
+        for name in filenames:
+            yield Path(dirpath) / name
@@ -0,0 +1,269 @@
+import asyncio
+import logging
+import stat
+import time
+from typing import Optional
+
+import file_events
+from config import (
+    BASE_PATH,
+    CHANGES_RETENTION_SECONDS,
+    CHANGES_PRUNE_INTERVAL,
+    CHANGES_POLL_INTERVAL,
+)
+from crypto_utils import get_plaintext_size, is_encrypted_file
+from file_events import FileEvent
+from locks import FileLock
+from state_db import connect, transaction
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS changes (
+    seq INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id TEXT NOT NULL,
+    action TEXT NOT NULL,
+    path TEXT NOT NULL,
+    new_path TEXT,
+    changed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS changes_user ON changes (user_id, seq);
+CREATE INDEX IF NOT EXISTS changes_age ON changes (changed_at);
+CREATE TABLE IF NOT EXISTS change_floors (
+    user_id TEXT PRIMARY KEY,
+    pruned_seq INTEGER NOT NULL
+);
+"""
+
+UPDATED = "updated"
+REMOVED = "removed"
+
+
+class CursorExpired(Exception):
+    pass
+
+
+def _compact(rows: list) -> list[tuple[str, str, bool]]:
+    # Turns journal rows into (path, op, subtree) entries in which only the
+    # last op on a path survives and a removal replaces everything that
+    # happened below it, as does a subtree update. Folders that appear
+    # arrive as whole subtrees, which the client lists again; a move also
+    # removes its source.
+    ops: dict[str, tuple[str, bool]] = {}
+
+    def put(path: str, op: str, subtree: bool) -> None:
+        if op == REMOVED or subtree:
+            prefix = path + "/"
+            for known in [p for p in ops if p.startswith(prefix)]:
+                del ops[known]
+        ops.pop(path, None)
+        ops[path] = (op, subtree)
+
+    for row in rows:
+        if row["action"] == file_events.DELETED:
+            put(row["path"], REMOVED, False)
+        elif row["action"] == file_events.MOVED:
+            put(row["path"], REMOVED, False)
+            put(row["new_path"], UPDATED, True)
+        elif row["action"] == file_events.COPIED:
+            put(row["new_path"], UPDATED, True)
+        else:
+            # Restores from the trash bring whole folders back.
+            put(row["path"], UPDATED, True)
+    return [(path, op, subtree) for path, (op, subtree) in ops.items()]
+
+
+def _describe(user_id: str, path: str, op: str, subtree: bool) -> dict:
+    entry = {"path": path, "op": op}
+    if op == REMOVED:
+        return entry
+    full_path = BASE_PATH / user_id / path
+    try:
+        st = full_path.stat()
+        is_dir = stat.S_ISDIR(st.st_mode)
+        if is_dir:
+            size = None
+        elif is_encrypted_file(full_path):
+            size = get_plaintext_size(full_path)
+        else:
+            size = st.st_size
+    except FileNotFoundError:
+        # Gone again since, outside of the journal's view.
+        return {"path": path, "op": REMOVED}
+    entry.update(
+        is_dir=is_dir,
+        size=size,
+        modified_at=st.st_mtime,
+        subtree=subtree and is_dir,
+    )
+    return entry
+
+
+# An append-only log of every change file events report, per user. Clients
+# keep the cursor of the last change they applied and ask for what came
+# after it, so a poll costs O(changes) instead of a walk of their tree.
+# Events arrive on request handlers and job threads and are written in
+# batches by one task, so recording them never blocks a request.
+class ChangeJournal:
+    def __init__(self, retention: int, prune_interval: int, poll_interval: float):
+        self.retention = retention
+        self.prune_interval = prune_interval
+        self.poll_interval = poll_interval
+        self._leader = FileLock("change-journal")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._events: Optional[asyncio.Queue] = None
+        self._changed: Optional[asyncio.Event] = None
+        self._tasks: list[asyncio.Task] = []
+
+    async def start(self) -> None:
+        await asyncio.to_thread(connect().executescript, SCHEMA)
+        self._events = asyncio.Queue()
+        self._changed = asyncio.Event()
+        self._tasks = [
+            asyncio.create_task(self._write()),
+            asyncio.create_task(self._prune()),
+        ]
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self) -> None:
+        self._loop = None
+        if self._events is not None and not self._events.empty():
+            # Flush what the last requests recorded before shutting down.
+            await asyncio.to_thread(self._append, self._drain())
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._leader.release()
+
+    def handle(self, event: FileEvent) -> None:
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    def _drain(self) -> list[FileEvent]:
+        events = []
+        while not self._events.empty():
+            events.append(self._events.get_nowait())
+        return events
+
+    async def _write(self) -> None:
+        while True:
+            events = [await self._events.get()]
+            events.extend(self._drain())
+            try:
+                await asyncio.to_thread(self._append, events)
+            except Exception:
+                logger.exception("Failed to record %d changes", len(events))
+                continue
+            self._notify()
+
+    def _append(self, events: list[FileEvent]) -> None:
+        now = time.time()
+        with transaction() as conn:
+            conn.executemany(
+                "INSERT INTO changes (user_id, action, path, new_path, changed_at)"
+                " VALUES (?, ?, ?, ?, ?)",
+                [(e.user_id, e.action, e.path, e.new_path, now) for e in events],
+            )
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def _prune(self) -> None:
+        while True:
+            if self._leader.acquire(blocking=False):
+                try:
+                    await asyncio.to_thread(self._delete_expired)
+                except Exception:
+                    logger.exception("Failed to prune the change journal")
+            await asyncio.sleep(self.prune_interval)
+
+    def _delete_expired(self) -> None:
+        # Remembers the newest pruned change of each user, so cursors from
+        # before it can be told apart from ones that are merely quiet.
+        cutoff = time.time() - self.retention
+        with transaction() as conn:
+            conn.execute(
+                "INSERT INTO change_floors (user_id, pruned_seq)"
+                " SELECT user_id, MAX(seq) FROM changes WHERE changed_at < ?"
+                " GROUP BY user_id ON CONFLICT (user_id) DO UPDATE"
+                " SET pruned_seq = MAX(pruned_seq, excluded.pruned_seq)",
+                (cutoff,),
+            )
+            conn.execute("DELETE FROM changes WHERE changed_at < ?", (cutoff,))
+
+    def _floor(self, user_id: str) -> int:
+        row = (
+            connect()
+            .execute(
+                "SELECT pruned_seq FROM change_floors WHERE user_id = ?", (user_id,)
+            )
+            .fetchone()
+        )
+        return row["pruned_seq"] if row else 0
+
+    def latest(self, user_id: str) -> int:
+        row = (
+            connect()
+            .execute(
+                "SELECT MAX(seq) AS seq FROM changes WHERE user_id = ?", (user_id,)
+            )
+            .fetchone()
+        )
+        return row["seq"] or self._floor(user_id)
+
+    def _since(self, user_id: str, cursor: int, limit: int) -> list:
+        if cursor < self._floor(user_id):
+            raise CursorExpired("Cursor has expired, a full resync is needed")
+        return (
+            connect()
+            .execute(
+                "SELECT seq, action, path, new_path FROM changes"
+                " WHERE user_id = ? AND seq > ? ORDER BY seq LIMIT ?",
+                (user_id, cursor, limit),
+            )
+            .fetchall()
+        )
+
+    def _changes(self, user_id: str, cursor: int, limit: int) -> dict:
+        rows = self._since(user_id, cursor, limit)
+        entries = [
+            _describe(user_id, path, op, subtree)
+            for path, op, subtree in _compact(rows)
+        ]
+        return {
+            "changes": entries,
+            "cursor": str(rows[-1]["seq"] if rows else cursor),
+            "has_more": len(rows) == limit,
+        }
+
+    async def changes(
+        self, user_id: str, cursor: Optional[int], limit: int, wait: float
+    ) -> dict:
+        if cursor is None:
+            # A new client lists its tree once and syncs from here on.
+            latest = await asyncio.to_thread(self.latest, user_id)
+            return {"changes": [], "cursor": str(latest), "has_more": False}
+
+        deadline = self._loop.time() + wait
+        while True:
+            result = await asyncio.to_thread(self._changes, user_id, cursor, limit)
+            remaining = deadline - self._loop.time()
+            if result["changes"] or remaining <= 0:
+                return result
+            # Other workers' writes are only seen by polling.
+            changed = self._changed
+            try:
+                await asyncio.wait_for(
+                    changed.wait(), min(self.poll_interval, remaining)
+                )
+            except asyncio.TimeoutError:
+                pass
+
+
+change_journal = ChangeJournal(
+    CHANGES_RETENTION_SECONDS, CHANGES_PRUNE_INTERVAL, CHANGES_POLL_INTERVAL
+)
+file_events.subscribe(change_journal.handle)
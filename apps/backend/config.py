@@ -5,6 +5,7 @@ from dotenv import load_dotenv
 load_dotenv()
 
 BASE_PATH = Path(os.environ.get("BASE_PATH", "."))
+STATE_PATH = Path(os.environ.get("STATE_PATH", BASE_PATH / ".pidrive"))
 JWT_SECRET = os.getenv("JWT_SECRET")
 API_KEY = os.getenv("API_KEY")
 FILES_MASTER_KEY = os.getenv("FILES_MASTER_KEY")
@@ -16,6 +17,180 @@ ALLOWED_ORIGINS = [
 
 HOME = "Home"
 
+WEB_CONCURRENCY = int(os.getenv("WEB_CONCURRENCY", "1"))
+
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "4096"))
+AUTH_CACHE_TTL = int(os.getenv("AUTH_CACHE_TTL", "300"))
+
+METRICS_TOKEN = os.getenv("METRICS_TOKEN")
+
+SERVER_TIMING = os.getenv("SERVER_TIMING", "false").lower() == "true"
+PROFILE_SAMPLE_RATE = float(os.getenv("PROFILE_SAMPLE_RATE", "0"))
+PROFILE_SLOW_SECONDS = float(os.getenv("PROFILE_SLOW_SECONDS", "0"))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL", "0.005"))
+PROFILE_PATH = Path(os.environ.get("PROFILE_PATH", STATE_PATH / "profiles"))
+PROFILE_MAX_FILES = int(os.getenv("PROFILE_MAX_FILES", "200"))
+
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_HOT_ROUTES = [
+    route.strip()
+    for route in os.getenv(
+        "LOG_HOT_ROUTES",
+        "/media/thumbnails,/media/stream,/share/thumbnails,/share/stream,/metrics",
+    ).split(",")
+    if route.strip()
+]
+LOG_HOT_SAMPLE_RATE = float(os.getenv("LOG_HOT_SAMPLE_RATE", "0.01"))
+AUDIT_LOG_PATH = Path(os.environ.get("AUDIT_LOG_PATH", STATE_PATH / "audit.log"))
+AUDIT_LOG_MAX_BYTES = int(os.getenv("AUDIT_LOG_MAX_BYTES", str(50 * 1024 * 1024)))
+AUDIT_LOG_BACKUPS = int(os.getenv("AUDIT_LOG_BACKUPS", "10"))
+AUDIT_BATCH_SIZE = int(os.getenv("AUDIT_BATCH_SIZE", "100"))
+AUDIT_FLUSH_INTERVAL = float(os.getenv("AUDIT_FLUSH_INTERVAL", "5"))
+
+RATE_LIMIT_ENABLED = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "10000"))
+# Per endpoint class: "<requests per second>,<burst>,<concurrent requests per
+# user or share link>,<concurrent requests in total>". Split across workers.
+RATE_LIMIT_DEFAULTS = {
+    "zip": "0.2,6,2,4",
+    "download": "10,30,8,64",
+    "stream": "30,120,8,64",
+    "thumbnail": "50,300,16,32",
+    "search": "2,10,2,8",
+}
+RATE_LIMITS = {
+    name: tuple(map(float, os.getenv(f"RATE_LIMIT_{name.upper()}", default).split(",")))
+    for name, default in RATE_LIMIT_DEFAULTS.items()
+}
+# Share requests whose link cannot be verified share one bucket per endpoint
+# class: "<requests per second>,<burst>,<concurrent requests>".
+RATE_LIMIT_ANONYMOUS = tuple(
+    map(float, os.getenv("RATE_LIMIT_ANONYMOUS", "0.2,5,1").split(","))
+)
+
+SHARE_TOKENS_REQUIRED = os.getenv("SHARE_TOKENS_REQUIRED", "false").lower() == "true"
+SHARE_TOKEN_DEFAULT_TTL = int(
+    os.getenv("SHARE_TOKEN_DEFAULT_TTL", str(7 * 24 * 60 * 60))
+)
+SHARE_TOKEN_MAX_TTL = int(os.getenv("SHARE_TOKEN_MAX_TTL", str(90 * 24 * 60 * 60)))
+SHARE_REVOCATION_REFRESH = float(os.getenv("SHARE_REVOCATION_REFRESH", "5"))
+
+SHARE_CACHE_PATH = Path(os.environ.get("SHARE_CACHE_PATH", STATE_PATH / "share-cache"))
+SHARE_CACHE_MAX_BYTES = int(
+    os.getenv("SHARE_CACHE_MAX_BYTES", str(2 * 1024 * 1024 * 1024))
+)
+SHARE_CACHE_MAX_ENTRY_BYTES = int(
+    os.getenv("SHARE_CACHE_MAX_ENTRY_BYTES", str(512 * 1024 * 1024))
+)
+
+PREVIEW_CACHE_PATH = Path(os.environ.get("PREVIEW_CACHE_PATH", STATE_PATH / "previews"))
+PREVIEW_CACHE_MAX_BYTES = int(
+    os.getenv("PREVIEW_CACHE_MAX_BYTES", str(1024 * 1024 * 1024))
+)
+PREVIEW_SPRITE_INTERVAL = float(os.getenv("PREVIEW_SPRITE_INTERVAL", "5"))
+PREVIEW_SPRITE_MAX_TILES = int(os.getenv("PREVIEW_SPRITE_MAX_TILES", "100"))
+PREVIEW_FFMPEG_CONCURRENCY = int(os.getenv("PREVIEW_FFMPEG_CONCURRENCY", "4"))
+
+METADATA_WORKERS = int(os.getenv("METADATA_WORKERS", "1"))
+METADATA_QUEUE_SIZE = int(os.getenv("METADATA_QUEUE_SIZE", "10000"))
+METADATA_HEADER_BYTES = int(os.getenv("METADATA_HEADER_BYTES", str(256 * 1024)))
+METADATA_MAX_HEADER_BYTES = int(
+    os.getenv("METADATA_MAX_HEADER_BYTES", str(4 * 1024 * 1024))
+)
+METADATA_VIDEO_PROBE_BYTES = int(
+    os.getenv("METADATA_VIDEO_PROBE_BYTES", str(8 * 1024 * 1024))
+)
+METADATA_RESCAN_INTERVAL = int(os.getenv("METADATA_RESCAN_INTERVAL", str(6 * 3600)))
+GALLERY_PAGE_SIZE = int(os.getenv("GALLERY_PAGE_SIZE", "200"))
+GALLERY_MAX_PAGE_SIZE = int(os.getenv("GALLERY_MAX_PAGE_SIZE", "1000"))
+PDF_POOL_SIZE = int(os.getenv("PDF_POOL_SIZE", "8"))
+PDF_PAGE_CACHE_BYTES = int(os.getenv("PDF_PAGE_CACHE_BYTES", str(64 * 1024 * 1024)))
+PDF_DEFAULT_WIDTH = int(os.getenv("PDF_DEFAULT_WIDTH", "1024"))
+PDF_MAX_WIDTH = int(os.getenv("PDF_MAX_WIDTH", "4096"))
+PDF_TILE_SIZE = int(os.getenv("PDF_TILE_SIZE", "512"))
+
+CONTENT_INDEX_PATH = Path(
+    os.environ.get("CONTENT_INDEX_PATH", STATE_PATH / "content-index")
+)
+CONTENT_INDEX_WORKERS = int(os.getenv("CONTENT_INDEX_WORKERS", "1"))
+CONTENT_INDEX_QUEUE_SIZE = int(os.getenv("CONTENT_INDEX_QUEUE_SIZE", "10000"))
+CONTENT_INDEX_RESCAN_INTERVAL = int(
+    os.getenv("CONTENT_INDEX_RESCAN_INTERVAL", str(6 * 3600))
+)
+CONTENT_MAX_FILE_BYTES = int(
+    os.getenv("CONTENT_MAX_FILE_BYTES", str(64 * 1024 * 1024))
+)
+CONTENT_MAX_TEXT_CHARS = int(os.getenv("CONTENT_MAX_TEXT_CHARS", str(1024 * 1024)))
+CONTENT_SEARCH_PAGE_SIZE = int(os.getenv("CONTENT_SEARCH_PAGE_SIZE", "50"))
+CONTENT_SEARCH_MAX_PAGE_SIZE = int(os.getenv("CONTENT_SEARCH_MAX_PAGE_SIZE", "200"))
+
+DELTA_MAX_LITERAL_BYTES = int(
+    os.getenv("DELTA_MAX_LITERAL_BYTES", str(64 * 1024 * 1024))
+)
+
+CHANGES_RETENTION_SECONDS = int(
+    os.getenv("CHANGES_RETENTION_SECONDS", str(30 * 24 * 60 * 60))
+)
+CHANGES_PRUNE_INTERVAL = int(os.getenv("CHANGES_PRUNE_INTERVAL", "3600"))
+CHANGES_POLL_INTERVAL = float(os.getenv("CHANGES_POLL_INTERVAL", "1"))
+CHANGES_PAGE_SIZE = int(os.getenv("CHANGES_PAGE_SIZE", "1000"))
+CHANGES_MAX_PAGE_SIZE = int(os.getenv("CHANGES_MAX_PAGE_SIZE", "10000"))
+CHANGES_MAX_WAIT = float(os.getenv("CHANGES_MAX_WAIT", "60"))
+
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_MAX_PER_USER = int(os.getenv("JOB_MAX_PER_USER", "2"))
+JOB_RETENTION_SECONDS = int(os.getenv("JOB_RETENTION_SECONDS", str(24 * 60 * 60)))
+
+EXTRACT_WORKERS = int(os.getenv("EXTRACT_WORKERS", "4"))
+EXTRACT_BUFFERED_ENTRY_BYTES = int(
+    os.getenv("EXTRACT_BUFFERED_ENTRY_BYTES", str(4 * 1024 * 1024))
+)
+EXTRACT_MAX_ENTRIES = int(os.getenv("EXTRACT_MAX_ENTRIES", "100000"))
+# "auto" lets an archive expand to EXTRACT_MAX_RATIO times its own size, and
+# never into the last EXTRACT_MIN_FREE_BYTES of the disk. A number sets a
+# fixed cap instead, and 0 lifts the cap altogether.
+_EXTRACT_MAX_BYTES = os.getenv("EXTRACT_MAX_BYTES", "auto").lower()
+EXTRACT_MAX_BYTES = None if _EXTRACT_MAX_BYTES == "auto" else int(_EXTRACT_MAX_BYTES)
+EXTRACT_MAX_RATIO = float(os.getenv("EXTRACT_MAX_RATIO", "100"))
+EXTRACT_MIN_FREE_BYTES = int(
+    os.getenv("EXTRACT_MIN_FREE_BYTES", str(1024 * 1024 * 1024))
+)
+
+BATCH_CONCURRENCY = int(os.getenv("BATCH_CONCURRENCY", "8"))
+
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "files").lower()
+BLOB_PATH = Path(os.environ.get("BLOB_PATH", STATE_PATH / "blobs"))
+CHUNK_MIN_SIZE = int(os.getenv("CHUNK_MIN_SIZE", str(256 * 1024)))
+CHUNK_AVG_SIZE = int(os.getenv("CHUNK_AVG_SIZE", str(1024 * 1024)))
+CHUNK_MAX_SIZE = int(os.getenv("CHUNK_MAX_SIZE", str(4 * 1024 * 1024)))
+BLOB_GC_INTERVAL = int(os.getenv("BLOB_GC_INTERVAL", str(6 * 60 * 60)))
+BLOB_GC_GRACE_SECONDS = int(os.getenv("BLOB_GC_GRACE_SECONDS", str(60 * 60)))
+
+COMPRESSION = os.getenv("COMPRESSION", "auto").lower()
+COMPRESSION_LEVEL = int(os.getenv("COMPRESSION_LEVEL", "3"))
+COMPRESSION_MIN_RATIO = float(os.getenv("COMPRESSION_MIN_RATIO", "0.9"))
+COMPRESSION_SAMPLE_SIZE = int(os.getenv("COMPRESSION_SAMPLE_SIZE", str(64 * 1024)))
+SEGMENT_SIZE = int(os.getenv("SEGMENT_SIZE", str(1024 * 1024)))
+
+ENCRYPT_CHUNK_SIZE = int(os.getenv("ENCRYPT_CHUNK_SIZE", str(4 * 1024 * 1024)))
+DECRYPT_CHUNK_SIZE = int(os.getenv("DECRYPT_CHUNK_SIZE", str(1024 * 1024)))
+STREAM_CHUNK_SIZE = int(os.getenv("STREAM_CHUNK_SIZE", str(1024 * 1024)))
+CHUNK_AUTOTUNE = os.getenv("CHUNK_AUTOTUNE", "false").lower() == "true"
+CHUNK_AUTOTUNE_SAMPLE_SIZE = int(
+    os.getenv("CHUNK_AUTOTUNE_SAMPLE_SIZE", str(32 * 1024 * 1024))
+)
+
+SCRUB_INTERVAL = int(os.getenv("SCRUB_INTERVAL", str(7 * 24 * 60 * 60)))
+SCRUB_RATE_BYTES = int(os.getenv("SCRUB_RATE_BYTES", str(20 * 1024 * 1024)))
+SCRUB_UPGRADE_LEGACY = os.getenv("SCRUB_UPGRADE_LEGACY", "true").lower() == "true"
+
+TRASH = ".trash"
+TRASH_RETENTION_SECONDS = int(
+    os.getenv("TRASH_RETENTION_SECONDS", str(30 * 24 * 60 * 60))
+)
+TRASH_MAX_BYTES = int(os.getenv("TRASH_MAX_BYTES", "0"))
+TRASH_PURGE_INTERVAL = int(os.getenv("TRASH_PURGE_INTERVAL", "600"))
+
 VIDEO_FORMATS = [
     ".mp4",
     ".avi",
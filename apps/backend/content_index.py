@@ -0,0 +1,465 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import logging
+import os
+import re
+import sqlite3
+import threading
+import time
+import zipfile
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterator, Optional
+from xml.etree import ElementTree
+
+import pypdfium2 as pdfium
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+import file_events
+from config import (
+    CONTENT_INDEX_PATH,
+    CONTENT_INDEX_WORKERS,
+    CONTENT_INDEX_QUEUE_SIZE,
+    CONTENT_INDEX_RESCAN_INTERVAL,
+    CONTENT_MAX_FILE_BYTES,
+    CONTENT_MAX_TEXT_CHARS,
+)
+from crypto_utils import (
+    _load_master_key,
+    DecryptedReader,
+    get_plaintext_size,
+    is_encrypted_file,
+)
+from indexer import FileIndexer, subtree
+from pdf_pages import PDFIUM_LOCK
+from state_db import BUSY_TIMEOUT_SECONDS
+
+logger = logging.getLogger(__name__)
+
+TEXT_FORMATS = (".txt", ".md")
+CONTENT_FORMATS = (*TEXT_FORMATS, ".pdf", ".docx", ".rtf")
+
+TOKEN = re.compile(r"\w+")
+MAX_TOKEN_CHARS = 64
+TERM_BYTES = 10
+QUERY_PART = re.compile(r'"([^"]*)"|(\S+)')
+SNIPPET_CHARS = 80
+WHITESPACE = re.compile(r"\s+")
+NONCE_LEN = 12
+
+DOCX_NS = "{http://schemas.openxmlformats.org/wordprocessingml/2006/main}"
+RTF_CONTROL = re.compile(r"\\([a-z]+)(-?\d+)? ?|\\'([0-9a-f]{2})|\\(.)|([{}])", re.I)
+RTF_SKIPPED = {"fonttbl", "colortbl", "stylesheet", "info", "pict", "header", "footer"}
+
+# Terms are stored as keyed hashes of the words, in document order, so the
+# FTS index answers words and phrases without holding any plaintext; the
+# text kept for snippets is sealed with a per-user key. Only the update
+# trigger on `terms` touches the FTS index, so renames are a plain UPDATE.
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    path TEXT NOT NULL UNIQUE,
+    file_size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    terms TEXT NOT NULL,
+    body BLOB,
+    error TEXT,
+    indexed_at REAL NOT NULL
+);
+CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+    terms, content='documents', content_rowid='id'
+);
+CREATE TRIGGER IF NOT EXISTS documents_ai AFTER INSERT ON documents BEGIN
+    INSERT INTO documents_fts (rowid, terms) VALUES (new.id, new.terms);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_ad AFTER DELETE ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, terms)
+    VALUES ('delete', old.id, old.terms);
+END;
+CREATE TRIGGER IF NOT EXISTS documents_au AFTER UPDATE OF terms ON documents BEGIN
+    INSERT INTO documents_fts (documents_fts, rowid, terms)
+    VALUES ('delete', old.id, old.terms);
+    INSERT INTO documents_fts (rowid, terms) VALUES (new.id, new.terms);
+END;
+"""
+
+UPSERT = (
+    "INSERT INTO documents"
+    " (path, file_size, mtime_ns, terms, body, error, indexed_at)"
+    " VALUES (?, ?, ?, ?, ?, ?, ?)"
+    " ON CONFLICT (path) DO UPDATE SET file_size = excluded.file_size,"
+    " mtime_ns = excluded.mtime_ns, terms = excluded.terms,"
+    " body = excluded.body, error = excluded.error,"
+    " indexed_at = excluded.indexed_at"
+)
+IN_SUBTREE = "(path = ? OR (path >= ? AND path < ?))"
+
+_local = threading.local()
+
+
+def content_kind(path: Path) -> Optional[str]:
+    suffix = path.suffix.lower()
+    if suffix in TEXT_FORMATS:
+        return "text"
+    if suffix in CONTENT_FORMATS:
+        return suffix[1:]
+    return None
+
+
+@lru_cache(maxsize=256)
+def _user_keys(user_id: str) -> tuple[bytes, bytes]:
+    master = _load_master_key()
+    keys = []
+    for info in (b"pidrive-self:content-term:v1", b"pidrive-self:content-body:v1"):
+        hkdf = HKDF(
+            algorithm=hashes.SHA256(),
+            length=32,
+            salt=user_id.encode(),
+            info=info,
+        )
+        keys.append(hkdf.derive(master))
+    return keys[0], keys[1]
+
+
+def _term(key: bytes, word: str) -> str:
+    digest = hmac.new(key, word.encode(), hashlib.sha256).digest()[:TERM_BYTES]
+    return base64.b32encode(digest).decode().lower()
+
+
+def _words(text: str) -> list[str]:
+    return [
+        word for word in TOKEN.findall(text.casefold()) if len(word) <= MAX_TOKEN_CHARS
+    ]
+
+
+def _seal(key: bytes, text: str) -> bytes:
+    nonce = os.urandom(NONCE_LEN)
+    return nonce + AESGCM(key).encrypt(nonce, text.encode(), None)
+
+
+def _unseal(key: bytes, sealed: bytes) -> str:
+    return AESGCM(key).decrypt(sealed[:NONCE_LEN], sealed[NONCE_LEN:], None).decode()
+
+
+def _open_plaintext(path: Path):
+    return DecryptedReader(path) if is_encrypted_file(path) else path.open("rb")
+
+
+def _plaintext_size(path: Path) -> int:
+    return get_plaintext_size(path) if is_encrypted_file(path) else path.stat().st_size
+
+
+def _text_content(path: Path) -> str:
+    with _open_plaintext(path) as reader:
+        data = reader.read(CONTENT_MAX_FILE_BYTES)
+    return data.decode("utf-8-sig", errors="replace")
+
+
+def _pdf_content(path: Path) -> str:
+    pages, length = [], 0
+    with _open_plaintext(path) as reader:
+        with PDFIUM_LOCK:
+            pdf = pdfium.PdfDocument(reader)
+        try:
+            for number in range(len(pdf)):
+                # Per page, so renders are not held up for a whole document.
+                with PDFIUM_LOCK:
+                    page = pdf[number]
+                    textpage = page.get_textpage()
+                    text = textpage.get_text_range()
+                    textpage.close()
+                    page.close()
+                pages.append(text)
+                length += len(text)
+                if length >= CONTENT_MAX_TEXT_CHARS:
+                    break
+        finally:
+            with PDFIUM_LOCK:
+                pdf.close()
+    return "\n".join(pages)
+
+
+def _docx_content(path: Path) -> str:
+    with _open_plaintext(path) as reader, zipfile.ZipFile(reader) as docx:
+        if docx.getinfo("word/document.xml").file_size > CONTENT_MAX_FILE_BYTES:
+            raise ValueError("Document body is too large to index")
+        paragraphs, current = [], []
+        with docx.open("word/document.xml") as xml:
+            for _, element in ElementTree.iterparse(xml):
+                if element.tag == f"{DOCX_NS}t" and element.text:
+                    current.append(element.text)
+                elif element.tag == f"{DOCX_NS}p":
+                    paragraphs.append("".join(current))
+                    current = []
+                    element.clear()
+    return "\n".join(paragraphs)
+
+
+def _rtf_content(path: Path) -> str:
+    # Enough of RTF for indexing: text and escaped characters, minus the
+    # font, colour and metadata groups.
+    source = _text_content(path)
+    out, depth, skip_depth = [], 0, None
+    position = 0
+    for match in RTF_CONTROL.finditer(source):
+        if skip_depth is None:
+            out.append(source[position : match.start()])
+        position = match.end()
+        word, number, hex_char, symbol, brace = match.groups()
+        if brace == "{":
+            depth += 1
+        elif brace == "}":
+            if skip_depth == depth:
+                skip_depth = None
+            depth -= 1
+        elif skip_depth is not None:
+            continue
+        elif word:
+            if word in RTF_SKIPPED:
+                skip_depth = depth
+            elif word == "u" and number:
+                out.append(chr(int(number) % 0x10000))
+            elif word in ("par", "line", "tab"):
+                out.append("\n")
+        elif hex_char:
+            out.append(bytes.fromhex(hex_char).decode("cp1252", errors="replace"))
+        elif symbol == "*":
+            skip_depth = depth
+        elif symbol in "\\{}":
+            out.append(symbol)
+    if skip_depth is None:
+        out.append(source[position:])
+    return "".join(out)
+
+
+EXTRACTORS = {
+    "text": _text_content,
+    "pdf": _pdf_content,
+    "docx": _docx_content,
+    "rtf": _rtf_content,
+}
+
+
+def parse_query(query: str) -> list[list[str]]:
+    # Quoted parts are phrases; every other word must appear somewhere.
+    parts = []
+    for phrase, word in QUERY_PART.findall(query):
+        words = _words(phrase or word)
+        if words:
+            parts.append(words)
+    if not parts:
+        raise ValueError("Query has no searchable words")
+    return parts
+
+
+def _snippet(text: str, parts: list[list[str]]) -> tuple[str, list[list[int]]]:
+    pattern = re.compile(
+        "|".join(
+            r"\W+".join(re.escape(word) for word in words)
+            for words in sorted(parts, key=len, reverse=True)
+        ),
+        re.IGNORECASE,
+    )
+    first = pattern.search(text)
+    center = first.start() if first else 0
+    start = max(0, center - SNIPPET_CHARS)
+    end = min(len(text), center + SNIPPET_CHARS * 2)
+    window = WHITESPACE.sub(" ", text[start:end]).strip()
+    prefix = "…" if start > 0 else ""
+    snippet = prefix + window + ("…" if end < len(text) else "")
+    highlights = [
+        [match.start(), match.end()] for match in pattern.finditer(snippet)
+    ]
+    return snippet, highlights
+
+
+# A per-user SQLite FTS5 index of the text in documents. It is updated
+# through the same file events and rescans as the media index, so a search
+# only reads the posting lists of its own terms however many files a user
+# has. Words are indexed whole: there is no prefix or substring matching.
+class ContentIndex(FileIndexer):
+    name = "content"
+
+    def accepts(self, path: Path) -> bool:
+        return content_kind(path) is not None
+
+    def setup(self) -> None:
+        CONTENT_INDEX_PATH.mkdir(parents=True, exist_ok=True)
+
+    def _connect(self, user_id: str) -> sqlite3.Connection:
+        conns = getattr(_local, "conns", None)
+        if conns is None or _local.pid != os.getpid():
+            conns = _local.conns = {}
+            _local.pid = os.getpid()
+        conn = conns.get(user_id)
+        if conn is not None:
+            return conn
+
+        CONTENT_INDEX_PATH.mkdir(parents=True, exist_ok=True)
+        conn = sqlite3.connect(
+            CONTENT_INDEX_PATH / f"{user_id}.db",
+            timeout=BUSY_TIMEOUT_SECONDS,
+            isolation_level=None,
+            check_same_thread=False,
+        )
+        conn.row_factory = sqlite3.Row
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.executescript(SCHEMA)
+        conns[user_id] = conn
+        return conn
+
+    @contextmanager
+    def _transaction(self, user_id: str) -> Iterator[sqlite3.Connection]:
+        conn = self._connect(user_id)
+        conn.execute("BEGIN IMMEDIATE")
+        try:
+            yield conn
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    def extract(self, full_path: Path) -> str:
+        kind = content_kind(full_path)
+        # Plain text is indexed up to the limit; parsing the other formats
+        # needs the whole file.
+        if kind != "text" and _plaintext_size(full_path) > CONTENT_MAX_FILE_BYTES:
+            raise ValueError("File is too large to index")
+        return EXTRACTORS[kind](full_path)[:CONTENT_MAX_TEXT_CHARS]
+
+    def store(
+        self,
+        user_id: str,
+        path: str,
+        st: os.stat_result,
+        result: Optional[str],
+        error: Optional[str],
+    ) -> None:
+        term_key, body_key = _user_keys(user_id)
+        text = result or ""
+        terms = " ".join(_term(term_key, word) for word in _words(text))
+        with self._transaction(user_id) as conn:
+            conn.execute(
+                UPSERT,
+                (
+                    path,
+                    st.st_size,
+                    st.st_mtime_ns,
+                    terms,
+                    _seal(body_key, text) if text else None,
+                    error,
+                    time.time(),
+                ),
+            )
+
+    def known(self, user_id: str, path: str) -> dict[str, tuple[int, int]]:
+        return {
+            row["path"]: (row["file_size"], row["mtime_ns"])
+            for row in self._connect(user_id).execute(
+                f"SELECT path, file_size, mtime_ns FROM documents WHERE {IN_SUBTREE}",
+                (path, *subtree(path)),
+            )
+        }
+
+    def drop(self, user_id: str, paths: list[str]) -> None:
+        with self._transaction(user_id) as conn:
+            conn.executemany(
+                "DELETE FROM documents WHERE path = ?", [(gone,) for gone in paths]
+            )
+
+    def forget(self, user_id: str, path: str) -> None:
+        with self._transaction(user_id) as conn:
+            conn.execute(
+                f"DELETE FROM documents WHERE {IN_SUBTREE}", (path, *subtree(path))
+            )
+
+    def relocate(self, user_id: str, path: str, new_path: str, copy: bool) -> None:
+        params = (path, *subtree(path))
+        with self._transaction(user_id) as conn:
+            conn.execute(
+                f"DELETE FROM documents WHERE {IN_SUBTREE}",
+                (new_path, *subtree(new_path)),
+            )
+            if not copy:
+                conn.execute(
+                    "UPDATE documents SET path = ? || substr(path, ?)"
+                    f" WHERE {IN_SUBTREE}",
+                    (new_path, len(path) + 1, *params),
+                )
+                return
+            rows = conn.execute(
+                "SELECT path, file_size, mtime_ns, terms, body, error, indexed_at"
+                f" FROM documents WHERE {IN_SUBTREE}",
+                params,
+            ).fetchall()
+            conn.executemany(
+                UPSERT,
+                [(new_path + row["path"][len(path) :], *tuple(row)[1:]) for row in rows],
+            )
+
+    async def search(
+        self, user_id: str, path: str, query: str, limit: int, offset: int
+    ) -> dict:
+        parts = parse_query(query)
+        items = await asyncio.to_thread(
+            self._search, user_id, path, parts, limit + 1, offset
+        )
+        return {
+            "items": items[:limit],
+            "next_offset": offset + limit if len(items) > limit else None,
+            "pending": self.pending(user_id),
+        }
+
+    def _search(
+        self,
+        user_id: str,
+        path: str,
+        parts: list[list[str]],
+        limit: int,
+        offset: int,
+    ) -> list[dict]:
+        term_key, body_key = _user_keys(user_id)
+        match = " AND ".join(
+            '"' + " ".join(_term(term_key, word) for word in words) + '"'
+            for words in parts
+        )
+        rows = (
+            self._connect(user_id)
+            .execute(
+                "SELECT d.path, d.body, documents_fts.rank AS score"
+                " FROM documents_fts JOIN documents d ON d.id = documents_fts.rowid"
+                " WHERE documents_fts MATCH ? AND d.path >= ? AND d.path < ?"
+                " ORDER BY documents_fts.rank LIMIT ? OFFSET ?",
+                (match, *subtree(path), limit, offset),
+            )
+            .fetchall()
+        )
+        items = []
+        for row in rows:
+            snippet, highlights = _snippet(
+                _unseal(body_key, row["body"]) if row["body"] else "", parts
+            )
+            items.append(
+                {
+                    "id": row["path"],
+                    "name": Path(row["path"]).name,
+                    "extension": Path(row["path"]).suffix,
+                    # bm25 scores are negative; larger is a better match here.
+                    "score": -row["score"],
+                    "snippet": snippet,
+                    "highlights": highlights,
+                }
+            )
+        return items
+
+
+content_index = ContentIndex(
+    CONTENT_INDEX_WORKERS, CONTENT_INDEX_QUEUE_SIZE, CONTENT_INDEX_RESCAN_INTERVAL
+)
+file_events.subscribe(content_index.handle)
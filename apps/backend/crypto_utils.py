@@ -1,23 +1,80 @@
 from __future__ import annotations
 from base64 import b64decode
+from collections import OrderedDict
 from dataclasses import dataclass
 from pathlib import Path
-from typing import Iterator, Optional
+from typing import Iterable, Iterator, Optional
 
 import os
 import io
 
 from cryptography.hazmat.primitives import hashes
 from cryptography.hazmat.primitives.ciphers import Cipher, algorithms, modes
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
 from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+import zstandard as zstd
+
+from config import (
+    STORAGE_BACKEND,
+    COMPRESSION,
+    COMPRESSION_LEVEL,
+    COMPRESSION_MIN_RATIO,
+    COMPRESSION_SAMPLE_SIZE,
+    SEGMENT_SIZE,
+    ENCRYPT_CHUNK_SIZE,
+    DECRYPT_CHUNK_SIZE,
+    STREAM_CHUNK_SIZE,
+)
+from metrics import CRYPTO_BYTES
+from profiling import stage
 
 MAGIC = b"PDRV1"
+MANIFEST_MAGIC = b"PDRVM"
+SEGMENTED_MAGIC = b"PDRV2"
 SALT_LEN = 16
 IV_LEN = 12
 SIZE_LEN = 8
 TAG_LEN = 16
 HEADER_LEN = len(MAGIC) + SALT_LEN + IV_LEN + SIZE_LEN
 
+SEGMENT_SIZE_LEN = 4
+OFFSET_LEN = 8
+SEGMENTED_HEADER_LEN = (
+    len(SEGMENTED_MAGIC) + SALT_LEN + SEGMENT_SIZE_LEN + SIZE_LEN + OFFSET_LEN
+)
+SEGMENT_FLAGS_LEN = 1
+SEGMENT_LENGTH_LEN = 4
+SEGMENT_RECORD_HEADER_LEN = IV_LEN + SEGMENT_FLAGS_LEN + SEGMENT_LENGTH_LEN
+INDEX_ENTRY_LEN = OFFSET_LEN + SEGMENT_LENGTH_LEN
+
+FLAG_COMPRESSED = 0x01
+FLAG_FINAL = 0x02
+
+SEGMENTED_KEY_INFO = b"pidrive-self:file:v2"
+
+AES_BLOCK_LEN = 16
+GCM_FIRST_COUNTER = 2
+
+_ENCRYPTED_SEGMENTED = CRYPTO_BYTES.labels("encrypt", "segmented")
+_DECRYPTED_SEGMENTED = CRYPTO_BYTES.labels("decrypt", "segmented")
+_DECRYPTED_LEGACY = CRYPTO_BYTES.labels("decrypt", "legacy")
+
+
+@dataclass
+class ChunkSizes:
+    encrypt: int
+    decrypt: int
+    stream: int
+    segment: int
+
+
+chunk_sizes = ChunkSizes(
+    encrypt=ENCRYPT_CHUNK_SIZE,
+    decrypt=DECRYPT_CHUNK_SIZE,
+    stream=STREAM_CHUNK_SIZE,
+    segment=SEGMENT_SIZE,
+)
+
 
 class CryptoConfigError(Exception):
     pass
@@ -40,12 +97,14 @@ def _load_master_key() -> bytes:
     return key
 
 
-def _derive_key(master: bytes, salt: bytes) -> bytes:
+def _derive_key(
+    master: bytes, salt: bytes, info: bytes = b"pidrive-self:file:v1"
+) -> bytes:
     hkdf = HKDF(
         algorithm=hashes.SHA256(),
         length=32,
         salt=salt,
-        info=b"pidrive-self:file:v1",
+        info=info,
     )
     return hkdf.derive(master)
 
@@ -58,13 +117,24 @@ class EncHeader:
     file_size: int
 
 
-def is_encrypted_file(path: Path) -> bool:
+def read_magic(path: Path) -> bytes:
     try:
         with path.open("rb") as f:
-            magic = f.read(len(MAGIC))
-            return magic == MAGIC
+            return f.read(len(MAGIC))
     except Exception:
-        return False
+        return b""
+
+
+def is_encrypted_file(path: Path) -> bool:
+    return read_magic(path) in (MAGIC, MANIFEST_MAGIC, SEGMENTED_MAGIC)
+
+
+def is_segmented_file(path: Path) -> bool:
+    return read_magic(path) == SEGMENTED_MAGIC
+
+
+def is_manifest_file(path: Path) -> bool:
+    return read_magic(path) == MANIFEST_MAGIC
 
 
 def read_header(path: Path) -> EncHeader:
@@ -81,46 +151,346 @@ def read_header(path: Path) -> EncHeader:
 
 
 async def encrypt_upload_to_file(
-    upload_file, out_path: Path, chunk_size: int = 4 * 1024 * 1024
+    upload_file,
+    out_path: Path,
+    chunk_size: Optional[int] = None,
+    reserved: bool = False,
 ) -> int:
-    from os import urandom
+    chunk_size = chunk_size or chunk_sizes.encrypt
+    if STORAGE_BACKEND == "dedup":
+        return await _store_upload_as_manifest(
+            upload_file, out_path, chunk_size, reserved
+        )
 
-    master = _load_master_key()
-    salt = urandom(SALT_LEN)
-    iv = urandom(IV_LEN)
-    key = _derive_key(master, salt)
+    first_chunk = await upload_file.read(chunk_size)
+    compress = COMPRESSION == "auto" and is_compressible(first_chunk)
+    return await _store_upload_segmented(
+        upload_file, out_path, chunk_size, reserved, first_chunk, compress
+    )
+
+
+async def _store_upload_as_manifest(
+    upload_file, out_path: Path, chunk_size: int, reserved: bool
+) -> int:
+    import asyncio
+    from blob_store import ManifestWriter
 
-    with out_path.open("xb") as out:
-        out.write(MAGIC)
-        out.write(salt)
-        out.write(iv)
-        out.write((0).to_bytes(SIZE_LEN, "big"))
+    writer = ManifestWriter(out_path, reserved=reserved)
+    while True:
+        chunk = await upload_file.read(chunk_size)
+        if not chunk:
+            break
+        await asyncio.to_thread(writer.write, chunk)
+    return await asyncio.to_thread(writer.close)
+
+
+# Synchronous counterpart of encrypt_upload_to_file for data produced on a
+# worker thread.
+def encrypt_chunks_to_file(
+    chunks: Iterable[bytes], out_path: Path, reserved: bool = False
+) -> int:
+    chunks = iter(chunks)
+    if STORAGE_BACKEND == "dedup":
+        from blob_store import ManifestWriter
+
+        writer = ManifestWriter(out_path, reserved=reserved)
+        for chunk in chunks:
+            writer.write(chunk)
+        return writer.close()
+
+    first_chunk = next(chunks, b"")
+    compress = COMPRESSION == "auto" and is_compressible(first_chunk)
+    with SegmentedWriter(out_path, reserved=reserved, compress=compress) as writer:
+        writer.write(first_chunk)
+        for chunk in chunks:
+            writer.write(chunk)
+    return writer.plain_size
+
+
+def is_compressible(sample: bytes) -> bool:
+    sample = sample[:COMPRESSION_SAMPLE_SIZE]
+    if len(sample) < 512:
+        return False
+    compressed = zstd.ZstdCompressor(level=1).compress(sample)
+    return len(compressed) <= len(sample) * COMPRESSION_MIN_RATIO
 
-        cipher = Cipher(algorithms.AES(key), modes.GCM(iv))
-        encryptor = cipher.encryptor()
 
-        plain_size = 0
-        while True:
+async def _store_upload_segmented(
+    upload_file,
+    out_path: Path,
+    chunk_size: int,
+    reserved: bool,
+    first_chunk: bytes,
+    compress: bool,
+) -> int:
+    import asyncio
+
+    writer = SegmentedWriter(out_path, reserved=reserved, compress=compress)
+    chunk = first_chunk
+    try:
+        while chunk:
+            await asyncio.to_thread(writer.write, chunk)
             chunk = await upload_file.read(chunk_size)
-            if not chunk:
+    finally:
+        await asyncio.to_thread(writer.close)
+    return writer.plain_size
+
+
+@dataclass
+class SegmentedHeader:
+    salt: bytes
+    segment_size: int
+    plain_size: int
+    index_offset: int
+    file_size: int
+
+
+def _segment_aad(salt: bytes, index: int, flags: int) -> bytes:
+    return salt + index.to_bytes(OFFSET_LEN, "big") + bytes([flags])
+
+
+class SegmentedWriter:
+    def __init__(
+        self,
+        out_path: Path,
+        reserved: bool = False,
+        compress: bool = False,
+        segment_size: Optional[int] = None,
+        salt: Optional[bytes] = None,
+    ):
+        segment_size = segment_size or chunk_sizes.segment
+        master = _load_master_key()
+        self._salt = salt or os.urandom(SALT_LEN)
+        self._aead = AESGCM(_derive_key(master, self._salt, SEGMENTED_KEY_INFO))
+        self._compressor = (
+            zstd.ZstdCompressor(level=COMPRESSION_LEVEL) if compress else None
+        )
+        self._segment_size = segment_size
+        self._buffer = bytearray()
+        self._index: list[tuple[int, int]] = []
+        self.plain_size = 0
+
+        self._out = out_path.open("wb" if reserved else "xb")
+        self._out.write(SEGMENTED_MAGIC)
+        self._out.write(self._salt)
+        self._out.write(segment_size.to_bytes(SEGMENT_SIZE_LEN, "big"))
+        self._out.write((0).to_bytes(SIZE_LEN, "big"))
+        self._out.write((0).to_bytes(OFFSET_LEN, "big"))
+        self._offset = SEGMENTED_HEADER_LEN
+        self.closed = False
+
+    def write(self, data: bytes) -> int:
+        self._buffer += data
+        self.plain_size += len(data)
+        while len(self._buffer) > self._segment_size:
+            self._seal(bytes(self._buffer[: self._segment_size]), final=False)
+            del self._buffer[: self._segment_size]
+        return len(data)
+
+    # Index the next segment will get, if everything written so far fills
+    # whole segments.
+    def next_segment(self) -> Optional[int]:
+        if not self._buffer:
+            return len(self._index)
+        if len(self._buffer) == self._segment_size:
+            return len(self._index) + 1
+        return None
+
+    # Appends a full segment sealed by another writer with the same salt and
+    # segment size, at the same position, without decrypting it.
+    def copy_sealed(self, record: bytes, plain_len: int) -> None:
+        if self.next_segment() is None or plain_len != self._segment_size:
+            raise ValueError("Sealed segments can only be copied at a boundary")
+        if self._buffer:
+            self._seal(bytes(self._buffer), final=False)
+            self._buffer.clear()
+        self._out.write(record)
+        self.plain_size += plain_len
+        self._index.append((self._offset, plain_len))
+        self._offset += len(record)
+
+    def _seal(self, plaintext: bytes, final: bool) -> None:
+        flags = FLAG_FINAL if final else 0
+        payload = plaintext
+        with stage("crypto"):
+            if self._compressor is not None and plaintext:
+                compressed = self._compressor.compress(plaintext)
+                if len(compressed) < len(plaintext):
+                    payload = compressed
+                    flags |= FLAG_COMPRESSED
+
+            nonce = os.urandom(IV_LEN)
+            aad = _segment_aad(self._salt, len(self._index), flags)
+            sealed = self._aead.encrypt(nonce, payload, aad)
+
+        self._out.write(nonce)
+        self._out.write(bytes([flags]))
+        self._out.write(len(sealed).to_bytes(SEGMENT_LENGTH_LEN, "big"))
+        self._out.write(sealed)
+        _ENCRYPTED_SEGMENTED.inc(len(plaintext))
+        self._index.append((self._offset, len(plaintext)))
+        self._offset += SEGMENT_RECORD_HEADER_LEN + len(sealed)
+
+    def close(self) -> None:
+        if self.closed:
+            return
+        self.closed = True
+        try:
+            self._seal(bytes(self._buffer), final=True)
+            self._buffer.clear()
+            index_offset = self._offset
+            self._out.write(len(self._index).to_bytes(SEGMENT_LENGTH_LEN, "big"))
+            for offset, length in self._index:
+                self._out.write(offset.to_bytes(OFFSET_LEN, "big"))
+                self._out.write(length.to_bytes(SEGMENT_LENGTH_LEN, "big"))
+            self._out.seek(len(SEGMENTED_MAGIC) + SALT_LEN + SEGMENT_SIZE_LEN)
+            self._out.write(self.plain_size.to_bytes(SIZE_LEN, "big"))
+            self._out.write(index_offset.to_bytes(OFFSET_LEN, "big"))
+        finally:
+            self._out.close()
+
+    def __enter__(self) -> "SegmentedWriter":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+
+def read_segmented_header(path: Path) -> SegmentedHeader:
+    with path.open("rb") as f:
+        header = f.read(SEGMENTED_HEADER_LEN)
+    if (
+        len(header) != SEGMENTED_HEADER_LEN
+        or header[: len(SEGMENTED_MAGIC)] != SEGMENTED_MAGIC
+    ):
+        raise ValueError("Not a segmented PiDrive file")
+    pos = len(SEGMENTED_MAGIC)
+    salt = header[pos : pos + SALT_LEN]
+    pos += SALT_LEN
+    segment_size = int.from_bytes(header[pos : pos + SEGMENT_SIZE_LEN], "big")
+    pos += SEGMENT_SIZE_LEN
+    plain_size = int.from_bytes(header[pos : pos + SIZE_LEN], "big")
+    pos += SIZE_LEN
+    index_offset = int.from_bytes(header[pos : pos + OFFSET_LEN], "big")
+    return SegmentedHeader(
+        salt=salt,
+        segment_size=segment_size,
+        plain_size=plain_size,
+        index_offset=index_offset,
+        file_size=path.stat().st_size,
+    )
+
+
+def read_segment_index(f, hdr: SegmentedHeader) -> list[tuple[int, int]]:
+    f.seek(hdr.index_offset)
+    count = int.from_bytes(f.read(SEGMENT_LENGTH_LEN), "big")
+    body = f.read(count * INDEX_ENTRY_LEN)
+    if count == 0 or len(body) != count * INDEX_ENTRY_LEN:
+        raise ValueError("Invalid segment index")
+    index = []
+    for pos in range(0, len(body), INDEX_ENTRY_LEN):
+        offset = int.from_bytes(body[pos : pos + OFFSET_LEN], "big")
+        length = int.from_bytes(body[pos + OFFSET_LEN : pos + INDEX_ENTRY_LEN], "big")
+        index.append((offset, length))
+    return index
+
+
+# The raw record of one segment, as stored, and its flags.
+def read_sealed_segment(
+    f, index: list[tuple[int, int]], number: int
+) -> tuple[bytes, int]:
+    offset, _ = index[number]
+    f.seek(offset)
+    record_header = f.read(SEGMENT_RECORD_HEADER_LEN)
+    sealed_len = int.from_bytes(record_header[IV_LEN + SEGMENT_FLAGS_LEN :], "big")
+    return record_header + f.read(sealed_len), record_header[IV_LEN]
+
+
+def _read_segment(
+    f, aead: AESGCM, hdr: SegmentedHeader, index: list[tuple[int, int]], number: int
+) -> bytes:
+    offset, plain_len = index[number]
+    f.seek(offset)
+    record_header = f.read(SEGMENT_RECORD_HEADER_LEN)
+    nonce = record_header[:IV_LEN]
+    flags = record_header[IV_LEN]
+    sealed_len = int.from_bytes(record_header[IV_LEN + SEGMENT_FLAGS_LEN :], "big")
+    sealed = f.read(sealed_len)
+
+    is_last = number == len(index) - 1
+    if bool(flags & FLAG_FINAL) != is_last:
+        raise ValueError("Invalid encrypted file (segment order)")
+
+    with stage("crypto"):
+        payload = aead.decrypt(nonce, sealed, _segment_aad(hdr.salt, number, flags))
+        if flags & FLAG_COMPRESSED:
+            payload = zstd.ZstdDecompressor().decompress(
+                payload, max_output_size=plain_len
+            )
+    if len(payload) != plain_len:
+        raise ValueError("Invalid encrypted file (segment length)")
+    _DECRYPTED_SEGMENTED.inc(plain_len)
+    return payload
+
+
+def iter_segmented_range(
+    path: Path, start: int = 0, end: Optional[int] = None
+) -> Iterator[bytes]:
+    hdr = read_segmented_header(path)
+    aead = AESGCM(_derive_key(_load_master_key(), hdr.salt, SEGMENTED_KEY_INFO))
+    if end is None:
+        end = hdr.plain_size - 1
+
+    with path.open("rb") as f:
+        index = read_segment_index(f, hdr)
+        produced = 0
+        for number, (_, plain_len) in enumerate(index):
+            next_produced = produced + plain_len
+            if next_produced > start or number == len(index) - 1:
+                data = _read_segment(f, aead, hdr, index, number)
+                s = max(0, start - produced)
+                e = min(plain_len, end - produced + 1)
+                if s < e:
+                    yield data[s:e]
+            produced = next_produced
+            if produced > end:
                 break
-            plain_size += len(chunk)
-            ct = encryptor.update(chunk)
-            if ct:
-                out.write(ct)
 
-        encryptor.finalize()
-        tag = encryptor.tag
-        out.write(tag)
 
-    with out_path.open("r+b") as out:
-        out.seek(len(MAGIC) + SALT_LEN + IV_LEN)
-        out.write(plain_size.to_bytes(SIZE_LEN, "big"))
+class EncryptedWriter(io.RawIOBase):
+    def __init__(self, out_path: Path, compress: bool = False):
+        self._writer = SegmentedWriter(out_path, compress=compress)
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, data) -> int:
+        return self._writer.write(bytes(data))
+
+    def tell(self) -> int:
+        return self._writer.plain_size
 
-    return plain_size
+    def close(self) -> None:
+        if self.closed:
+            return
+        try:
+            self._writer.close()
+        finally:
+            super().close()
 
 
-def decrypt_stream(path: Path, chunk_size: int = 1024 * 1024) -> Iterator[bytes]:
+def decrypt_stream(path: Path, chunk_size: Optional[int] = None) -> Iterator[bytes]:
+    magic = read_magic(path)
+    if magic == MANIFEST_MAGIC:
+        from blob_store import iter_manifest
+
+        yield from iter_manifest(path)
+        return
+    if magic == SEGMENTED_MAGIC:
+        yield from iter_segmented_range(path)
+        return
+
+    chunk_size = chunk_size or chunk_sizes.decrypt
     hdr = read_header(path)
     master = _load_master_key()
     key = _derive_key(master, hdr.salt)
@@ -145,38 +515,64 @@ def decrypt_stream(path: Path, chunk_size: int = 1024 * 1024) -> Iterator[bytes]
             if not data:
                 break
             remaining -= len(data)
-            pt = decryptor.update(data)
+            with stage("crypto"):
+                pt = decryptor.update(data)
             if pt:
+                _DECRYPTED_LEGACY.inc(len(pt))
                 yield pt
         decryptor.finalize()
 
 
 def decrypt_stream_range(
-    path: Path, start: int, end: int, chunk_size: int = 1024 * 1024
+    path: Path, start: int, end: int, chunk_size: Optional[int] = None
 ) -> Iterator[bytes]:
     if start < 0 or end < start:
         raise ValueError("Invalid range")
-    hdr = read_header(path)
-    if end >= hdr.plain_size:
+    if end >= get_plaintext_size(path):
         raise ValueError("Requested range not satisfiable")
 
-    produced = 0
-    emitted = 0
+    magic = read_magic(path)
+    if magic == MANIFEST_MAGIC:
+        from blob_store import iter_manifest_range
 
-    for pt in decrypt_stream(path, chunk_size=chunk_size):
-        pt_len = len(pt)
-        next_produced = produced + pt_len
-        if next_produced <= start:
-            produced = next_produced
-            continue
-        s = max(0, start - produced)
-        e = min(pt_len, (end - produced) + 1)
-        if s < e:
-            yield pt[s:e]
-            emitted += e - s
-        produced = next_produced
-        if produced > end and emitted >= (end - start + 1):
-            break
+        yield from iter_manifest_range(path, start, end)
+        return
+    if magic == SEGMENTED_MAGIC:
+        yield from iter_segmented_range(path, start, end)
+        return
+
+    hdr = read_header(path)
+    if start == 0 and end == hdr.plain_size - 1:
+        yield from decrypt_stream(path, chunk_size=chunk_size)
+        return
+    yield from _iter_legacy_range(
+        path, hdr, start, end, chunk_size or chunk_sizes.decrypt
+    )
+
+
+def _iter_legacy_range(
+    path: Path, hdr: EncHeader, start: int, end: int, chunk_size: int
+) -> Iterator[bytes]:
+    key = _derive_key(_load_master_key(), hdr.salt)
+    block = start // AES_BLOCK_LEN
+    counter = hdr.iv + (GCM_FIRST_COUNTER + block).to_bytes(4, "big")
+    decryptor = Cipher(algorithms.AES(key), modes.CTR(counter)).decryptor()
+
+    with path.open("rb") as f:
+        f.seek(HEADER_LEN + block * AES_BLOCK_LEN)
+        skip = start - block * AES_BLOCK_LEN
+        remaining = end - start + 1
+        while remaining > 0:
+            data = f.read(min(chunk_size, remaining + skip))
+            if not data:
+                break
+            with stage("crypto"):
+                pt = decryptor.update(data)[skip:]
+            skip = 0
+            pt = pt[:remaining]
+            remaining -= len(pt)
+            _DECRYPTED_LEGACY.inc(len(pt))
+            yield pt
 
 
 def decrypt_to_bytes(path: Path, max_bytes: Optional[int] = None) -> bytes:
@@ -188,28 +584,79 @@ def decrypt_to_bytes(path: Path, max_bytes: Optional[int] = None) -> bytes:
     return buf.getvalue()
 
 
-def ensure_encrypted_empty_file(path: Path) -> None:
-    if path.exists():
+# Seekable read-only view of a file's plaintext. Reads are served from a
+# few cached, block-aligned ranges so the small scattered reads of parsers
+# do not decrypt the same segment over and over.
+class DecryptedReader(io.RawIOBase):
+    def __init__(
+        self, path: Path, block_size: Optional[int] = None, cached_blocks: int = 4
+    ):
+        self.path = path
+        self.size = get_plaintext_size(path)
+        self.block_size = block_size or chunk_sizes.segment
+        self.cached_blocks = cached_blocks
+        self._blocks: OrderedDict[int, bytes] = OrderedDict()
+        self._pos = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self._pos
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError("Negative seek position")
+        self._pos = offset
+        return offset
+
+    def _block(self, number: int) -> bytes:
+        block = self._blocks.get(number)
+        if block is not None:
+            self._blocks.move_to_end(number)
+            return block
+        start = number * self.block_size
+        end = min(start + self.block_size, self.size) - 1
+        block = b"".join(decrypt_stream_range(self.path, start, end))
+        self._blocks[number] = block
+        if len(self._blocks) > self.cached_blocks:
+            self._blocks.popitem(last=False)
+        return block
+
+    def readinto(self, buffer) -> int:
+        view = memoryview(buffer).cast("B")
+        filled = 0
+        while filled < len(view) and self._pos < self.size:
+            number, offset = divmod(self._pos, self.block_size)
+            data = self._block(number)[offset : offset + len(view) - filled]
+            view[filled : filled + len(data)] = data
+            filled += len(data)
+            self._pos += len(data)
+        return filled
+
+
+def ensure_encrypted_empty_file(path: Path, reserved: bool = False) -> None:
+    if path.exists() and not reserved:
         return
-    from os import urandom
-
-    master = _load_master_key()
-    salt = urandom(SALT_LEN)
-    iv = urandom(IV_LEN)
-    key = _derive_key(master, salt)
-    cipher = Cipher(algorithms.AES(key), modes.GCM(iv))
-    encryptor = cipher.encryptor()
-    encryptor.finalize()
-    tag = encryptor.tag
-    with path.open("xb") as out:
-        out.write(MAGIC)
-        out.write(salt)
-        out.write(iv)
-        out.write((0).to_bytes(SIZE_LEN, "big"))
-        out.write(tag)
+    SegmentedWriter(path, reserved=reserved).close()
 
 
 def get_plaintext_size(path: Path) -> int:
-    if is_encrypted_file(path):
-        return read_header(path).plain_size
-    return path.stat().st_size
+    with stage("crypto"):
+        magic = read_magic(path)
+        if magic == MAGIC:
+            return read_header(path).plain_size
+        if magic == MANIFEST_MAGIC:
+            from blob_store import read_manifest_size
+
+            return read_manifest_size(path)
+        if magic == SEGMENTED_MAGIC:
+            return read_segmented_header(path).plain_size
+        return path.stat().st_size
@@ -0,0 +1,381 @@
+import asyncio
+import hashlib
+import logging
+import os
+import struct
+import uuid
+import zlib
+from pathlib import Path
+from typing import AsyncIterator, Optional
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from blob_store import ManifestWriter
+from config import (
+    COMPRESSION,
+    STORAGE_BACKEND,
+    DELTA_MAX_LITERAL_BYTES,
+)
+from crypto_utils import (
+    _derive_key,
+    _load_master_key,
+    _read_segment,
+    SEGMENTED_KEY_INFO,
+    FLAG_FINAL,
+    SegmentedWriter,
+    chunk_sizes,
+    decrypt_stream_range,
+    get_plaintext_size,
+    is_compressible,
+    is_encrypted_file,
+    is_segmented_file,
+    read_sealed_segment,
+    read_segment_index,
+    read_segmented_header,
+)
+from state_db import connect, transaction
+
+logger = logging.getLogger(__name__)
+
+DELTA_TMP = ".delta"
+
+OP_COPY = b"C"
+OP_LITERAL = b"L"
+COPY_ARGS = struct.Struct(">II")
+LITERAL_ARGS = struct.Struct(">I")
+
+STRONG_LEN = 16
+BLOCK_ENTRY = struct.Struct(f">I{STRONG_LEN}s")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS delta_signatures (
+    user_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    etag TEXT NOT NULL,
+    block_size INTEGER NOT NULL,
+    blocks BLOB NOT NULL,
+    PRIMARY KEY (user_id, path)
+);
+"""
+
+
+class StaleBase(Exception):
+    pass
+
+
+def etag(st: os.stat_result) -> str:
+    return f"{st.st_size}-{st.st_mtime_ns}"
+
+
+def block_entry(data: bytes) -> bytes:
+    # Adler-32 rolls in O(1) per byte on the client; BLAKE2b confirms a hit.
+    strong = hashlib.blake2b(data, digest_size=STRONG_LEN).digest()
+    return BLOCK_ENTRY.pack(zlib.adler32(data), strong)
+
+
+def block_size_of(path: Path) -> int:
+    # Blocks line up with segments, so unchanged ones can be kept sealed.
+    if is_segmented_file(path):
+        return read_segmented_header(path).segment_size
+    return chunk_sizes.segment
+
+
+def _read_range(path: Path, start: int, end: int) -> bytes:
+    if is_encrypted_file(path):
+        return b"".join(decrypt_stream_range(path, start, end))
+    with path.open("rb") as f:
+        f.seek(start)
+        return f.read(end - start + 1)
+
+
+def _plaintext_size(path: Path) -> int:
+    return get_plaintext_size(path) if is_encrypted_file(path) else path.stat().st_size
+
+
+class Blocks:
+    def __init__(self, block_size: int):
+        self.block_size = block_size
+        self.entries = bytearray()
+        self._pending = bytearray()
+
+    def feed(self, data: bytes) -> None:
+        self._pending += data
+        while len(self._pending) >= self.block_size:
+            self.entries += block_entry(bytes(self._pending[: self.block_size]))
+            del self._pending[: self.block_size]
+
+    def reuse(self, entry: bytes) -> bool:
+        if self._pending:
+            return False
+        self.entries += entry
+        return True
+
+    def finish(self) -> bytes:
+        if self._pending:
+            self.entries += block_entry(bytes(self._pending))
+            self._pending.clear()
+        return bytes(self.entries)
+
+
+def compute_blocks(path: Path, block_size: int) -> bytes:
+    blocks = Blocks(block_size)
+    size = _plaintext_size(path)
+    for start in range(0, size, block_size):
+        blocks.feed(_read_range(path, start, min(start + block_size, size) - 1))
+    return blocks.finish()
+
+
+def _store_signature(
+    user_id: str, path: str, tag: str, block_size: int, blocks: bytes
+) -> None:
+    with transaction() as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO delta_signatures"
+            " (user_id, path, etag, block_size, blocks) VALUES (?, ?, ?, ?, ?)",
+            (user_id, path, tag, block_size, blocks),
+        )
+
+
+# Block checksums of a file's plaintext, cached per path until the file's
+# size or mtime changes. Files rebuilt from a delta get theirs for free.
+def signature(user_id: str, parent_path: Path, path: str) -> tuple[str, int, bytes]:
+    full_path = parent_path / path
+    tag = etag(full_path.stat())
+    row = (
+        connect()
+        .execute(
+            "SELECT etag, block_size, blocks FROM delta_signatures"
+            " WHERE user_id = ? AND path = ?",
+            (user_id, path),
+        )
+        .fetchone()
+    )
+    if row is not None and row["etag"] == tag:
+        return tag, row["block_size"], row["blocks"]
+
+    block_size = block_size_of(full_path)
+    blocks = compute_blocks(full_path, block_size)
+    if etag(full_path.stat()) != tag:
+        raise StaleBase("File changed while its signature was computed")
+    _store_signature(user_id, path, tag, block_size, blocks)
+    return tag, block_size, blocks
+
+
+def public_signature(tag: str, block_size: int, blocks: bytes, size: int) -> dict:
+    weak, strong = [], []
+    for checksum, digest in BLOCK_ENTRY.iter_unpack(blocks):
+        weak.append(checksum)
+        strong.append(digest.hex())
+    return {
+        "etag": tag,
+        "size": size,
+        "block_size": block_size,
+        "weak": weak,
+        "strong": strong,
+    }
+
+
+# Rebuilds a file from blocks of its previous version and literal data.
+# In the segmented format a block copied to the position it came from is
+# copied still sealed; only segments that changed or moved are decrypted
+# and encrypted again. The dedup backend gets the same effect from its
+# content-addressed chunks.
+class DeltaBuilder:
+    def __init__(self, base: Path, out: Path, block_size: int, blocks: bytes):
+        self.base = base
+        self.block_size = block_size
+        self.base_blocks = blocks
+        self.block_count = len(blocks) // BLOCK_ENTRY.size
+        self.base_size = _plaintext_size(base)
+        self.new_blocks = Blocks(block_size)
+        self.copied_bytes = 0
+        self.literal_bytes = 0
+        self.reused_segments = 0
+
+        self._f = None
+        self._index: list[tuple[int, int]] = []
+        if STORAGE_BACKEND == "dedup":
+            self._writer = ManifestWriter(out)
+            return
+        if is_segmented_file(base):
+            self._hdr = read_segmented_header(base)
+            self._f = base.open("rb")
+            self._index = read_segment_index(self._f, self._hdr)
+            self._aead = AESGCM(
+                _derive_key(_load_master_key(), self._hdr.salt, SEGMENTED_KEY_INFO)
+            )
+        sample = self._block(0) if self.block_count else b""
+        self._writer = SegmentedWriter(
+            out,
+            compress=COMPRESSION == "auto" and is_compressible(sample),
+            segment_size=block_size,
+            salt=self._hdr.salt if self._f else None,
+        )
+
+    def _block(self, number: int) -> bytes:
+        if self._f is not None:
+            return _read_segment(self._f, self._aead, self._hdr, self._index, number)
+        start = number * self.block_size
+        return _read_range(
+            self.base, start, min(start + self.block_size, self.base_size) - 1
+        )
+
+    def _entry(self, number: int) -> bytes:
+        return self.base_blocks[
+            number * BLOCK_ENTRY.size : (number + 1) * BLOCK_ENTRY.size
+        ]
+
+    def copy(self, first: int, count: int) -> None:
+        if first + count > self.block_count:
+            raise ValueError(f"Block {first + count - 1} is past the end of the file")
+        for number in range(first, first + count):
+            if self._copy_sealed(number):
+                continue
+            data = self._block(number)
+            self._writer.write(data)
+            self.new_blocks.feed(data)
+            self.copied_bytes += len(data)
+
+    def _copy_sealed(self, number: int) -> bool:
+        if (
+            self._f is None
+            or self._writer.next_segment() != number
+            or self._index[number][1] != self.block_size
+            or number == len(self._index) - 1
+            or not self.new_blocks.reuse(self._entry(number))
+        ):
+            return False
+        record, flags = read_sealed_segment(self._f, self._index, number)
+        if flags & FLAG_FINAL:
+            raise ValueError("Invalid encrypted file (segment order)")
+        self._writer.copy_sealed(record, self.block_size)
+        self.copied_bytes += self.block_size
+        self.reused_segments += 1
+        return True
+
+    def literal(self, data: bytes) -> None:
+        self._writer.write(data)
+        self.new_blocks.feed(data)
+        self.literal_bytes += len(data)
+
+    def close(self) -> int:
+        try:
+            result = self._writer.close()
+        finally:
+            if self._f is not None:
+                self._f.close()
+        return result if STORAGE_BACKEND == "dedup" else self._writer.plain_size
+
+    def abort(self) -> None:
+        try:
+            self._writer.close()
+        except Exception:
+            pass
+        if self._f is not None:
+            self._f.close()
+
+
+async def _read_ops(
+    stream: AsyncIterator[bytes],
+) -> AsyncIterator[tuple[bytes, object]]:
+    # Ops are a one-byte code followed by big-endian arguments:
+    #   C <first block:u32> <count:u32>
+    #   L <length:u32> <length bytes of data>
+    # Literal data is passed on as it arrives, in pieces.
+    buffer = bytearray()
+    literal_left = 0
+    async for chunk in stream:
+        buffer += chunk
+        while True:
+            if literal_left:
+                if not buffer:
+                    break
+                piece = bytes(buffer[:literal_left])
+                del buffer[: len(piece)]
+                literal_left -= len(piece)
+                yield OP_LITERAL, piece
+                continue
+            if not buffer:
+                break
+            op = bytes(buffer[:1])
+            if op == OP_COPY:
+                if len(buffer) < 1 + COPY_ARGS.size:
+                    break
+                args = COPY_ARGS.unpack_from(buffer, 1)
+                del buffer[: 1 + COPY_ARGS.size]
+                yield OP_COPY, args
+            elif op == OP_LITERAL:
+                if len(buffer) < 1 + LITERAL_ARGS.size:
+                    break
+                (literal_left,) = LITERAL_ARGS.unpack_from(buffer, 1)
+                if literal_left > DELTA_MAX_LITERAL_BYTES:
+                    raise ValueError("Literal is larger than the allowed maximum")
+                del buffer[: 1 + LITERAL_ARGS.size]
+            else:
+                raise ValueError(f"Unknown delta op {op!r}")
+    if buffer or literal_left:
+        raise ValueError("Delta ended in the middle of an op")
+
+
+async def apply_delta(
+    user_id: str,
+    parent_path: Path,
+    path: str,
+    base_etag: str,
+    stream: AsyncIterator[bytes],
+) -> dict:
+    full_path = parent_path / path
+    tag, block_size, blocks = await asyncio.to_thread(
+        signature, user_id, parent_path, path
+    )
+    if tag != base_etag:
+        raise StaleBase("File has changed since its signature was fetched")
+
+    tmp_dir = parent_path / DELTA_TMP
+    await asyncio.to_thread(tmp_dir.mkdir, exist_ok=True)
+    tmp_path = tmp_dir / uuid.uuid4().hex
+    builder: Optional[DeltaBuilder] = None
+    try:
+        builder = await asyncio.to_thread(
+            DeltaBuilder, full_path, tmp_path, block_size, blocks
+        )
+        async for op, args in _read_ops(stream):
+            if op == OP_COPY:
+                await asyncio.to_thread(builder.copy, *args)
+            else:
+                await asyncio.to_thread(builder.literal, args)
+        size = await asyncio.to_thread(builder.close)
+        new_blocks = builder.new_blocks.finish()
+        await asyncio.to_thread(
+            _replace, user_id, full_path, tmp_path, path, tag, block_size, new_blocks
+        )
+    except BaseException:
+        if builder is not None:
+            await asyncio.to_thread(builder.abort)
+        await asyncio.to_thread(tmp_path.unlink, missing_ok=True)
+        raise
+    return {
+        "size": size,
+        "copied_bytes": builder.copied_bytes,
+        "literal_bytes": builder.literal_bytes,
+        "reused_segments": builder.reused_segments,
+    }
+
+
+def _replace(
+    user_id: str,
+    full_path: Path,
+    tmp_path: Path,
+    path: str,
+    base_etag: str,
+    block_size: int,
+    blocks: bytes,
+) -> None:
+    if etag(full_path.stat()) != base_etag:
+        raise StaleBase("File changed while the delta was applied")
+    os.replace(tmp_path, full_path)
+    _store_signature(user_id, path, etag(full_path.stat()), block_size, blocks)
+
+
+def init_db() -> None:
+    connect().executescript(SCHEMA)
@@ -0,0 +1,56 @@
+import logging
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Optional
+
+logger = logging.getLogger(__name__)
+
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+MOVED = "moved"
+COPIED = "copied"
+
+
+# Paths are relative to the user's directory, e.g. "Home/photos/a.jpg".
+# `new_path` is set for moves and copies.
+@dataclass(frozen=True)
+class FileEvent:
+    action: str
+    user_id: str
+    path: str
+    new_path: Optional[str] = None
+
+
+Listener = Callable[[FileEvent], None]
+
+_listeners: list[Listener] = []
+
+
+# Listeners run inline in request handlers and job worker threads, so they
+# must be cheap and thread-safe; anything slow belongs on their own queue.
+def subscribe(listener: Listener) -> None:
+    _listeners.append(listener)
+
+
+def emit(action: str, user_id: str, path: str, new_path: Optional[str] = None) -> None:
+    event = FileEvent(
+        action,
+        user_id,
+        str(Path(path)),
+        str(Path(new_path)) if new_path is not None else None,
+    )
+    for listener in _listeners:
+        try:
+            listener(event)
+        except Exception:
+            logger.exception("File event listener failed for %s", event.action)
+
+
+def emit_batch(action: str, user_id: str, results: list[dict]) -> None:
+    for result in results:
+        if not result["success"]:
+            continue
+        if action in (MOVED, COPIED) and result["new_path"] is None:
+            continue
+        emit(action, user_id, result["item"], result["new_path"])
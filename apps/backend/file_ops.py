@@ -0,0 +1,254 @@
+import asyncio
+import errno
+import os
+import shutil
+from pathlib import Path, PurePosixPath
+from typing import Any, Callable, Optional
+
+from config import BATCH_CONCURRENCY
+from utils import unique_path
+
+ProgressHook = Optional[Callable[[int], None]]
+
+COPY_CHUNK_SIZE = 4 * 1024 * 1024
+
+
+def count_tree(path: Path) -> tuple[int, int]:
+    if not path.is_dir():
+        return 1, path.stat().st_size
+    files = 0
+    total_bytes = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            try:
+                total_bytes += os.path.getsize(os.path.join(root, name))
+                files += 1
+            except OSError:
+                continue
+    return files, total_bytes
+
+
+def check_destination(dest_path: Path) -> None:
+    if not dest_path.exists():
+        raise FileNotFoundError("Destination path not found")
+    if not dest_path.is_dir():
+        raise NotADirectoryError("Destination is not a directory")
+
+
+def replace_reserved(src_full_path: Path, reserved_path: Path) -> None:
+    try:
+        os.replace(src_full_path, reserved_path)
+    except OSError as e:
+        if reserved_path.is_dir():
+            reserved_path.rmdir()
+        else:
+            reserved_path.unlink(missing_ok=True)
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(str(src_full_path), str(reserved_path))
+
+
+def move_item(
+    src_full_path: Path, dest_path: Path, on_progress: ProgressHook = None
+) -> Optional[Path]:
+    if not src_full_path.exists():
+        raise FileNotFoundError(f"Source path not found: {src_full_path.name}")
+
+    src_resolved = src_full_path.resolve()
+    dest_resolved = dest_path.resolve()
+
+    if src_resolved.parent == dest_resolved:
+        return None
+
+    if src_resolved == dest_resolved or str(dest_resolved).startswith(
+        str(src_resolved) + os.sep
+    ):
+        raise ValueError(
+            f"Cannot move '{src_full_path.name}' into itself or its subdirectory"
+        )
+
+    new_location = unique_path(
+        dest_path / src_full_path.name, reserve=True, is_dir=src_full_path.is_dir()
+    )
+    replace_reserved(src_full_path, new_location)
+    if on_progress:
+        on_progress(1)
+    return new_location
+
+
+def copy_item(
+    src_full_path: Path,
+    dest_path: Path,
+    on_progress: ProgressHook = None,
+    on_target: Optional[Callable[[Path], None]] = None,
+) -> Path:
+    if not src_full_path.exists():
+        raise FileNotFoundError(f"Source path not found: {src_full_path.name}")
+
+    src_resolved = src_full_path.resolve()
+    dest_resolved = dest_path.resolve()
+
+    if str(dest_resolved).startswith(str(src_resolved) + os.sep):
+        raise ValueError(
+            f"Cannot copy '{src_full_path.name}' into itself or its subdirectory"
+        )
+
+    is_dir = src_full_path.is_dir()
+    new_location = unique_path(
+        dest_path / src_full_path.name, reserve=True, is_dir=is_dir
+    )
+    if on_target:
+        on_target(new_location)
+
+    def copy_function(src, dst):
+        return _copy_file(src, dst, on_progress)
+
+    if is_dir:
+        shutil.copytree(
+            str(src_full_path),
+            str(new_location),
+            copy_function=copy_function,
+            dirs_exist_ok=True,
+        )
+    else:
+        copy_function(str(src_full_path), str(new_location))
+    return new_location
+
+
+def _copy_file(src: str, dst: str, on_progress: ProgressHook = None) -> str:
+    if on_progress is None:
+        return shutil.copy2(src, dst)
+
+    with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+        while True:
+            chunk = fsrc.read(COPY_CHUNK_SIZE)
+            if not chunk:
+                break
+            fdst.write(chunk)
+            on_progress(len(chunk))
+    shutil.copystat(src, dst)
+    return dst
+
+
+def delete_item(full_path: Path, on_progress: ProgressHook = None) -> None:
+    if full_path.is_file() or full_path.is_symlink():
+        full_path.unlink()
+        if on_progress:
+            on_progress(1)
+        return
+    if not full_path.is_dir():
+        return
+    if on_progress is None:
+        shutil.rmtree(full_path)
+        return
+
+    for root, dirs, names in os.walk(full_path, topdown=False):
+        for name in names:
+            os.unlink(os.path.join(root, name))
+            on_progress(1)
+        for name in dirs:
+            dir_path = os.path.join(root, name)
+            if os.path.islink(dir_path):
+                os.unlink(dir_path)
+            else:
+                os.rmdir(dir_path)
+    os.rmdir(full_path)
+
+
+def restore_moved_item(src_full_path: Path, new_location: Optional[Path]) -> None:
+    if new_location is None:
+        return
+    if src_full_path.exists():
+        raise FileExistsError(f"Cannot restore '{src_full_path.name}'")
+    shutil.move(str(new_location), str(src_full_path))
+
+
+def error_status(error: Exception) -> int:
+    if isinstance(error, PermissionError):
+        return 403
+    if isinstance(error, FileNotFoundError):
+        return 404
+    if isinstance(error, (ValueError, NotADirectoryError, FileExistsError)):
+        return 400
+    return 500
+
+
+# Items that share a name, or of which one contains the other, depend on
+# each other's outcome; each such set runs in request order in one group,
+# while unrelated groups run concurrently.
+def _batch_groups(items: list[str]) -> list[list[int]]:
+    leader = list(range(len(items)))
+
+    def find(index: int) -> int:
+        while leader[index] != index:
+            leader[index] = leader[leader[index]]
+            index = leader[index]
+        return index
+
+    def join(first: int, second: int) -> None:
+        leader[find(first)] = find(second)
+
+    by_name: dict[str, int] = {}
+    by_path: dict[PurePosixPath, int] = {}
+    for index, item in enumerate(items):
+        path = PurePosixPath(os.path.normpath(item))
+        join(index, by_name.setdefault(path.name, index))
+        join(index, by_path.setdefault(path, index))
+    for path, index in by_path.items():
+        for ancestor in path.parents:
+            if ancestor in by_path:
+                join(index, by_path[ancestor])
+
+    groups: dict[int, list[int]] = {}
+    for index in range(len(items)):
+        groups.setdefault(find(index), []).append(index)
+    return list(groups.values())
+
+
+async def run_batch(
+    items: list[str],
+    operation: Callable[[str], Any],
+    rollback: Optional[Callable[[str, Any], None]] = None,
+    atomic: bool = False,
+    describe: Optional[Callable[[Any], Optional[str]]] = None,
+) -> list[dict]:
+    semaphore = asyncio.Semaphore(BATCH_CONCURRENCY)
+    results = [
+        {"item": item, "success": False, "new_path": None, "error": None}
+        for item in items
+    ]
+    outcomes: list[Any] = [None] * len(items)
+
+    groups = _batch_groups(items)
+
+    async def run_group(indexes: list[int]) -> None:
+        for index in indexes:
+            async with semaphore:
+                try:
+                    outcome = await asyncio.to_thread(operation, items[index])
+                except Exception as e:
+                    results[index]["error"] = str(e) or e.__class__.__name__
+                    results[index]["status"] = error_status(e)
+                    continue
+            outcomes[index] = outcome
+            results[index]["success"] = True
+            if describe:
+                results[index]["new_path"] = describe(outcome)
+
+    await asyncio.gather(*(run_group(indexes) for indexes in groups))
+
+    if atomic and rollback and not all(result["success"] for result in results):
+        for index in reversed(range(len(items))):
+            result = results[index]
+            if not result["success"]:
+                continue
+            try:
+                await asyncio.to_thread(rollback, items[index], outcomes[index])
+            except Exception as e:
+                result["error"] = f"Rollback failed: {e}"
+                continue
+            result["success"] = False
+            result["new_path"] = None
+            result["rolled_back"] = True
+
+    return results
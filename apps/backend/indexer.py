@@ -0,0 +1,234 @@
+import asyncio
+import logging
+import os
+from abc import ABC, abstractmethod
+from pathlib import Path
+from typing import Any, Iterator, Optional
+
+import file_events
+from config import BASE_PATH, STATE_PATH, HOME
+from file_events import FileEvent
+from locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+
+def subtree(path: str) -> tuple[str, str]:
+    # Every descendant path sorts between "<path>/" and "<path>0".
+    return path + "/", path + "0"
+
+
+def user_ids() -> list[str]:
+    if not BASE_PATH.is_dir():
+        return []
+    state = STATE_PATH.resolve()
+    return [
+        user_dir.name
+        for user_dir in BASE_PATH.iterdir()
+        if (user_dir / HOME).is_dir() and user_dir.resolve() != state
+    ]
+
+
+# Keeps a per-file index in step with users' Home trees. Extraction runs on
+# a bounded worker queue; file events rename, copy or drop existing entries
+# and queue whatever is new, and a leader-only periodic rescan catches
+# anything the events missed. Subclasses provide the storage and the
+# extraction, all of which run in worker threads.
+class FileIndexer(ABC):
+    name = "file"
+
+    def __init__(self, workers: int, queue_size: int, rescan_interval: int):
+        self.workers = workers
+        self.queue_size = queue_size
+        self.rescan_interval = rescan_interval
+        self._leader = FileLock(f"{self.name}-index")
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._events: Optional[asyncio.Queue] = None
+        self._pending: set[tuple[str, str]] = set()
+        self._tasks: list[asyncio.Task] = []
+
+    @abstractmethod
+    def accepts(self, path: Path) -> bool:
+        ...
+
+    def setup(self) -> None:
+        pass
+
+    @abstractmethod
+    def extract(self, full_path: Path) -> Any:
+        ...
+
+    @abstractmethod
+    def store(
+        self,
+        user_id: str,
+        path: str,
+        st: os.stat_result,
+        result: Any,
+        error: Optional[str],
+    ) -> None:
+        ...
+
+    # Size and mtime of every indexed file at or below `path`.
+    @abstractmethod
+    def known(self, user_id: str, path: str) -> dict[str, tuple[int, int]]:
+        ...
+
+    @abstractmethod
+    def drop(self, user_id: str, paths: list[str]) -> None:
+        ...
+
+    @abstractmethod
+    def forget(self, user_id: str, path: str) -> None:
+        ...
+
+    # Renames, moves and copies keep file contents and mtimes, so existing
+    # entries stay valid under their new paths. Copies that are not carried
+    # over here are picked up as new files afterwards.
+    @abstractmethod
+    def relocate(self, user_id: str, path: str, new_path: str, copy: bool) -> None:
+        ...
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.setup)
+        self._queue = asyncio.Queue(self.queue_size)
+        self._events = asyncio.Queue()
+        self._tasks = [asyncio.create_task(self._run()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._apply_events()))
+        self._tasks.append(asyncio.create_task(self._rescan()))
+        self._loop = asyncio.get_running_loop()
+
+    async def stop(self) -> None:
+        self._loop = None
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        self._pending.clear()
+        self._leader.release()
+
+    def enqueue(self, user_id: str, path: str) -> None:
+        key = (user_id, path)
+        if self._queue is None or key in self._pending or not self.accepts(Path(path)):
+            return
+        try:
+            self._queue.put_nowait(key)
+        except asyncio.QueueFull:
+            return
+        self._pending.add(key)
+
+    async def _put(self, user_id: str, path: str) -> None:
+        # Unlike enqueue, waits for room so bulk work is never dropped.
+        key = (user_id, path)
+        if key in self._pending:
+            return
+        self._pending.add(key)
+        await self._queue.put(key)
+
+    def pending(self, user_id: str) -> int:
+        return sum(1 for pending_user, _ in self._pending if pending_user == user_id)
+
+    async def _run(self) -> None:
+        while True:
+            user_id, path = await self._queue.get()
+            try:
+                await asyncio.to_thread(self.index, user_id, path)
+            except Exception:
+                logger.exception("Failed to update %s index", self.name)
+            finally:
+                self._pending.discard((user_id, path))
+
+    def handle(self, event: FileEvent) -> None:
+        loop = self._loop
+        if loop is not None:
+            loop.call_soon_threadsafe(self._events.put_nowait, event)
+
+    async def _apply_events(self) -> None:
+        while True:
+            event = await self._events.get()
+            try:
+                await self._apply(event)
+            except Exception:
+                logger.exception(
+                    "Failed to apply %s event to %s index", event.action, self.name
+                )
+
+    async def _apply(self, event: FileEvent) -> None:
+        if event.action == file_events.DELETED:
+            await asyncio.to_thread(self.forget, event.user_id, event.path)
+            return
+        if event.action in (file_events.MOVED, file_events.COPIED):
+            await asyncio.to_thread(
+                self.relocate,
+                event.user_id,
+                event.path,
+                event.new_path,
+                event.action == file_events.COPIED,
+            )
+        await self._refresh(event.user_id, event.new_path or event.path)
+
+    async def _refresh(self, user_id: str, path: str) -> None:
+        stale = await asyncio.to_thread(self._reconcile, user_id, path)
+        for stale_path in stale:
+            await self._put(user_id, stale_path)
+
+    async def _rescan(self) -> None:
+        # Catches anything the file events missed: files stored before the
+        # index existed, changes made by other tools, or a full queue.
+        while True:
+            if self._leader.acquire(blocking=False):
+                for user_id in await asyncio.to_thread(user_ids):
+                    try:
+                        await self._refresh(user_id, HOME)
+                    except Exception:
+                        logger.exception(
+                            "Rescan of %s index failed for %s", self.name, user_id
+                        )
+            await asyncio.sleep(self.rescan_interval)
+
+    def _walk(self, root: Path) -> Iterator[Path]:
+        if root.is_file():
+            if self.accepts(root):
+                yield root
+            return
+        for dirpath, _, filenames in os.walk(root):
+            for name in filenames:
+                if self.accepts(Path(name)):
+                    yield Path(dirpath) / name
+
+    def _reconcile(self, user_id: str, path: str) -> list[str]:
+        user_path = BASE_PATH / user_id
+        known = self.known(user_id, path)
+        stale = []
+        for full_path in self._walk(user_path / path):
+            try:
+                st = full_path.stat()
+            except FileNotFoundError:
+                continue
+            relative = str(full_path.relative_to(user_path))
+            if known.pop(relative, None) != (st.st_size, st.st_mtime_ns):
+                stale.append(relative)
+        if known:
+            self.drop(user_id, list(known))
+        return stale
+
+    def index(self, user_id: str, path: str) -> None:
+        full_path = BASE_PATH / user_id / path
+        try:
+            st = full_path.stat()
+        except FileNotFoundError:
+            self.forget(user_id, path)
+            return
+        if not self.accepts(full_path) or not full_path.is_file():
+            return
+
+        result, error = None, None
+        try:
+            result = self.extract(full_path)
+        except Exception as e:
+            error = str(e) or type(e).__name__
+            logger.warning(
+                "Could not index %s in the %s index: %s", path, self.name, error
+            )
+        self.store(user_id, path, st, result, error)
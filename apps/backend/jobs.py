@@ -0,0 +1,574 @@
+from __future__ import annotations
+
+import asyncio
+import json
+import logging
+import os
+import socket
+import time
+import uuid
+from dataclasses import asdict, dataclass, field
+from pathlib import Path
+from typing import Optional
+
+from config import (
+    BASE_PATH,
+    STATE_PATH,
+    JOB_WORKERS,
+    JOB_MAX_PER_USER,
+    JOB_RETENTION_SECONDS,
+)
+import file_events
+from archives import archive_size, archive_stem, extract_archive
+from crypto_utils import EncryptedWriter
+from file_ops import check_destination, copy_item, count_tree, delete_item, move_item
+from locks import FileLock
+from state_db import connect, transaction
+from trash import move_to_trash
+from utils import unique_path, write_zip
+
+logger = logging.getLogger(__name__)
+
+JOBS_PATH = STATE_PATH / "jobs"
+
+ACTIVE_STATES = ("queued", "running")
+FINISHED_STATES = ("completed", "failed", "cancelled")
+
+PERSIST_INTERVAL = 0.25
+POLL_INTERVAL = 1.0
+HEARTBEAT_INTERVAL = 10.0
+LEASE_SECONDS = 60.0
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    status TEXT NOT NULL,
+    cancel_requested INTEGER NOT NULL DEFAULT 0,
+    owner TEXT,
+    heartbeat_at REAL,
+    created_at REAL NOT NULL,
+    updated_at REAL NOT NULL,
+    version INTEGER NOT NULL DEFAULT 0,
+    data TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs (user_id, created_at);
+"""
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobInterrupted(Exception):
+    pass
+
+
+# The job's row no longer names this worker, which missed its heartbeats
+# long enough for another one to claim the job; that one carries on.
+class JobLeaseLost(JobInterrupted):
+    pass
+
+
+@dataclass
+class Job:
+    id: str
+    user_id: str
+    kind: str
+    items: list[str]
+    destination: Optional[str] = None
+    status: str = "queued"
+    total: int = 0
+    done: int = 0
+    bytes_total: int = 0
+    bytes_done: int = 0
+    completed_items: list[str] = field(default_factory=list)
+    outputs: list[str] = field(default_factory=list)
+    current_target: Optional[str] = None
+    cancel_requested: bool = False
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    updated_at: float = field(default_factory=time.time)
+    version: int = 0
+
+    def public(self) -> dict:
+        data = asdict(self)
+        for key in ("user_id", "current_target", "cancel_requested", "version"):
+            data.pop(key)
+        return data
+
+
+def job_result_path(job_id: str) -> Path:
+    return JOBS_PATH / f"{job_id}.zip"
+
+
+def _job_from_row(row) -> Job:
+    job = Job(**json.loads(row["data"]))
+    job.status = row["status"]
+    job.cancel_requested = bool(row["cancel_requested"])
+    job.updated_at = row["updated_at"]
+    job.version = row["version"]
+    return job
+
+
+class JobManager:
+    def __init__(self, workers: int, max_per_user: int):
+        self.workers = workers
+        self.max_per_user = max_per_user
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        self._last_persist: dict[str, float] = {}
+        self._changed: Optional[asyncio.Event] = None
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._tasks: list[asyncio.Task] = []
+        self._stopping = False
+
+    async def start(self) -> None:
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._stopping = False
+        self.owner = f"{socket.gethostname()}:{os.getpid()}:{uuid.uuid4().hex[:8]}"
+        await asyncio.to_thread(self._init_db)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._tasks.append(asyncio.create_task(self._heartbeat()))
+
+    async def stop(self) -> None:
+        self._stopping = True
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        await asyncio.to_thread(self._release_owned)
+
+    async def submit(
+        self, user_id: str, kind: str, items: list[str], destination: Optional[str]
+    ) -> Job:
+        job = Job(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            kind=kind,
+            items=items,
+            destination=destination,
+            total=len(items),
+        )
+        await asyncio.to_thread(self._insert, job)
+        self._notify()
+        await asyncio.to_thread(self._prune)
+        return job
+
+    async def get(self, user_id: str, job_id: str) -> Optional[Job]:
+        return await asyncio.to_thread(self._get, user_id, job_id)
+
+    async def list(self, user_id: str) -> list[Job]:
+        return await asyncio.to_thread(self._list, user_id)
+
+    async def cancel(self, user_id: str, job_id: str) -> Optional[Job]:
+        job = await asyncio.to_thread(self._cancel, user_id, job_id)
+        if job is not None:
+            self._notify()
+        return job
+
+    async def wait_for_update(self, job_id: str, seen: int, timeout: float) -> None:
+        deadline = self._loop.time() + timeout
+        while True:
+            remaining = deadline - self._loop.time()
+            if remaining <= 0:
+                return
+            changed = self._changed
+            try:
+                await asyncio.wait_for(changed.wait(), min(POLL_INTERVAL, remaining))
+            except asyncio.TimeoutError:
+                pass
+            version = await asyncio.to_thread(self._version, job_id)
+            if version != seen:
+                return
+
+    def _notify(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    def _init_db(self) -> None:
+        JOBS_PATH.mkdir(parents=True, exist_ok=True)
+        connect().executescript(SCHEMA)
+        with FileLock("jobs-import"):
+            self._import_legacy()
+
+    def _import_legacy(self) -> None:
+        for job_file in JOBS_PATH.glob("*.json"):
+            try:
+                job = Job(**json.loads(job_file.read_text()))
+            except Exception as e:
+                logger.warning("Skipping unreadable job file %s: %s", job_file.name, e)
+                continue
+            if job.status == "running":
+                job.status = "queued"
+            self._insert(job, ignore_existing=True)
+            job_file.unlink(missing_ok=True)
+
+    def _insert(self, job: Job, ignore_existing: bool = False) -> None:
+        verb = "INSERT OR IGNORE" if ignore_existing else "INSERT"
+        with transaction() as conn:
+            conn.execute(
+                f"{verb} INTO jobs (id, user_id, status, cancel_requested, "
+                "created_at, updated_at, data) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    job.id,
+                    job.user_id,
+                    job.status,
+                    int(job.cancel_requested),
+                    job.created_at,
+                    job.updated_at,
+                    json.dumps(asdict(job)),
+                ),
+            )
+
+    def _get(self, user_id: str, job_id: str) -> Optional[Job]:
+        row = (
+            connect()
+            .execute(
+                "SELECT * FROM jobs WHERE id = ? AND user_id = ?", (job_id, user_id)
+            )
+            .fetchone()
+        )
+        return _job_from_row(row) if row else None
+
+    def _list(self, user_id: str) -> list[Job]:
+        rows = connect().execute(
+            "SELECT * FROM jobs WHERE user_id = ? ORDER BY created_at DESC",
+            (user_id,),
+        )
+        return [_job_from_row(row) for row in rows]
+
+    def status_counts(self) -> dict[str, int]:
+        rows = connect().execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        return {status: count for status, count in rows}
+
+    def _version(self, job_id: str) -> Optional[int]:
+        row = (
+            connect()
+            .execute("SELECT version FROM jobs WHERE id = ?", (job_id,))
+            .fetchone()
+        )
+        return row["version"] if row else None
+
+    def _cancel(self, user_id: str, job_id: str) -> Optional[Job]:
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET "
+                "status = CASE WHEN status = 'queued' THEN 'cancelled' ELSE status END, "
+                "cancel_requested = CASE WHEN status = 'running' THEN 1 "
+                "ELSE cancel_requested END, "
+                "updated_at = ?, version = version + 1 "
+                "WHERE id = ? AND user_id = ?",
+                (time.time(), job_id, user_id),
+            )
+        return self._get(user_id, job_id)
+
+    def _claim(self) -> Optional[Job]:
+        now = time.time()
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN cancel_requested THEN 'cancelled' "
+                "ELSE 'queued' END, owner = NULL, version = version + 1 "
+                "WHERE status = 'running' AND heartbeat_at < ?",
+                (now - LEASE_SECONDS,),
+            )
+            row = conn.execute(
+                "SELECT * FROM jobs AS queued WHERE status = 'queued' AND ("
+                "SELECT COUNT(*) FROM jobs AS running WHERE running.status = 'running' "
+                "AND running.user_id = queued.user_id) < ? "
+                "ORDER BY created_at LIMIT 1",
+                (self.max_per_user,),
+            ).fetchone()
+            if row is None:
+                return None
+            conn.execute(
+                "UPDATE jobs SET status = 'running', owner = ?, heartbeat_at = ?, "
+                "updated_at = ?, version = version + 1 WHERE id = ?",
+                (self.owner, now, now, row["id"]),
+            )
+        job = _job_from_row(row)
+        job.status = "running"
+        return job
+
+    def _save(self, job: Job) -> None:
+        job.updated_at = time.time()
+        with transaction() as conn:
+            row = conn.execute(
+                "UPDATE jobs SET status = ?, updated_at = ?, data = ?, "
+                "version = version + 1 WHERE id = ? AND owner = ? "
+                "RETURNING cancel_requested, version",
+                (
+                    job.status,
+                    job.updated_at,
+                    json.dumps(asdict(job)),
+                    job.id,
+                    self.owner,
+                ),
+            ).fetchone()
+        if row is None:
+            raise JobLeaseLost(f"Lost the lease on job {job.id}")
+        job.cancel_requested = job.cancel_requested or bool(row["cancel_requested"])
+        job.version = row["version"]
+
+    def _release_owned(self) -> None:
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET status = CASE WHEN cancel_requested THEN 'cancelled' "
+                "ELSE 'queued' END, owner = NULL, version = version + 1 "
+                "WHERE status = 'running' AND owner = ?",
+                (self.owner,),
+            )
+
+    def _touch(self, job: Job, force: bool = False) -> None:
+        now = time.time()
+        if force or now - self._last_persist.get(job.id, 0) >= PERSIST_INTERVAL:
+            self._last_persist[job.id] = now
+            self._save(job)
+            self._loop.call_soon_threadsafe(self._notify)
+
+    def _remove(self, job_id: str) -> None:
+        job_result_path(job_id).unlink(missing_ok=True)
+
+    def _prune(self) -> None:
+        with transaction() as conn:
+            expired = [
+                row["id"]
+                for row in conn.execute(
+                    "DELETE FROM jobs WHERE status IN (?, ?, ?) AND updated_at < ? "
+                    "RETURNING id",
+                    (*FINISHED_STATES, time.time() - JOB_RETENTION_SECONDS),
+                )
+            ]
+        for job_id in expired:
+            self._remove(job_id)
+
+    async def _heartbeat(self) -> None:
+        while True:
+            await asyncio.sleep(HEARTBEAT_INTERVAL)
+            try:
+                await asyncio.to_thread(self._beat)
+            except Exception:
+                logger.exception("Job heartbeat failed")
+
+    def _beat(self) -> None:
+        with transaction() as conn:
+            conn.execute(
+                "UPDATE jobs SET heartbeat_at = ? WHERE status = 'running' AND owner = ?",
+                (time.time(), self.owner),
+            )
+        self._prune()
+
+    async def _worker(self) -> None:
+        while True:
+            changed = self._changed
+            try:
+                job = await asyncio.to_thread(self._claim)
+            except Exception:
+                logger.exception("Could not claim job")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(changed.wait(), POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await asyncio.to_thread(self._run, job)
+            finally:
+                self._last_persist.pop(job.id, None)
+                self._notify()
+
+    def _run(self, job: Job) -> None:
+        try:
+            self._touch(job, force=True)
+            try:
+                getattr(self, f"_run_{job.kind}")(job)
+                job.status = "completed"
+            except JobInterrupted:
+                raise
+            except JobCancelled:
+                job.status = "cancelled"
+            except Exception as e:
+                logger.exception("Job %s (%s) failed", job.id, job.kind)
+                job.status = "failed"
+                job.error = str(e)
+            self._touch(job, force=True)
+        except JobLeaseLost as e:
+            logger.warning("%s; leaving it to its new owner", e)
+        except JobInterrupted:
+            pass
+
+    def _check(self, job: Job) -> None:
+        if self._stopping:
+            raise JobInterrupted()
+        if job.cancel_requested:
+            raise JobCancelled()
+
+    def _hook(self, job: Job, attr: str):
+        def on_progress(amount: int) -> None:
+            self._check(job)
+            setattr(job, attr, getattr(job, attr) + amount)
+            self._touch(job)
+
+        return on_progress
+
+    def _finish_item(self, job: Job, item_path: str, output: Optional[Path]) -> None:
+        job.completed_items.append(item_path)
+        if output is not None:
+            job.outputs.append(str(output.relative_to(BASE_PATH / job.user_id)))
+        job.current_target = None
+        job.done = len(job.completed_items)
+        self._touch(job, force=True)
+
+    def _run_move(self, job: Job) -> None:
+        parent_path = BASE_PATH / job.user_id
+        dest_path = parent_path / job.destination
+        check_destination(dest_path)
+        job.total = len(job.items)
+        for item_path in job.items:
+            if item_path in job.completed_items:
+                continue
+            self._check(job)
+            new_location = move_item(parent_path / item_path, dest_path)
+            self._finish_item(job, item_path, new_location)
+            if new_location is not None:
+                file_events.emit(
+                    file_events.MOVED,
+                    job.user_id,
+                    item_path,
+                    str(new_location.relative_to(parent_path)),
+                )
+
+    def _run_copy(self, job: Job) -> None:
+        parent_path = BASE_PATH / job.user_id
+        dest_path = parent_path / job.destination
+        check_destination(dest_path)
+
+        if job.current_target:
+            delete_item(Path(job.current_target))
+            job.current_target = None
+
+        pending = [item for item in job.items if item not in job.completed_items]
+        job.total = len(job.items)
+        job.bytes_total = job.bytes_done + sum(
+            count_tree(parent_path / item)[1] for item in pending
+        )
+
+        def on_target(target: Path) -> None:
+            job.current_target = str(target)
+            self._touch(job, force=True)
+
+        for item_path in pending:
+            self._check(job)
+            new_location = copy_item(
+                parent_path / item_path,
+                dest_path,
+                on_progress=self._hook(job, "bytes_done"),
+                on_target=on_target,
+            )
+            self._finish_item(job, item_path, new_location)
+            file_events.emit(
+                file_events.COPIED,
+                job.user_id,
+                item_path,
+                str(new_location.relative_to(parent_path)),
+            )
+
+    def _run_delete(self, job: Job) -> None:
+        parent_path = BASE_PATH / job.user_id
+        job.total = len(job.items)
+        for item_path in job.items:
+            if item_path in job.completed_items:
+                continue
+            self._check(job)
+            move_to_trash(parent_path, item_path)
+            self._finish_item(job, item_path, None)
+            file_events.emit(file_events.DELETED, job.user_id, item_path)
+
+    def _run_extract(self, job: Job) -> None:
+        parent_path = BASE_PATH / job.user_id
+        if job.destination:
+            check_destination(parent_path / job.destination)
+
+        if job.current_target:
+            delete_item(Path(job.current_target))
+            job.current_target = None
+
+        pending = [item for item in job.items if item not in job.completed_items]
+        job.total = len(job.items)
+        job.bytes_total = job.bytes_done + sum(
+            archive_size(parent_path / item) for item in pending
+        )
+
+        for item_path in pending:
+            self._check(job)
+            archive = parent_path / item_path
+            if not archive.is_file():
+                raise FileNotFoundError(f"Archive not found: {item_path}")
+            dest_path = (
+                parent_path / job.destination if job.destination else archive.parent
+            )
+            root = unique_path(
+                dest_path / archive_stem(archive), reserve=True, is_dir=True
+            )
+            job.current_target = str(root)
+            self._touch(job, force=True)
+            try:
+                extract_archive(
+                    archive,
+                    parent_path,
+                    root,
+                    on_progress=self._hook(job, "bytes_done"),
+                    check=lambda: self._check(job),
+                )
+            except JobInterrupted:
+                raise
+            except BaseException:
+                # Cancelled or failed extractions leave nothing behind;
+                # interrupted ones are cleaned up when the job resumes.
+                delete_item(root)
+                job.current_target = None
+                raise
+            self._finish_item(job, item_path, root)
+            file_events.emit(
+                file_events.CREATED, job.user_id, str(root.relative_to(parent_path))
+            )
+
+    def _run_zip(self, job: Job) -> None:
+        parent_path = BASE_PATH / job.user_id
+        result_path = job_result_path(job.id)
+        if result_path.exists():
+            result_path.unlink()
+
+        item_paths = []
+        job.bytes_done = 0
+        job.bytes_total = 0
+        for item_path in job.items:
+            full_path = parent_path / item_path
+            if not full_path.exists():
+                raise FileNotFoundError(f"Path not found: {item_path}")
+            item_paths.append(
+                {"id": item_path, "name": full_path.name, "is_dir": full_path.is_dir()}
+            )
+            job.bytes_total += count_tree(full_path)[1]
+
+        try:
+            with EncryptedWriter(result_path) as out:
+                write_zip(
+                    out,
+                    item_paths,
+                    parent_path,
+                    on_progress=self._hook(job, "bytes_done"),
+                )
+        except JobLeaseLost:
+            # The result path is the new owner's now.
+            raise
+        except BaseException:
+            if result_path.exists():
+                result_path.unlink()
+            raise
+        job.done = job.total
+
+
+job_manager = JobManager(JOB_WORKERS, JOB_MAX_PER_USER)
@@ -0,0 +1,619 @@
+import argparse
+import base64
+import http.client
+import io
+import json
+import os
+import random
+import secrets
+import shutil
+import socket
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+from dataclasses import dataclass
+from pathlib import Path
+from typing import Callable, Iterator, Optional
+from urllib.parse import urlencode, urlsplit
+
+from jose import jwt
+
+KiB = 1024
+MiB = 1024 * KiB
+
+READ_SIZE = 1 * MiB
+RANGE_SIZE = 256 * KiB
+SERVER_START_TIMEOUT = 60
+DEFAULT_TOLERANCE = 0.3
+
+SCALES = {
+    "ci": {
+        "files": 1000,
+        "depth": 8,
+        "files_per_level": 10,
+        "video_size": 32 * MiB,
+        "images": 8,
+        "upload_size": 1 * MiB,
+        "requests": 100,
+        "concurrency": 4,
+    },
+    "full": {
+        "files": 5000,
+        "depth": 16,
+        "files_per_level": 25,
+        "video_size": 256 * MiB,
+        "images": 32,
+        "upload_size": 4 * MiB,
+        "requests": 300,
+        "concurrency": 8,
+    },
+}
+
+
+@dataclass
+class Request:
+    method: str
+    path: str
+    params: Optional[dict] = None
+    headers: Optional[dict] = None
+    body: Optional[bytes] = None
+    authenticated: bool = True
+
+
+@dataclass
+class Outcome:
+    status: int
+    seconds: float
+    sent: int
+    received: int
+
+
+class Client:
+    def __init__(self, url: str, token: str, api_key: str):
+        parts = urlsplit(url)
+        self.host = parts.hostname
+        self.port = parts.port or 80
+        self.auth_headers = {"authorization": f"Bearer {token}", "x-api-key": api_key}
+        self._local = threading.local()
+
+    def _connection(self) -> http.client.HTTPConnection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = http.client.HTTPConnection(self.host, self.port, timeout=300)
+            self._local.conn = conn
+        return conn
+
+    def _reset(self) -> None:
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            conn.close()
+        self._local.conn = None
+
+    def send(self, request: Request, keep_body: bool = False) -> tuple[Outcome, bytes]:
+        headers = dict(request.headers or {})
+        if request.authenticated:
+            headers.update(self.auth_headers)
+        target = request.path
+        if request.params:
+            target += "?" + urlencode(request.params)
+
+        body = bytearray()
+        started = time.perf_counter()
+        try:
+            conn = self._connection()
+            conn.request(request.method, target, body=request.body, headers=headers)
+            response = conn.getresponse()
+            received = 0
+            while True:
+                chunk = response.read(READ_SIZE)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if keep_body:
+                    body += chunk
+            status = response.status
+            if response.will_close:
+                self._reset()
+        except (OSError, http.client.HTTPException):
+            self._reset()
+            status, received = 0, 0
+        outcome = Outcome(
+            status=status,
+            seconds=time.perf_counter() - started,
+            sent=len(request.body or b""),
+            received=received,
+        )
+        return outcome, bytes(body)
+
+
+def mint_token(secret: str, user_id: str, lifetime: int = 24 * 60 * 60) -> str:
+    return jwt.encode(
+        {"sub": user_id, "aud": "authenticated", "exp": int(time.time()) + lifetime},
+        secret,
+        algorithm="HS256",
+    )
+
+
+def multipart(filename: str, data: bytes) -> tuple[bytes, dict]:
+    boundary = uuid.uuid4().hex
+    head = (
+        f"--{boundary}\r\n"
+        f'Content-Disposition: form-data; name="file"; filename="{filename}"\r\n'
+        "Content-Type: application/octet-stream\r\n\r\n"
+    ).encode()
+    tail = f"\r\n--{boundary}--\r\n".encode()
+    headers = {"content-type": f"multipart/form-data; boundary={boundary}"}
+    return head + data + tail, headers
+
+
+def upload(path: str, filename: str, data: bytes) -> Request:
+    body, headers = multipart(filename, data)
+    return Request("POST", "/files/upload", {"path": path}, headers, body)
+
+
+def download_id(items: list[dict]) -> str:
+    return base64.b64encode(json.dumps(items).encode()).decode()
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class LocalServer:
+    def __init__(self, workers: int, extra_env: Optional[dict] = None):
+        self.workers = workers
+        self.extra_env = extra_env or {}
+        self.jwt_secret = secrets.token_urlsafe(32)
+        self.api_key = secrets.token_hex(16)
+        self.port = _free_port()
+        self.url = f"http://127.0.0.1:{self.port}"
+        self._base_path: Optional[Path] = None
+        self._process: Optional[subprocess.Popen] = None
+
+    def __enter__(self) -> "LocalServer":
+        self._base_path = Path(tempfile.mkdtemp(prefix="pidrive-loadtest-"))
+        env = {
+            key: value
+            for key, value in os.environ.items()
+            if key not in ("PROMETHEUS_MULTIPROC_DIR", "STATE_PATH")
+        }
+        env.update(
+            BASE_PATH=str(self._base_path),
+            JWT_SECRET=self.jwt_secret,
+            API_KEY=self.api_key,
+            FILES_MASTER_KEY=base64.b64encode(os.urandom(32)).decode(),
+            LOG_LEVEL="WARNING",
+            RATE_LIMIT_ENABLED="false",
+            WEB_CONCURRENCY=str(self.workers),
+            **self.extra_env,
+        )
+        self._process = subprocess.Popen(
+            [
+                sys.executable,
+                "-m",
+                "uvicorn",
+                "main:app",
+                "--host",
+                "127.0.0.1",
+                "--port",
+                str(self.port),
+                "--workers",
+                str(self.workers),
+                "--no-access-log",
+            ],
+            cwd=Path(__file__).resolve().parent,
+            env=env,
+        )
+        self._wait_ready()
+        return self
+
+    def _wait_ready(self) -> None:
+        deadline = time.monotonic() + SERVER_START_TIMEOUT
+        while time.monotonic() < deadline:
+            if self._process.poll() is not None:
+                raise RuntimeError("Server exited during startup")
+            try:
+                conn = http.client.HTTPConnection("127.0.0.1", self.port, timeout=1)
+                conn.request("GET", "/users")
+                conn.getresponse().read()
+                conn.close()
+                return
+            except OSError:
+                time.sleep(0.2)
+        raise RuntimeError("Server did not start in time")
+
+    def __exit__(self, *exc) -> None:
+        if self._process is not None:
+            self._process.terminate()
+            try:
+                self._process.wait(timeout=30)
+            except subprocess.TimeoutExpired:
+                self._process.kill()
+                self._process.wait()
+        if self._base_path is not None:
+            shutil.rmtree(self._base_path, ignore_errors=True)
+
+
+def run_requests(
+    client: Client, requests: Iterator[Request], count: int, concurrency: int
+) -> tuple[list[Outcome], float]:
+    batch = [next(requests) for _ in range(count)]
+    started = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        outcomes = [
+            outcome for outcome, _ in pool.map(lambda req: client.send(req), batch)
+        ]
+    return outcomes, time.perf_counter() - started
+
+
+def _check(outcome: Outcome, what: str) -> None:
+    if not 200 <= outcome.status < 300:
+        raise RuntimeError(f"{what} failed with status {outcome.status}")
+
+
+def _image(rng: random.Random) -> bytes:
+    from PIL import Image
+
+    gradient = Image.linear_gradient("L").resize((1920, 1080))
+    channels = [gradient.rotate(rng.choice([0, 90, 180, 270])) for _ in range(3)]
+    buffer = io.BytesIO()
+    Image.merge("RGB", channels).save(buffer, "JPEG", quality=rng.randint(70, 95))
+    return buffer.getvalue()
+
+
+@dataclass
+class Tree:
+    flat_dir: str = "Home/flat"
+    deep_dir: str = "Home/deep"
+    deepest_dir: str = "Home/deep"
+    video: str = "Home/media/video.mp4"
+    images: tuple = ()
+
+
+def seed_tree(client: Client, settings: dict, concurrency: int, seed: int) -> Tree:
+    rng = random.Random(seed)
+    tree = Tree()
+    uploads = []
+
+    for number in range(settings["files"]):
+        size = rng.randint(KiB, 32 * KiB)
+        uploads.append(
+            upload(tree.flat_dir, f"doc{number:05d}.txt", rng.randbytes(size))
+        )
+
+    level_dir = tree.deep_dir
+    for level in range(settings["depth"]):
+        level_dir = f"{level_dir}/level{level:02d}"
+        for number in range(settings["files_per_level"]):
+            data = rng.randbytes(rng.randint(KiB, 64 * KiB))
+            uploads.append(upload(level_dir, f"note-{level:02d}-{number:03d}.md", data))
+    tree.deepest_dir = level_dir
+
+    image_paths = []
+    for number in range(settings["images"]):
+        name = f"photo{number:03d}.jpg"
+        uploads.append(upload("Home/images", name, _image(rng)))
+        image_paths.append(f"Home/images/{name}")
+    tree.images = tuple(image_paths)
+
+    with ThreadPoolExecutor(concurrency) as pool:
+        for outcome, _ in pool.map(lambda req: client.send(req), uploads):
+            _check(outcome, "Seeding upload")
+
+    video_dir, video_name = tree.video.rsplit("/", 1)
+    outcome, _ = client.send(
+        upload(video_dir, video_name, rng.randbytes(settings["video_size"]))
+    )
+    _check(outcome, "Seeding video upload")
+    return tree
+
+
+def cleanup(client: Client) -> None:
+    outcome, body = client.send(Request("GET", "/directories", {"path": "Home"}), True)
+    if outcome.status != 200:
+        return
+    items = [entry["id"] for entry in json.loads(body)]
+    if items:
+        client.send(
+            Request(
+                "DELETE",
+                "/files",
+                headers={"content-type": "application/json"},
+                body=json.dumps({"items": items}).encode(),
+            )
+        )
+    client.send(Request("DELETE", "/trash"))
+
+
+def scenarios(
+    tree: Tree, settings: dict, user_id: str, seed: int
+) -> dict[str, Callable[[], Iterator[Request]]]:
+    video_size = settings["video_size"]
+    video_name = tree.video.rsplit("/", 1)[1]
+    video_item = download_id([{"id": tree.video, "name": video_name, "is_dir": False}])
+    zip_items = download_id(
+        [
+            {"id": path, "name": path.rsplit("/", 1)[1], "is_dir": False}
+            for path in tree.images
+        ]
+        + [{"id": tree.deep_dir, "name": "deep", "is_dir": True}]
+    )
+    upload_data = random.Random(seed).randbytes(settings["upload_size"])
+
+    def repeat(make: Callable[[int, random.Random], Request]) -> Callable:
+        def requests() -> Iterator[Request]:
+            rng = random.Random(seed)
+            number = 0
+            while True:
+                yield make(number, rng)
+                number += 1
+
+        return requests
+
+    def range_headers(rng: random.Random) -> dict:
+        start = rng.randrange(0, max(1, video_size - RANGE_SIZE))
+        return {"range": f"bytes={start}-{start + RANGE_SIZE - 1}"}
+
+    return {
+        "listing": repeat(
+            lambda n, rng: Request("GET", "/directories", {"path": tree.flat_dir})
+        ),
+        "listing_deep": repeat(
+            lambda n, rng: Request("GET", "/directories", {"path": tree.deepest_dir})
+        ),
+        "search": repeat(
+            lambda n, rng: Request(
+                "GET", "/directories/search", {"query": f"doc{rng.randint(0, 9)}"}
+            )
+        ),
+        "upload": repeat(
+            lambda n, rng: upload("Home/uploads", f"upload{n:05d}.bin", upload_data)
+        ),
+        "download": repeat(
+            lambda n, rng: Request("GET", "/files/download", {"id": video_item})
+        ),
+        "zip": repeat(
+            lambda n, rng: Request("GET", "/files/download", {"id": zip_items})
+        ),
+        "range": repeat(
+            lambda n, rng: Request(
+                "GET", "/media/stream", {"path": tree.video}, range_headers(rng)
+            )
+        ),
+        "thumbnail": repeat(
+            lambda n, rng: Request(
+                "GET", "/media/thumbnails", {"path": tree.images[n % len(tree.images)]}
+            )
+        ),
+        "share_download": repeat(
+            lambda n, rng: Request(
+                "GET",
+                "/share/download",
+                {"user_id": user_id, "id": video_item},
+                authenticated=False,
+            )
+        ),
+        "share_range": repeat(
+            lambda n, rng: Request(
+                "GET",
+                "/share/stream",
+                {"user_id": user_id, "path": tree.video},
+                range_headers(rng),
+                authenticated=False,
+            )
+        ),
+    }
+
+
+REQUEST_SCALE = {"download": 0.2, "zip": 0.2, "share_download": 0.2, "upload": 0.5}
+
+
+def percentile(values: list[float], pct: float) -> float:
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, round(pct / 100 * (len(ordered) - 1)))
+    return ordered[index]
+
+
+def summarize(outcomes: list[Outcome], wall: float) -> dict:
+    timings = [outcome.seconds for outcome in outcomes]
+    transferred = sum(outcome.sent + outcome.received for outcome in outcomes)
+    return {
+        "requests": len(outcomes),
+        "errors": sum(1 for outcome in outcomes if not 200 <= outcome.status < 300),
+        "rps": len(outcomes) / wall if wall > 0 else None,
+        "mb_per_s": transferred / MiB / wall if wall > 0 else None,
+        "p50_ms": percentile(timings, 50) * 1000,
+        "p95_ms": percentile(timings, 95) * 1000,
+        "p99_ms": percentile(timings, 99) * 1000,
+        "mean_ms": statistics.fmean(timings) * 1000,
+    }
+
+
+def run_scenarios(
+    client: Client,
+    tree: Tree,
+    settings: dict,
+    user_id: str,
+    selected: list[str],
+    seed: int,
+    on_result: Optional[Callable[[str, dict], None]] = None,
+) -> dict:
+    available = scenarios(tree, settings, user_id, seed)
+    unknown = set(selected) - set(available)
+    if unknown:
+        raise ValueError(f"Unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = {}
+    for name in selected:
+        requests = available[name]()
+        count = max(1, int(settings["requests"] * REQUEST_SCALE.get(name, 1.0)))
+        warmup = max(1, count // 10)
+        run_requests(client, requests, warmup, settings["concurrency"])
+        outcomes, wall = run_requests(client, requests, count, settings["concurrency"])
+        results[name] = summarize(outcomes, wall)
+        if on_result:
+            on_result(name, results[name])
+    return results
+
+
+def compare(baseline: dict, current: dict, tolerance: float) -> list[dict]:
+    rows = []
+    for name, result in current.items():
+        before = baseline.get(name)
+        if before is None:
+            continue
+        checks = [
+            ("p95_ms", before["p95_ms"], result["p95_ms"], True),
+            ("rps", before["rps"], result["rps"], False),
+        ]
+        for metric, old, new, lower_is_better in checks:
+            if not old or new is None:
+                continue
+            change = (new - old) / old
+            worse = change > tolerance if lower_is_better else change < -tolerance
+            rows.append(
+                {
+                    "scenario": name,
+                    "metric": metric,
+                    "baseline": old,
+                    "current": new,
+                    "change": change,
+                    "regressed": worse,
+                }
+            )
+        if result["errors"]:
+            rows.append(
+                {
+                    "scenario": name,
+                    "metric": "errors",
+                    "baseline": before.get("errors", 0),
+                    "current": result["errors"],
+                    "change": None,
+                    "regressed": True,
+                }
+            )
+    return rows
+
+
+def _print_result(name: str, result: dict) -> None:
+    throughput = f"{result['mb_per_s']:.1f}" if result["mb_per_s"] else "-"
+    print(
+        f"{name:<15} {result['requests']:>6} {result['errors']:>6} "
+        f"{result['rps']:>9.1f} {throughput:>9} {result['p50_ms']:>9.1f} "
+        f"{result['p95_ms']:>9.1f} {result['p99_ms']:>9.1f}"
+    )
+
+
+def _print_comparison(rows: list[dict], tolerance: float) -> None:
+    print(f"\nCompared with baseline (tolerance {tolerance:.0%}):")
+    for row in rows:
+        change = f"{row['change']:+.1%}" if row["change"] is not None else "-"
+        verdict = "REGRESSION" if row["regressed"] else "ok"
+        print(
+            f"{row['scenario']:<15} {row['metric']:<7} {row['baseline']:>10.1f} "
+            f"-> {row['current']:>10.1f} {change:>8}  {verdict}"
+        )
+
+
+def _sizes(value: str) -> int:
+    value = value.strip().lower().rstrip("b")
+    units = {"k": KiB, "m": MiB, "g": 1024 * MiB}
+    return int(float(value.rstrip("kmg")) * units.get(value[-1:], 1))
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(
+        description="Load-test a PiDrive backend against a synthetic user tree."
+    )
+    parser.add_argument("--scale", choices=sorted(SCALES), default="full")
+    parser.add_argument(
+        "--url", default=None, help="Existing instance; a local one is started if unset"
+    )
+    parser.add_argument("--jwt-secret", default=os.getenv("JWT_SECRET"))
+    parser.add_argument("--api-key", default=os.getenv("API_KEY"))
+    parser.add_argument("--workers", type=int, default=1, help="Local server workers")
+    parser.add_argument("--scenarios", default=None, help="Comma-separated")
+    parser.add_argument("--files", type=int)
+    parser.add_argument("--depth", type=int)
+    parser.add_argument("--files-per-level", type=int)
+    parser.add_argument("--video-size", type=_sizes)
+    parser.add_argument("--images", type=int)
+    parser.add_argument("--upload-size", type=_sizes)
+    parser.add_argument("--requests", type=int)
+    parser.add_argument("--concurrency", type=int)
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", type=Path, default=None, help="Write results here")
+    parser.add_argument("--baseline", type=Path, default=None)
+    parser.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE)
+    args = parser.parse_args()
+
+    settings = dict(SCALES[args.scale])
+    for key in settings:
+        value = getattr(args, key)
+        if value is not None:
+            settings[key] = value
+
+    if args.url:
+        if not args.jwt_secret or not args.api_key:
+            parser.error("--url requires --jwt-secret and --api-key")
+        server = None
+        url, jwt_secret, api_key = args.url, args.jwt_secret, args.api_key
+    else:
+        server = LocalServer(args.workers).__enter__()
+        url, jwt_secret, api_key = server.url, server.jwt_secret, server.api_key
+
+    user_id = f"loadtest-{uuid.uuid4().hex[:12]}"
+    client = Client(url, mint_token(jwt_secret, user_id), api_key)
+    selected = (
+        args.scenarios.split(",")
+        if args.scenarios
+        else list(scenarios(Tree(), settings, user_id, args.seed))
+    )
+
+    try:
+        _check(client.send(Request("GET", "/users"))[0], "User initialisation")
+        started = time.perf_counter()
+        tree = seed_tree(client, settings, settings["concurrency"], args.seed)
+        print(f"Seeded synthetic tree in {time.perf_counter() - started:.1f}s")
+        print(
+            f"{'scenario':<15} {'reqs':>6} {'errors':>6} {'req/s':>9} {'MB/s':>9} "
+            f"{'p50 ms':>9} {'p95 ms':>9} {'p99 ms':>9}"
+        )
+        results = run_scenarios(
+            client, tree, settings, user_id, selected, args.seed, _print_result
+        )
+    finally:
+        if server is not None:
+            server.__exit__(None, None, None)
+        else:
+            cleanup(client)
+
+    if args.json:
+        args.json.write_text(
+            json.dumps(
+                {"scale": args.scale, "settings": settings, "results": results},
+                indent=2,
+            )
+        )
+
+    failed = any(result["errors"] for result in results.values())
+    if args.baseline:
+        baseline = json.loads(args.baseline.read_text())
+        if baseline.get("settings") != settings:
+            print("Warning: baseline was recorded with different settings")
+        rows = compare(baseline["results"], results, args.tolerance)
+        _print_comparison(rows, args.tolerance)
+        failed = failed or any(row["regressed"] for row in rows)
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import logging
+import os
+import queue
+import random
+import re
+import sys
+import time
+import uuid
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from logging.handlers import (
+    MemoryHandler,
+    QueueHandler,
+    QueueListener,
+    RotatingFileHandler,
+)
+from typing import Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import (
+    LOG_LEVEL,
+    LOG_HOT_ROUTES,
+    LOG_HOT_SAMPLE_RATE,
+    AUDIT_LOG_PATH,
+    AUDIT_LOG_MAX_BYTES,
+    AUDIT_LOG_BACKUPS,
+    AUDIT_BATCH_SIZE,
+    AUDIT_FLUSH_INTERVAL,
+)
+from locks import FileLock
+
+REQUEST_ID_HEADER = b"x-request-id"
+REQUEST_ID_PATTERN = re.compile(r"[A-Za-z0-9._-]{1,64}")
+
+_RECORD_ATTRS = set(vars(logging.makeLogRecord({}))) | {
+    "message",
+    "asctime",
+    "color_message",
+}
+
+request_id: ContextVar[Optional[str]] = ContextVar("request_id", default=None)
+
+access_logger = logging.getLogger("pidrive.access")
+audit_logger = logging.getLogger("pidrive.audit")
+
+
+class JsonFormatter(logging.Formatter):
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "time": datetime.fromtimestamp(record.created, timezone.utc).isoformat(
+                timespec="milliseconds"
+            ),
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        current = request_id.get()
+        if current is not None:
+            entry["request_id"] = current
+        for key, value in vars(record).items():
+            if key not in _RECORD_ATTRS:
+                entry[key] = value
+        if record.exc_info:
+            entry["exc_info"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class AuditFileHandler(RotatingFileHandler):
+    def __init__(self):
+        AUDIT_LOG_PATH.parent.mkdir(parents=True, exist_ok=True)
+        super().__init__(
+            AUDIT_LOG_PATH,
+            maxBytes=AUDIT_LOG_MAX_BYTES,
+            backupCount=AUDIT_LOG_BACKUPS,
+            delay=True,
+        )
+
+    def reopen_if_rotated(self) -> None:
+        if self.stream is None:
+            return
+        try:
+            current = os.stat(self.baseFilename).st_ino
+        except FileNotFoundError:
+            current = None
+        if current != os.fstat(self.stream.fileno()).st_ino:
+            self.stream.close()
+            self.stream = None
+
+
+class AuditBuffer(MemoryHandler):
+    def __init__(self, capacity: int, target: AuditFileHandler):
+        super().__init__(capacity, target=target)
+        self._file_lock = FileLock("audit-log")
+
+    def flush(self) -> None:
+        with self.lock:
+            if not self.buffer or self.target is None:
+                return
+            with self._file_lock:
+                self.target.reopen_if_rotated()
+                super().flush()
+
+
+def audit(action: str, user_id: Optional[str], **fields) -> None:
+    audit_logger.info(action, extra={"action": action, "user_id": user_id, **fields})
+
+
+def audit_batch(action: str, user_id: str, results: list[dict], **fields) -> None:
+    for result in results:
+        if not result["success"]:
+            continue
+        extra = (
+            dict(fields, new_path=result["new_path"])
+            if result["new_path"] is not None
+            else fields
+        )
+        audit(action, user_id, path=result["item"], **extra)
+
+
+class LogPipeline:
+    def __init__(self, flush_interval: float):
+        self.flush_interval = flush_interval
+        self._listeners: list[QueueListener] = []
+        self._audit_buffer: Optional[AuditBuffer] = None
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        formatter = JsonFormatter()
+
+        log_queue: queue.SimpleQueue = queue.SimpleQueue()
+        log_handler = QueueHandler(log_queue)
+        log_handler.setFormatter(formatter)
+        root = logging.getLogger()
+        root.handlers = [log_handler]
+        root.setLevel(LOG_LEVEL)
+        for name in ("uvicorn", "uvicorn.error"):
+            logging.getLogger(name).handlers = []
+            logging.getLogger(name).propagate = True
+        # RequestLogMiddleware writes the access log.
+        logging.getLogger("uvicorn.access").handlers = []
+        logging.getLogger("uvicorn.access").propagate = False
+
+        audit_queue: queue.SimpleQueue = queue.SimpleQueue()
+        audit_handler = QueueHandler(audit_queue)
+        audit_handler.setFormatter(formatter)
+        audit_logger.handlers = [audit_handler]
+        audit_logger.setLevel(logging.INFO)
+        audit_logger.propagate = False
+        self._audit_buffer = AuditBuffer(AUDIT_BATCH_SIZE, AuditFileHandler())
+
+        self._listeners = [
+            QueueListener(log_queue, logging.StreamHandler(sys.stdout)),
+            QueueListener(audit_queue, self._audit_buffer),
+        ]
+        for listener in self._listeners:
+            listener.start()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        for listener in self._listeners:
+            await asyncio.to_thread(listener.stop)
+        self._listeners = []
+        if self._audit_buffer is not None:
+            target = self._audit_buffer.target
+            await asyncio.to_thread(self._audit_buffer.close)
+            target.close()
+            self._audit_buffer = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await asyncio.to_thread(self._audit_buffer.flush)
+            except Exception:
+                logging.getLogger(__name__).exception("Audit log flush failed")
+
+
+log_pipeline = LogPipeline(AUDIT_FLUSH_INTERVAL)
+
+
+def _incoming_request_id(scope: Scope) -> Optional[str]:
+    for name, value in scope["headers"]:
+        if name == REQUEST_ID_HEADER:
+            value = value.decode("latin-1")
+            return value if REQUEST_ID_PATTERN.fullmatch(value) else None
+    return None
+
+
+class RequestLogMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        current = _incoming_request_id(scope) or uuid.uuid4().hex
+        token = request_id.set(current)
+        started = time.perf_counter()
+        status = 500
+        sent = 0
+
+        async def send_with_request_id(message: Message) -> None:
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (REQUEST_ID_HEADER, current.encode("latin-1")),
+                ]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_request_id)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            sample_rate = 1.0
+            if status < 400 and route in LOG_HOT_ROUTES:
+                sample_rate = LOG_HOT_SAMPLE_RATE
+            if sample_rate >= 1.0 or random.random() < sample_rate:
+                access_logger.log(
+                    logging.ERROR if status >= 500 else logging.INFO,
+                    "%s %s %d",
+                    scope["method"],
+                    scope["path"],
+                    status,
+                    extra={
+                        "method": scope["method"],
+                        "route": route,
+                        "status": status,
+                        "duration_ms": round((time.perf_counter() - started) * 1000, 1),
+                        "bytes": sent,
+                        "user_id": scope.get("state", {}).get("user_id"),
+                        "client": (scope.get("client") or (None,))[0],
+                        "sample_rate": sample_rate,
+                    },
+                )
+            request_id.reset(token)
@@ -1,9 +1,36 @@
+import asyncio
+import logging
+from contextlib import asynccontextmanager
+
 import uvicorn
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
 
-from config import ALLOWED_ORIGINS, APP_TITLE, APP_VERSION, APP_DESCRIPTION
+from config import (
+    ALLOWED_ORIGINS,
+    APP_TITLE,
+    APP_VERSION,
+    APP_DESCRIPTION,
+    CHUNK_AUTOTUNE,
+    WEB_CONCURRENCY,
+)
 from middleware import AuthMiddleware
+from ratelimit import RateLimitMiddleware
+from logs import RequestLogMiddleware, log_pipeline
+from metrics import MetricsMiddleware, loop_monitor, mark_process_dead
+from profiling import ProfilingMiddleware
+from jobs import job_manager
+from trash import trash_purger
+from scrubber import scrubber
+from share_cache import share_cache
+from share_tokens import share_links
+from video_previews import video_previews
+from media_index import media_index
+from content_index import content_index
+from changes import change_journal
+from delta_sync import init_db as init_delta_signatures
+from pdf_pages import pdf_pages
+from benchmark import load_or_autotune
 
 from routes.users import router as users_router
 from routes.directories import router as directories_router
@@ -11,9 +38,56 @@ from routes.files import router as files_router
 from routes.operations import router as operations_router
 from routes.media import router as media_router
 from routes.shares import router as shared_router
+from routes.share_links import router as share_links_router
+from routes.jobs import router as jobs_router
+from routes.trash import router as trash_router
+from routes.integrity import router as integrity_router
+from routes.metrics import router as metrics_router
+from routes.changes import router as changes_router
+
+logger = logging.getLogger(__name__)
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    await log_pipeline.start()
+    if CHUNK_AUTOTUNE:
+        logger.info("Chunk sizes tuned: %s", await asyncio.to_thread(load_or_autotune))
+    await loop_monitor.start()
+    await job_manager.start()
+    await trash_purger.start()
+    await scrubber.start()
+    await share_links.start()
+    await share_cache.start()
+    await video_previews.start()
+    await media_index.start()
+    await content_index.start()
+    await change_journal.start()
+    await asyncio.to_thread(init_delta_signatures)
+    yield
+    await change_journal.stop()
+    await content_index.stop()
+    await pdf_pages.stop()
+    await media_index.stop()
+    await video_previews.stop()
+    await share_cache.stop()
+    await share_links.stop()
+    await scrubber.stop()
+    await trash_purger.stop()
+    await job_manager.stop()
+    await loop_monitor.stop()
+    mark_process_dead()
+    await log_pipeline.stop()
 
 
-app = FastAPI(title=APP_TITLE, version=APP_VERSION, description=APP_DESCRIPTION)
+app = FastAPI(
+    title=APP_TITLE,
+    version=APP_VERSION,
+    description=APP_DESCRIPTION,
+    lifespan=lifespan,
+)
+
+app.add_middleware(RateLimitMiddleware)
 
 app.add_middleware(AuthMiddleware)
 
@@ -25,13 +99,31 @@ app.add_middleware(
     allow_headers=["authorization", "x-api-key", "range", "content-type", "accept"],
 )
 
+app.add_middleware(ProfilingMiddleware)
+
+app.add_middleware(MetricsMiddleware)
+
+app.add_middleware(RequestLogMiddleware)
+
 app.include_router(users_router)
 app.include_router(directories_router)
 app.include_router(files_router)
 app.include_router(operations_router)
 app.include_router(media_router)
 app.include_router(shared_router)
+app.include_router(share_links_router)
+app.include_router(jobs_router)
+app.include_router(trash_router)
+app.include_router(integrity_router)
+app.include_router(metrics_router)
+app.include_router(changes_router)
 
 
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=4000)
+    uvicorn.run(
+        "main:app",
+        host="0.0.0.0",
+        port=4000,
+        workers=WEB_CONCURRENCY,
+        access_log=False,
+    )
@@ -0,0 +1,434 @@
+import asyncio
+import base64
+import json
+import logging
+import os
+import subprocess
+import time
+from datetime import datetime, timezone
+from io import BytesIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Optional
+
+import pypdfium2 as pdfium
+from PIL import Image, UnidentifiedImageError
+
+import file_events
+from config import (
+    BASE_PATH,
+    IMAGE_FORMATS,
+    VIDEO_FORMATS,
+    METADATA_WORKERS,
+    METADATA_QUEUE_SIZE,
+    METADATA_HEADER_BYTES,
+    METADATA_MAX_HEADER_BYTES,
+    METADATA_VIDEO_PROBE_BYTES,
+    METADATA_RESCAN_INTERVAL,
+)
+from crypto_utils import (
+    decrypt_stream_range,
+    DecryptedReader,
+    get_plaintext_size,
+    is_encrypted_file,
+)
+from indexer import FileIndexer, subtree
+from pdf_pages import PDFIUM_LOCK
+from state_db import connect, transaction
+
+logger = logging.getLogger(__name__)
+
+PROBE_TIMEOUT = 60
+
+EXIF_IFD = 0x8769
+EXIF_DATETIME = 0x0132
+EXIF_ORIENTATION = 0x0112
+EXIF_DATETIME_ORIGINAL = 0x9003
+EXIF_OFFSET_TIME_ORIGINAL = 0x9011
+
+METADATA_FIELDS = ("width", "height", "taken_at", "duration", "codec", "pages")
+GALLERY_KINDS = ("image", "video")
+
+# Files without a capture date sort by modification time. The timeline
+# index is built on this exact expression, so queries must repeat it.
+SORT_KEY = "COALESCE(taken_at, mtime_ns / 1000000000.0)"
+
+SCHEMA = f"""
+CREATE TABLE IF NOT EXISTS media (
+    user_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    parent TEXT NOT NULL,
+    kind TEXT NOT NULL,
+    file_size INTEGER NOT NULL,
+    mtime_ns INTEGER NOT NULL,
+    width INTEGER,
+    height INTEGER,
+    taken_at REAL,
+    duration REAL,
+    codec TEXT,
+    pages INTEGER,
+    error TEXT,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (user_id, path)
+);
+CREATE INDEX IF NOT EXISTS media_parent ON media (user_id, parent);
+CREATE INDEX IF NOT EXISTS media_timeline ON media (user_id, {SORT_KEY}, path);
+"""
+
+
+def media_kind(path: Path) -> Optional[str]:
+    suffix = path.suffix.lower()
+    if suffix in IMAGE_FORMATS and suffix not in (".svg", ".ico"):
+        return "image"
+    if suffix in VIDEO_FORMATS:
+        return "video"
+    if suffix == ".pdf":
+        return "pdf"
+    return None
+
+
+def _read_prefix(path: Path, length: int) -> bytes:
+    if not is_encrypted_file(path):
+        with path.open("rb") as f:
+            return f.read(length)
+    end = min(length, get_plaintext_size(path)) - 1
+    if end < 0:
+        return b""
+    return b"".join(decrypt_stream_range(path, 0, end))
+
+
+def _parse_exif_time(value: str, offset: Optional[str]) -> Optional[float]:
+    try:
+        taken = datetime.strptime(value.strip("\x00 "), "%Y:%m:%d %H:%M:%S")
+        if offset:
+            taken = datetime.fromisoformat(taken.isoformat() + offset.strip("\x00 "))
+        else:
+            taken = taken.replace(tzinfo=timezone.utc)
+        return taken.timestamp()
+    except ValueError:
+        return None
+
+
+def _image_metadata(path: Path) -> dict:
+    # Dimensions and EXIF sit in the first few kilobytes of an image; only
+    # read further when the header turns out to be larger.
+    length = METADATA_HEADER_BYTES
+    while True:
+        header = _read_prefix(path, length)
+        try:
+            with Image.open(BytesIO(header)) as img:
+                width, height = img.size
+                exif = img.getexif()
+                codec = (img.format or "").lower() or None
+            break
+        except (UnidentifiedImageError, OSError, SyntaxError):
+            if len(header) < length or length >= METADATA_MAX_HEADER_BYTES:
+                raise
+            length *= 4
+
+    details = exif.get_ifd(EXIF_IFD)
+    taken = details.get(EXIF_DATETIME_ORIGINAL) or exif.get(EXIF_DATETIME)
+    if exif.get(EXIF_ORIENTATION) in (5, 6, 7, 8):
+        width, height = height, width
+    return {
+        "width": width,
+        "height": height,
+        "codec": codec,
+        "taken_at": (
+            _parse_exif_time(taken, details.get(EXIF_OFFSET_TIME_ORIGINAL))
+            if isinstance(taken, str)
+            else None
+        ),
+    }
+
+
+def _probe_source(path: Path) -> tuple[Path, bool]:
+    if not is_encrypted_file(path):
+        return path, False
+    # A sparse copy holding only the decrypted head and tail is enough for
+    # ffprobe: container headers (and the MP4 moov box) live at either end.
+    size = get_plaintext_size(path)
+    head_end = min(METADATA_VIDEO_PROBE_BYTES, size) - 1
+    tail_start = max(head_end + 1, size - METADATA_VIDEO_PROBE_BYTES)
+    with NamedTemporaryFile(suffix=path.suffix, delete=False) as tmp:
+        tmp.truncate(size)
+        if head_end >= 0:
+            for chunk in decrypt_stream_range(path, 0, head_end):
+                tmp.write(chunk)
+        if tail_start < size:
+            tmp.seek(tail_start)
+            for chunk in decrypt_stream_range(path, tail_start, size - 1):
+                tmp.write(chunk)
+    return Path(tmp.name), True
+
+
+def _video_metadata(path: Path) -> dict:
+    source, temporary = _probe_source(path)
+    try:
+        result = subprocess.run(
+            [
+                "ffprobe",
+                "-v",
+                "error",
+                "-show_entries",
+                "format=duration:format_tags=creation_time"
+                ":stream=codec_type,codec_name,width,height",
+                "-of",
+                "json",
+                str(source),
+            ],
+            capture_output=True,
+            timeout=PROBE_TIMEOUT,
+        )
+    finally:
+        if temporary:
+            source.unlink(missing_ok=True)
+    if result.returncode != 0:
+        raise ValueError(result.stderr.decode(errors="replace").strip())
+
+    probe = json.loads(result.stdout)
+    fmt = probe.get("format", {})
+    video = next(
+        (s for s in probe.get("streams", []) if s.get("codec_type") == "video"), {}
+    )
+    created = fmt.get("tags", {}).get("creation_time")
+    try:
+        taken_at = (
+            datetime.fromisoformat(created.replace("Z", "+00:00")).timestamp()
+            if created
+            else None
+        )
+    except ValueError:
+        taken_at = None
+    return {
+        "width": video.get("width"),
+        "height": video.get("height"),
+        "codec": video.get("codec_name"),
+        "duration": float(fmt["duration"]) if "duration" in fmt else None,
+        "taken_at": taken_at,
+    }
+
+
+def _pdf_metadata(path: Path) -> dict:
+    reader = DecryptedReader(path) if is_encrypted_file(path) else path.open("rb")
+    with reader, PDFIUM_LOCK:
+        pdf = pdfium.PdfDocument(reader)
+        try:
+            return {"pages": len(pdf)}
+        finally:
+            pdf.close()
+
+
+EXTRACTORS = {"image": _image_metadata, "video": _video_metadata, "pdf": _pdf_metadata}
+
+
+def encode_cursor(sort_at: float, path: str) -> str:
+    return base64.urlsafe_b64encode(json.dumps([sort_at, path]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[float, str]:
+    try:
+        sort_at, path = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return float(sort_at), str(path)
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+
+COLUMNS = (
+    "user_id",
+    "path",
+    "parent",
+    "kind",
+    "file_size",
+    "mtime_ns",
+    *METADATA_FIELDS,
+    "error",
+    "indexed_at",
+)
+UPSERT = (
+    f"INSERT OR REPLACE INTO media ({', '.join(COLUMNS)})"
+    f" VALUES ({', '.join('?' * len(COLUMNS))})"
+)
+IN_SUBTREE = "user_id = ? AND (path = ? OR (path >= ? AND path < ?))"
+
+
+class MediaIndex(FileIndexer):
+    name = "media"
+
+    def accepts(self, path: Path) -> bool:
+        return media_kind(path) is not None
+
+    def setup(self) -> None:
+        connect().executescript(SCHEMA)
+
+    def extract(self, full_path: Path) -> dict:
+        return EXTRACTORS[media_kind(full_path)](full_path)
+
+    def store(
+        self,
+        user_id: str,
+        path: str,
+        st: os.stat_result,
+        result: Optional[dict],
+        error: Optional[str],
+    ) -> None:
+        metadata = result or {}
+        with transaction() as conn:
+            conn.execute(
+                UPSERT,
+                (
+                    user_id,
+                    path,
+                    str(Path(path).parent),
+                    media_kind(Path(path)),
+                    st.st_size,
+                    st.st_mtime_ns,
+                    *(metadata.get(field) for field in METADATA_FIELDS),
+                    error,
+                    time.time(),
+                ),
+            )
+
+    def known(self, user_id: str, path: str) -> dict[str, tuple[int, int]]:
+        return {
+            row["path"]: (row["file_size"], row["mtime_ns"])
+            for row in connect().execute(
+                f"SELECT path, file_size, mtime_ns FROM media WHERE {IN_SUBTREE}",
+                (user_id, path, *subtree(path)),
+            )
+        }
+
+    def drop(self, user_id: str, paths: list[str]) -> None:
+        with transaction() as conn:
+            conn.executemany(
+                "DELETE FROM media WHERE user_id = ? AND path = ?",
+                [(user_id, gone) for gone in paths],
+            )
+
+    def forget(self, user_id: str, path: str) -> None:
+        with transaction() as conn:
+            conn.execute(
+                f"DELETE FROM media WHERE {IN_SUBTREE}",
+                (user_id, path, *subtree(path)),
+            )
+
+    def relocate(self, user_id: str, path: str, new_path: str, copy: bool) -> None:
+        params = (user_id, path, *subtree(path))
+        with transaction() as conn:
+            rows = conn.execute(
+                f"SELECT * FROM media WHERE {IN_SUBTREE}", params
+            ).fetchall()
+            if not copy:
+                conn.execute(f"DELETE FROM media WHERE {IN_SUBTREE}", params)
+            relocated = []
+            for row in rows:
+                values = dict(row)
+                values["path"] = new_path + row["path"][len(path) :]
+                values["parent"] = str(Path(values["path"]).parent)
+                relocated.append(tuple(values[column] for column in COLUMNS))
+            conn.executemany(UPSERT, relocated)
+
+    async def gallery(
+        self,
+        user_id: str,
+        path: str,
+        kinds: tuple[str, ...],
+        limit: int,
+        cursor: Optional[tuple[float, str]],
+    ) -> dict:
+        rows = await asyncio.to_thread(
+            self._gallery, user_id, path, kinds, limit + 1, cursor
+        )
+        items = []
+        for row in rows[:limit]:
+            item = {
+                "id": row["path"],
+                "name": Path(row["path"]).name,
+                "kind": row["kind"],
+                "date": row["sort_at"],
+            }
+            for field in METADATA_FIELDS:
+                if row[field] is not None:
+                    item[field] = row[field]
+            items.append(item)
+        last = rows[limit - 1] if len(rows) > limit else None
+        return {
+            "items": items,
+            "next_cursor": (
+                encode_cursor(last["sort_at"], last["path"]) if last else None
+            ),
+            "pending": self.pending(user_id),
+        }
+
+    def _gallery(
+        self,
+        user_id: str,
+        path: str,
+        kinds: tuple[str, ...],
+        limit: int,
+        cursor: Optional[tuple[float, str]],
+    ) -> list:
+        # Keyset pagination over the timeline index: each page is a short
+        # index range scan no matter how deep into the timeline it starts.
+        # The index is forced because the planner prefers the primary key
+        # for the path range and would then sort the whole subtree.
+        query = (
+            f"SELECT *, {SORT_KEY} AS sort_at FROM media INDEXED BY media_timeline"
+            " WHERE user_id = ? AND path >= ? AND path < ?"
+            f" AND kind IN ({', '.join('?' * len(kinds))})"
+        )
+        params = [user_id, *subtree(path), *kinds]
+        if cursor is not None:
+            # The plain bound on the sort key is what SQLite turns into an
+            # index range; the row value only breaks ties.
+            query += f" AND {SORT_KEY} <= ? AND ({SORT_KEY}, path) < (?, ?)"
+            params.extend((cursor[0], *cursor))
+        query += f" ORDER BY {SORT_KEY} DESC, path DESC LIMIT ?"
+        params.append(limit)
+        return connect().execute(query, params).fetchall()
+
+    async def annotate(
+        self, user_id: str, folder: str, items: list[dict]
+    ) -> list[dict]:
+        stale = await asyncio.to_thread(self._annotate, user_id, folder, items)
+        for path in stale:
+            self.enqueue(user_id, path)
+        return items
+
+    def _annotate(self, user_id: str, folder: str, items: list[dict]) -> list[str]:
+        rows = {
+            row["path"]: row
+            for row in connect()
+            .execute(
+                "SELECT * FROM media WHERE user_id = ? AND parent = ?",
+                (user_id, folder),
+            )
+            .fetchall()
+        }
+        user_path = BASE_PATH / user_id
+        stale = []
+        for item in items:
+            if item["is_dir"] or not media_kind(Path(item["name"])):
+                continue
+            row = rows.get(item["id"])
+            try:
+                st = (user_path / item["id"]).stat()
+            except FileNotFoundError:
+                continue
+            if (
+                row is None
+                or row["file_size"] != st.st_size
+                or row["mtime_ns"] != st.st_mtime_ns
+            ):
+                stale.append(item["id"])
+                continue
+            for field in METADATA_FIELDS:
+                if row[field] is not None:
+                    item[field] = row[field]
+        return stale
+
+
+media_index = MediaIndex(
+    METADATA_WORKERS, METADATA_QUEUE_SIZE, METADATA_RESCAN_INTERVAL
+)
+file_events.subscribe(media_index.handle)
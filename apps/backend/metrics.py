@@ -0,0 +1,180 @@
+import asyncio
+import os
+import time
+from contextlib import contextmanager
+from typing import Iterator, Optional
+
+from prometheus_client import (
+    REGISTRY,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+MULTIPROCESS = "PROMETHEUS_MULTIPROC_DIR" in os.environ
+
+LATENCY_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+LOOP_LAG_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 5.0)
+LOOP_LAG_INTERVAL = 0.5
+
+REQUEST_DURATION = Histogram(
+    "pidrive_http_request_duration_seconds",
+    "Time from request start until the response body is fully sent.",
+    ["method", "route", "status"],
+    buckets=LATENCY_BUCKETS,
+)
+RESPONSE_BYTES = Counter(
+    "pidrive_http_response_bytes",
+    "Response body bytes sent to clients.",
+    ["route"],
+)
+CRYPTO_BYTES = Counter(
+    "pidrive_crypto_bytes",
+    "Plaintext bytes encrypted or decrypted.",
+    ["operation", "format"],
+)
+THUMBNAIL_SECONDS = Histogram(
+    "pidrive_thumbnail_generation_seconds",
+    "Time spent producing a thumbnail.",
+    ["kind"],
+    buckets=LATENCY_BUCKETS,
+)
+ZIP_SECONDS = Histogram(
+    "pidrive_zip_build_seconds",
+    "Time spent writing a ZIP archive.",
+    buckets=LATENCY_BUCKETS,
+)
+DIRECTORY_ENTRIES = Counter(
+    "pidrive_directory_entries_scanned",
+    "Directory entries read while serving requests.",
+    ["operation"],
+)
+CACHE_REQUESTS = Counter(
+    "pidrive_cache_requests",
+    "Cache lookups by outcome.",
+    ["cache", "result"],
+)
+RATE_LIMITED = Counter(
+    "pidrive_rate_limited_requests",
+    "Requests rejected with 429 by the rate limiter.",
+    ["endpoint_class", "reason"],
+)
+LOOP_LAG = Histogram(
+    "pidrive_event_loop_lag_seconds",
+    "How late the event loop woke up a periodic timer.",
+    buckets=LOOP_LAG_BUCKETS,
+)
+LOOP_LAG_CURRENT = Gauge(
+    "pidrive_event_loop_lag_current_seconds",
+    "Most recent event loop lag sample.",
+    multiprocess_mode="max",
+)
+
+
+def record_cache(cache: str, hit: bool) -> None:
+    CACHE_REQUESTS.labels(cache, "hit" if hit else "miss").inc()
+
+
+@contextmanager
+def timed(histogram, *labels: str) -> Iterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        metric = histogram.labels(*labels) if labels else histogram
+        metric.observe(time.perf_counter() - started)
+
+
+def render(extra: Optional[CollectorRegistry] = None) -> bytes:
+    if MULTIPROCESS:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    output = generate_latest(registry)
+    if extra is not None:
+        output += generate_latest(extra)
+    return output
+
+
+def mark_process_dead() -> None:
+    if MULTIPROCESS:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+class MetricsMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        status = 500
+        sent = 0
+
+        async def send_with_metrics(message) -> None:
+            nonlocal status, sent
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            elif message["type"] == "http.response.body":
+                sent += len(message.get("body", b""))
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_metrics)
+        finally:
+            route = getattr(scope.get("route"), "path", "unmatched")
+            REQUEST_DURATION.labels(scope["method"], route, str(status)).observe(
+                time.perf_counter() - started
+            )
+            if sent:
+                RESPONSE_BYTES.labels(route).inc(sent)
+
+
+class LoopLagMonitor:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            expected = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            lag = max(0.0, loop.time() - expected)
+            LOOP_LAG.observe(lag)
+            LOOP_LAG_CURRENT.set(lag)
+
+
+loop_monitor = LoopLagMonitor(LOOP_LAG_INTERVAL)
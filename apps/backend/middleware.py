@@ -1,66 +1,131 @@
-from fastapi import Request
-from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import JSONResponse
+import hashlib
+import hmac
 import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
 from jose import jwt, JWTError
 from dotenv import load_dotenv
+from starlette.datastructures import Headers
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from config import AUTH_CACHE_SIZE, AUTH_CACHE_TTL
+from metrics import record_cache
 
 
 load_dotenv()
 JWT_SECRET = os.getenv("JWT_SECRET")
 
+PUBLIC_PREFIXES = ("/shared/", "/share/", "/metrics")
+
+
+class TokenCache:
+    def __init__(self, max_size: int, ttl: int):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._entries: OrderedDict[bytes, tuple[dict, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: bytes) -> Optional[dict]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            payload, expires_at = entry
+            if expires_at <= time.time():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return payload
+
+    def put(self, key: bytes, payload: dict) -> None:
+        expires_at = time.time() + self.ttl
+        exp = payload.get("exp")
+        if isinstance(exp, (int, float)):
+            expires_at = min(expires_at, exp)
+        with self._lock:
+            self._entries[key] = (payload, expires_at)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+
+token_cache = TokenCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+
+class AuthMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or scope["path"].startswith(PUBLIC_PREFIXES):
+            await self.app(scope, receive, send)
+            return
 
-class AuthMiddleware(BaseHTTPMiddleware):
-    async def dispatch(self, request: Request, call_next):
         try:
-            if request.url.path.startswith("/shared/") or request.url.path.startswith(
-                "/share/"
-            ):
-                response = await call_next(request)
-                return response
-
-            auth_header = request.headers.get("authorization")
-            if not auth_header:
-                return JSONResponse(
-                    status_code=401, content={"detail": "Missing Authorization header"}
-                )
-
-            api_key = request.headers.get("x-api-key")
-            if not api_key:
-                return JSONResponse(
-                    status_code=403, content={"detail": "Invalid or missing API Key"}
-                )
-
-            incoming_token = auth_header.split(" ")[1] if " " in auth_header else None
-
-            if not incoming_token:
-                return JSONResponse(
-                    status_code=401, content={"detail": "Invalid token format"}
-                )
-            if api_key != os.environ.get("API_KEY"):
-                return JSONResponse(
-                    status_code=403, content={"detail": "Invalid or missing API Key"}
-                )
-
-            payload = verify_jwt_token(incoming_token)
-            if not payload:
-                return JSONResponse(
-                    status_code=401, content={"detail": "Invalid token"}
-                )
-            request.state.user_id = payload.get("sub")
-            response = await call_next(request)
-            return response
+            user_id, error = authenticate(Headers(scope=scope))
         except Exception as e:
-            return JSONResponse(
+            error = JSONResponse(
                 status_code=500, content={"detail": f"Authentication error: {str(e)}"}
             )
+        if error is not None:
+            await error(scope, receive, send)
+            return
+
+        scope.setdefault("state", {})["user_id"] = user_id
+        await self.app(scope, receive, send)
+
+
+def authenticate(headers: Headers) -> tuple[Optional[str], Optional[JSONResponse]]:
+    auth_header = headers.get("authorization")
+    if not auth_header:
+        return None, JSONResponse(
+            status_code=401, content={"detail": "Missing Authorization header"}
+        )
+
+    api_key = headers.get("x-api-key")
+    if not api_key:
+        return None, JSONResponse(
+            status_code=403, content={"detail": "Invalid or missing API Key"}
+        )
+
+    incoming_token = auth_header.split(" ")[1] if " " in auth_header else None
+
+    if not incoming_token:
+        return None, JSONResponse(
+            status_code=401, content={"detail": "Invalid token format"}
+        )
+    if not hmac.compare_digest(
+        api_key.encode(), os.environ.get("API_KEY", "").encode()
+    ):
+        return None, JSONResponse(
+            status_code=403, content={"detail": "Invalid or missing API Key"}
+        )
+
+    payload = verify_jwt_token(incoming_token)
+    if not payload:
+        return None, JSONResponse(status_code=401, content={"detail": "Invalid token"})
+    return payload.get("sub"), None
 
 
 def verify_jwt_token(token: str):
+    key = hashlib.sha256(token.encode()).digest()
+    payload = token_cache.get(key)
+    record_cache("auth_token", payload is not None)
+    if payload is not None:
+        return payload
     try:
         payload = jwt.decode(
             token, JWT_SECRET, algorithms=["HS256"], audience="authenticated"
         )
-        return payload
     except JWTError as e:
         return None
+    token_cache.put(key, payload)
+    return payload
@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Literal, Optional
 from pydantic import BaseModel, Field
 
 
@@ -6,6 +6,7 @@ class DeleteItemsRequest(BaseModel):
     items: list[str] | dict = Field(
         ..., description="List of item paths or dict with items"
     )
+    atomic: bool = Field(False, description="Roll back every item if any item fails")
 
 
 class RenameRequest(BaseModel):
@@ -18,6 +19,7 @@ class MoveItemsRequest(BaseModel):
         ..., description="List of item paths or dict with items"
     )
     destination: str = Field(..., description="Destination directory path")
+    atomic: bool = Field(False, description="Roll back every item if any item fails")
 
 
 class CopyItemsRequest(BaseModel):
@@ -25,6 +27,23 @@ class CopyItemsRequest(BaseModel):
         ..., description="List of item paths or dict with items"
     )
     destination: str = Field(..., description="Destination directory path")
+    atomic: bool = Field(False, description="Roll back every item if any item fails")
+
+
+class JobRequest(BaseModel):
+    kind: Literal["move", "copy", "delete", "zip", "extract"] = Field(
+        ..., description="Operation to run in the background"
+    )
+    items: list[str] = Field(..., description="List of item paths")
+    destination: Optional[str] = Field(
+        None,
+        description="Destination directory path for move and copy, and for"
+        " extract, where it defaults to each archive's own folder",
+    )
+
+
+class TrashEntriesRequest(BaseModel):
+    ids: list[str] = Field(..., description="List of trash entry ids")
 
 
 class MessageResponse(BaseModel):
@@ -34,6 +53,7 @@ class MessageResponse(BaseModel):
 class StorageResponse(BaseModel):
     message: str
     storage: int
+    physical_storage: Optional[int] = None
 
 
 class FileMetadataResponse(BaseModel):
@@ -46,6 +66,12 @@ class FileMetadataResponse(BaseModel):
     accessed_at: float
     size: int
     no_items: Optional[int] = None
+    width: Optional[int] = None
+    height: Optional[int] = None
+    taken_at: Optional[float] = None
+    duration: Optional[float] = None
+    codec: Optional[str] = None
+    pages: Optional[int] = None
 
 
 class UploadResponse(BaseModel):
@@ -58,3 +84,13 @@ class DownloadItem(BaseModel):
     id: str
     name: str
     is_dir: bool
+
+
+class ShareRequest(BaseModel):
+    path: str = Field(..., description="File or directory to share")
+    permissions: list[Literal["view", "download"]] = Field(
+        ["view", "download"], description="What the link allows"
+    )
+    expires_in: Optional[int] = Field(
+        None, gt=0, description="Lifetime of the link in seconds"
+    )
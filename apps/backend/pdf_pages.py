@@ -0,0 +1,232 @@
+import asyncio
+import logging
+import threading
+from collections import OrderedDict
+from io import BytesIO
+from pathlib import Path
+from typing import Optional
+
+import pypdfium2 as pdfium
+
+from config import (
+    PDF_POOL_SIZE,
+    PDF_PAGE_CACHE_BYTES,
+    PDF_MAX_WIDTH,
+    PDF_TILE_SIZE,
+)
+from crypto_utils import DecryptedReader, is_encrypted_file
+from metrics import record_cache
+from profiling import stage
+
+logger = logging.getLogger(__name__)
+
+THUMBNAIL_SIZE = 512
+PAGE_QUALITY = 85
+
+# PDFium is not thread-safe, not even across different documents, so every
+# call into it in this process (opening, rendering, closing) holds this lock.
+PDFIUM_LOCK = threading.Lock()
+
+
+class PageNotFound(Exception):
+    pass
+
+
+def _file_key(path: Path) -> tuple[str, int, int]:
+    st = path.stat()
+    return str(path), st.st_size, st.st_mtime_ns
+
+
+class _Document:
+    def __init__(self, path: Path):
+        # Pages are read on demand, so only the parts of the file PDFium
+        # touches are ever decrypted and nothing is written to disk.
+        self.reader = (
+            DecryptedReader(path) if is_encrypted_file(path) else path.open("rb")
+        )
+        try:
+            self.pdf = pdfium.PdfDocument(self.reader)
+        except BaseException:
+            self.reader.close()
+            raise
+
+    def close(self) -> None:
+        self.pdf.close()
+        self.reader.close()
+
+
+class PdfPages:
+    def __init__(self, pool_size: int, cache_bytes: int):
+        self.pool_size = pool_size
+        self.cache_bytes = cache_bytes
+        self._documents: OrderedDict[tuple, _Document] = OrderedDict()
+        self._pages: OrderedDict[tuple, bytes] = OrderedDict()
+        self._cached = 0
+        self._renders: dict[tuple, asyncio.Future] = {}
+
+    async def stop(self) -> None:
+        await asyncio.to_thread(self._close_all)
+        self._pages.clear()
+        self._cached = 0
+
+    def _close_all(self) -> None:
+        with PDFIUM_LOCK:
+            while self._documents:
+                _, document = self._documents.popitem()
+                document.close()
+
+    # Callers must hold PDFIUM_LOCK.
+    def _document(self, key: tuple, path: Path) -> _Document:
+        document = self._documents.get(key)
+        if document is not None:
+            self._documents.move_to_end(key)
+            return document
+        document = _Document(path)
+        self._documents[key] = document
+        while len(self._documents) > self.pool_size:
+            _, evicted = self._documents.popitem(last=False)
+            evicted.close()
+        return document
+
+    async def info(self, path: Path) -> dict:
+        key = await asyncio.to_thread(_file_key, path)
+        return await asyncio.to_thread(self._info, key, path)
+
+    def _info(self, key: tuple, path: Path) -> dict:
+        with PDFIUM_LOCK:
+            pdf = self._document(key, path).pdf
+            sizes = [pdf.get_page_size(number) for number in range(len(pdf))]
+        return {
+            "pages": len(sizes),
+            "sizes": [[round(w, 2), round(h, 2)] for w, h in sizes],
+            "max_width": PDF_MAX_WIDTH,
+            "tile_size": PDF_TILE_SIZE,
+        }
+
+    async def page(
+        self,
+        path: Path,
+        number: int,
+        width: int,
+        tile: Optional[tuple[int, int]] = None,
+    ) -> bytes:
+        return await self._cached_render(path, number, width, tile, False)
+
+    async def thumbnail(self, path: Path) -> bytes:
+        return await self._cached_render(path, 0, THUMBNAIL_SIZE, None, True)
+
+    async def _cached_render(
+        self,
+        path: Path,
+        number: int,
+        width: int,
+        tile: Optional[tuple[int, int]],
+        thumbnail: bool,
+    ) -> bytes:
+        key = (
+            *await asyncio.to_thread(_file_key, path),
+            number,
+            width,
+            tile,
+            thumbnail,
+        )
+        image = self._pages.get(key)
+        record_cache("pdf_page", image is not None)
+        if image is not None:
+            self._pages.move_to_end(key)
+            return image
+
+        render = self._renders.get(key)
+        if render is None:
+            render = asyncio.ensure_future(
+                asyncio.to_thread(
+                    self._render, key[:3], path, number, width, tile, thumbnail
+                )
+            )
+            render.add_done_callback(lambda _: self._renders.pop(key, None))
+            self._renders[key] = render
+        image = await asyncio.shield(render)
+        if key not in self._pages:
+            self._remember(key, image)
+        return image
+
+    def _remember(self, key: tuple, image: bytes) -> None:
+        if len(image) > self.cache_bytes:
+            return
+        self._pages[key] = image
+        self._cached += len(image)
+        while self._cached > self.cache_bytes:
+            _, evicted = self._pages.popitem(last=False)
+            self._cached -= len(evicted)
+
+    def _render(
+        self,
+        file_key: tuple,
+        path: Path,
+        number: int,
+        width: int,
+        tile: Optional[tuple[int, int]],
+        thumbnail: bool,
+    ) -> bytes:
+        with stage("render"), PDFIUM_LOCK:
+            pdf = self._document(file_key, path).pdf
+            if not 0 <= number < len(pdf):
+                raise PageNotFound(f"Page {number} does not exist")
+            page = pdf[number]
+            try:
+                page_width, page_height = page.get_size()
+                scale = width / page_width
+                crop = (0, 0, 0, 0)
+                if tile is not None:
+                    crop = _tile_crop(tile, scale, page_width, page_height)
+                bitmap = page.render(scale=scale, crop=crop)
+                try:
+                    # Copied so the PDFium bitmap can be freed under the lock.
+                    image = bitmap.to_pil().copy()
+                finally:
+                    bitmap.close()
+            finally:
+                page.close()
+
+        out = BytesIO()
+        if thumbnail:
+            image.thumbnail((THUMBNAIL_SIZE, THUMBNAIL_SIZE))
+            image.save(out, "PNG")
+        else:
+            image.convert("RGB").save(out, "JPEG", quality=PAGE_QUALITY)
+        return out.getvalue()
+
+
+def check_page_request(
+    width: int, column: Optional[int], row: Optional[int]
+) -> Optional[tuple[int, int]]:
+    if not 0 < width <= PDF_MAX_WIDTH:
+        raise ValueError(f"Width must be between 1 and {PDF_MAX_WIDTH}")
+    if (column is None) != (row is None):
+        raise ValueError("Tiles need both col and row")
+    return (column, row) if column is not None else None
+
+
+# Tiles are PDF_TILE_SIZE squares of the page rendered at `scale`, numbered
+# from the top left; the crop is expressed in PDF points cut from each side.
+def _tile_crop(
+    tile: tuple[int, int], scale: float, page_width: float, page_height: float
+) -> tuple[float, float, float, float]:
+    column, row = tile
+    full_width = page_width * scale
+    full_height = page_height * scale
+    left = column * PDF_TILE_SIZE
+    top = row * PDF_TILE_SIZE
+    if column < 0 or row < 0 or left >= full_width or top >= full_height:
+        raise PageNotFound(f"Tile {column},{row} is outside the page")
+    right = min(left + PDF_TILE_SIZE, full_width)
+    bottom = min(top + PDF_TILE_SIZE, full_height)
+    return (
+        left / scale,
+        page_height - bottom / scale,
+        page_width - right / scale,
+        top / scale,
+    )
+
+
+pdf_pages = PdfPages(PDF_POOL_SIZE, PDF_PAGE_CACHE_BYTES)
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import os
+import random
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from contextvars import ContextVar
+from pathlib import Path
+from typing import Optional
+
+from starlette.types import ASGIApp, Message, Receive, Scope, Send
+
+from config import (
+    PROFILE_INTERVAL,
+    PROFILE_MAX_FILES,
+    PROFILE_PATH,
+    PROFILE_SAMPLE_RATE,
+    PROFILE_SLOW_SECONDS,
+    SERVER_TIMING,
+)
+
+logger = logging.getLogger(__name__)
+
+PROFILING = PROFILE_SAMPLE_RATE > 0 or PROFILE_SLOW_SECONDS > 0
+
+IDLE_LEAVES = {("_worker", "thread.py"), ("dequeue", "handlers.py")}
+
+_timings: ContextVar[Optional[list]] = ContextVar("request_timings", default=None)
+
+
+class _Stage:
+    __slots__ = ("name", "_timings", "_started")
+
+    def __init__(self, name: str):
+        self.name = name
+
+    def __enter__(self) -> None:
+        self._timings = _timings.get()
+        if self._timings is not None:
+            self._started = time.perf_counter()
+
+    def __exit__(self, *exc) -> None:
+        if self._timings is not None:
+            self._timings.append((self.name, time.perf_counter() - self._started))
+
+
+def stage(name: str) -> _Stage:
+    return _Stage(name)
+
+
+def server_timing_header(timings: list, total: float) -> bytes:
+    durations: dict[str, float] = {}
+    for name, seconds in list(timings):
+        durations[name] = durations.get(name, 0.0) + seconds
+    durations["app"] = total
+    return ", ".join(
+        f"{name};dur={seconds * 1000:.1f}" for name, seconds in durations.items()
+    ).encode("latin-1")
+
+
+def _frame_label(code) -> str:
+    filename = os.path.basename(code.co_filename)
+    return f"{code.co_name} ({filename}:{code.co_firstlineno})".replace(";", ":")
+
+
+def _code_key(code) -> tuple[str, str]:
+    return code.co_name, os.path.basename(code.co_filename)
+
+
+def _is_idle_worker(codes: list) -> bool:
+    leaf = _code_key(codes[0])
+    if leaf in IDLE_LEAVES:
+        return True
+    return (
+        leaf == ("wait", "threading.py")
+        and len(codes) > 1
+        and _code_key(codes[1]) == ("get", "queue.py")
+    )
+
+
+class StackSampler:
+    def __init__(self, interval: float):
+        self.interval = interval
+        self._active: dict[int, Counter] = {}
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._thread: Optional[threading.Thread] = None
+
+    def begin(self) -> Counter:
+        samples: Counter = Counter()
+        with self._lock:
+            self._active[id(samples)] = samples
+            if self._thread is None:
+                self._thread = threading.Thread(
+                    target=self._run, name="stack-sampler", daemon=True
+                )
+                self._thread.start()
+            self._wakeup.set()
+        return samples
+
+    def end(self, samples: Counter) -> None:
+        with self._lock:
+            self._active.pop(id(samples), None)
+
+    def _run(self) -> None:
+        own = threading.get_ident()
+        while True:
+            self._wakeup.wait()
+            with self._lock:
+                active = list(self._active.values())
+                if not active:
+                    self._wakeup.clear()
+                    continue
+            stacks = self._sample(own)
+            for samples in active:
+                samples.update(stacks)
+            time.sleep(self.interval)
+
+    def _sample(self, own: int) -> list[str]:
+        names = {thread.ident: thread.name for thread in threading.enumerate()}
+        stacks = []
+        for ident, frame in sys._current_frames().items():
+            if ident == own:
+                continue
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            if not codes or _is_idle_worker(codes):
+                continue
+            labels = [_frame_label(code) for code in codes]
+            labels.append(names.get(ident, str(ident)).replace(";", ":"))
+            stacks.append(";".join(reversed(labels)))
+        return stacks
+
+
+def write_profile(samples: Counter, method: str, route: str, seconds: float) -> Path:
+    PROFILE_PATH.mkdir(parents=True, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9]+", "_", route).strip("_") or "root"
+    name = (
+        f"{time.time_ns() // 1_000_000}-{os.getpid()}-{method}-{slug}"
+        f"-{int(seconds * 1000)}ms.folded"
+    )
+    path = PROFILE_PATH / name
+    tmp_path = path.with_suffix(".tmp")
+    with tmp_path.open("w") as f:
+        for stack, count in samples.most_common():
+            f.write(f"{stack} {count}\n")
+    os.replace(tmp_path, path)
+
+    profiles = sorted(PROFILE_PATH.glob("*.folded"))
+    for old in profiles[: max(0, len(profiles) - PROFILE_MAX_FILES)]:
+        old.unlink(missing_ok=True)
+    return path
+
+
+sampler = StackSampler(PROFILE_INTERVAL)
+
+
+class ProfilingMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not (PROFILING or SERVER_TIMING):
+            await self.app(scope, receive, send)
+            return
+
+        started = time.perf_counter()
+        timings: list = []
+        token = _timings.set(timings)
+        chosen = random.random() < PROFILE_SAMPLE_RATE
+        samples = sampler.begin() if chosen or PROFILE_SLOW_SECONDS > 0 else None
+
+        async def send_with_timing(message: Message) -> None:
+            if SERVER_TIMING and message["type"] == "http.response.start":
+                header = server_timing_header(timings, time.perf_counter() - started)
+                message["headers"] = [
+                    *message.get("headers", []),
+                    (b"server-timing", header),
+                ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            _timings.reset(token)
+            if samples is not None:
+                sampler.end(samples)
+                elapsed = time.perf_counter() - started
+                slow = 0 < PROFILE_SLOW_SECONDS <= elapsed
+                if samples and (chosen or slow):
+                    route = getattr(scope.get("route"), "path", scope["path"])
+                    try:
+                        await asyncio.to_thread(
+                            write_profile, samples, scope["method"], route, elapsed
+                        )
+                    except OSError as e:
+                        logger.warning("Could not write request profile: %s", e)
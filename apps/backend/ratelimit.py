@@ -0,0 +1,217 @@
+import json
+import math
+import time
+from base64 import b64decode
+from collections import OrderedDict
+from itertools import islice
+from typing import Optional
+from urllib.parse import parse_qs
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send
+
+from config import (
+    BASE_PATH,
+    RATE_LIMIT_ANONYMOUS,
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_MAX_KEYS,
+    RATE_LIMITS,
+    SHARE_TOKENS_REQUIRED,
+    WEB_CONCURRENCY,
+)
+from metrics import RATE_LIMITED
+from share_tokens import InvalidShareToken, share_links
+
+ANONYMOUS = "anonymous"
+
+ENDPOINT_CLASSES = {
+    "/files/download": "download",
+    "/share/download": "download",
+    "/media/stream": "stream",
+    "/share/stream": "stream",
+    "/media/thumbnails": "thumbnail",
+    "/share/thumbnails": "thumbnail",
+    "/media/previews/sprite": "thumbnail",
+    "/media/previews/vtt": "thumbnail",
+    "/share/previews/sprite": "thumbnail",
+    "/share/previews/vtt": "thumbnail",
+    "/media/pdf/page": "thumbnail",
+    "/share/pdf/page": "thumbnail",
+    "/directories/search": "search",
+    "/directories/search/content": "search",
+}
+
+
+class RateLimited(Exception):
+    def __init__(self, reason: str, retry_after: float):
+        super().__init__(reason)
+        self.reason = reason
+        self.retry_after = retry_after
+
+
+class Limit:
+    def __init__(
+        self, rate: float, burst: float, per_key: float, total: float, workers: int
+    ):
+        # Each worker enforces its share, so the totals hold across the pool as
+        # long as the server spreads connections evenly.
+        self.rate = rate / workers
+        self.burst = max(1.0, burst / workers)
+        self.per_key = max(1, math.ceil(per_key / workers))
+        self.total = max(1, math.ceil(total / workers))
+        self.active = 0
+
+
+class Bucket:
+    __slots__ = ("tokens", "updated", "active")
+
+    def __init__(self, tokens: float):
+        self.tokens = tokens
+        self.updated = time.monotonic()
+        self.active = 0
+
+
+class RateLimiter:
+    def __init__(
+        self,
+        limits: dict[str, tuple[float, float, float, float]],
+        anonymous: tuple[float, float, float],
+        max_keys: int,
+        workers: int,
+    ):
+        self.limits = {
+            name: Limit(*values, workers=max(1, workers))
+            for name, values in limits.items()
+        }
+        # Only the rate and per-key concurrency of the anonymous limit apply;
+        # its requests still count against each class's total.
+        self.anonymous = Limit(*anonymous, 0, workers=max(1, workers))
+        self.max_keys = max_keys
+        self._buckets: OrderedDict[tuple[str, str], Bucket] = OrderedDict()
+
+    def acquire(self, endpoint_class: str, key: str) -> None:
+        limit = self.limits[endpoint_class]
+        own = self.anonymous if key == ANONYMOUS else limit
+        bucket = self._bucket(endpoint_class, key, own)
+
+        now = time.monotonic()
+        bucket.tokens = min(
+            own.burst, bucket.tokens + (now - bucket.updated) * own.rate
+        )
+        bucket.updated = now
+
+        if bucket.active >= own.per_key:
+            raise RateLimited("concurrency", 1)
+        if limit.active >= limit.total:
+            raise RateLimited("global_concurrency", 1)
+        if bucket.tokens < 1:
+            raise RateLimited("rate", (1 - bucket.tokens) / own.rate)
+
+        bucket.tokens -= 1
+        bucket.active += 1
+        limit.active += 1
+
+    def release(self, endpoint_class: str, key: str) -> None:
+        self.limits[endpoint_class].active -= 1
+        self._buckets[(endpoint_class, key)].active -= 1
+
+    def _bucket(self, endpoint_class: str, key: str, limit: Limit) -> Bucket:
+        bucket = self._buckets.get((endpoint_class, key))
+        if bucket is not None:
+            self._buckets.move_to_end((endpoint_class, key))
+            return bucket
+
+        bucket = self._buckets[(endpoint_class, key)] = Bucket(limit.burst)
+        # Forgetting a key refills its bucket, which only errs on the lenient
+        # side; keys with requests in flight are kept so release() finds them.
+        excess = len(self._buckets) - self.max_keys
+        for candidate in list(islice(self._buckets, max(0, excess))):
+            if self._buckets[candidate].active == 0:
+                del self._buckets[candidate]
+        return bucket
+
+
+rate_limiter = RateLimiter(
+    RATE_LIMITS, RATE_LIMIT_ANONYMOUS, RATE_LIMIT_MAX_KEYS, WEB_CONCURRENCY
+)
+
+
+def _is_zip(download_id: str) -> bool:
+    try:
+        items = json.loads(b64decode(download_id).decode("utf-8"))
+        return len(items) != 1 or bool(items[0]["is_dir"])
+    except Exception:
+        return False
+
+
+def classify(scope: Scope, query: dict[str, list[str]]) -> Optional[str]:
+    endpoint_class = ENDPOINT_CLASSES.get(scope["path"])
+    if endpoint_class == "download" and _is_zip(query.get("id", [""])[0]):
+        return "zip"
+    return endpoint_class
+
+
+def _is_user(user_id: str) -> bool:
+    return (
+        bool(user_id)
+        and not user_id.startswith(".")
+        and "/" not in user_id
+        and "\\" not in user_id
+        and (BASE_PATH / user_id).is_dir()
+    )
+
+
+def _share_key(query: dict[str, list[str]]) -> str:
+    # Share routes are unauthenticated, so a caller only gets a bucket of its
+    # own for an identity the route would accept: a valid token's link, or
+    # the owner named by a legacy share. Everything else, linkIds included
+    # since nothing checks them, is counted in the one anonymous bucket.
+    if "token" in query:
+        try:
+            return f"token:{share_links.verify(query['token'][0]).jti}"
+        except InvalidShareToken:
+            return ANONYMOUS
+    user_id = query.get("user_id", [""])[0]
+    if SHARE_TOKENS_REQUIRED or not _is_user(user_id):
+        return ANONYMOUS
+    return f"share:{user_id}"
+
+
+def limit_key(scope: Scope, query: dict[str, list[str]]) -> str:
+    if scope["path"].startswith("/share/"):
+        return _share_key(query)
+    return f"user:{scope['state']['user_id']}"
+
+
+class RateLimitMiddleware:
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        if scope["type"] != "http" or not RATE_LIMIT_ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        query = parse_qs(scope["query_string"].decode("latin-1"))
+        endpoint_class = classify(scope, query)
+        if endpoint_class is None:
+            await self.app(scope, receive, send)
+            return
+
+        key = limit_key(scope, query)
+        try:
+            rate_limiter.acquire(endpoint_class, key)
+        except RateLimited as e:
+            RATE_LIMITED.labels(endpoint_class, e.reason).inc()
+            response = JSONResponse(
+                status_code=429,
+                content={"detail": "Too many requests, please retry later."},
+                headers={"Retry-After": str(max(1, math.ceil(e.retry_after)))},
+            )
+            await response(scope, receive, send)
+            return
+
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            rate_limiter.release(endpoint_class, key)
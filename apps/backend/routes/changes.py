@@ -0,0 +1,45 @@
+import logging
+from typing import Optional
+
+from fastapi import APIRouter, HTTPException, Request
+
+from changes import CursorExpired, change_journal
+from config import CHANGES_PAGE_SIZE, CHANGES_MAX_PAGE_SIZE, CHANGES_MAX_WAIT
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/changes")
+
+
+@router.get("")
+async def list_changes(
+    req: Request,
+    cursor: Optional[str] = None,
+    limit: int = CHANGES_PAGE_SIZE,
+    wait: float = 0,
+):
+    try:
+        if not 0 < limit <= CHANGES_MAX_PAGE_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Limit must be between 1 and {CHANGES_MAX_PAGE_SIZE}",
+            )
+        if not 0 <= wait <= CHANGES_MAX_WAIT:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Wait must be between 0 and {CHANGES_MAX_WAIT} seconds",
+            )
+        try:
+            position = int(cursor) if cursor is not None else None
+        except ValueError:
+            raise HTTPException(status_code=400, detail="Invalid cursor")
+
+        return await change_journal.changes(req.state.user_id, position, limit, wait)
+
+    except CursorExpired as e:
+        raise HTTPException(status_code=410, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error listing changes")
+        raise HTTPException(status_code=500, detail="Internal server error.")
@@ -1,10 +1,16 @@
 import asyncio
+import logging
 import os
 from fastapi import APIRouter, HTTPException, Request
 from starlette.responses import JSONResponse
 from pathlib import Path
 
-from config import BASE_PATH, HOME
+from config import (
+    BASE_PATH,
+    HOME,
+    CONTENT_SEARCH_PAGE_SIZE,
+    CONTENT_SEARCH_MAX_PAGE_SIZE,
+)
 from utils import (
     verify_incoming_path,
     list_number_of_items,
@@ -13,13 +19,18 @@ from utils import (
     get_directory_contents,
     ensure_unique_path,
 )
+import file_events
 from crypto_utils import get_plaintext_size
+from media_index import media_index
+from content_index import content_index
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/directories")
 
 
 @router.get("")
-async def list_directory_contents(path: str, req: Request):
+async def list_directory_contents(path: str, req: Request, metadata: bool = False):
     try:
         relative_path = BASE_PATH / req.state.user_id
         is_verified = verify_incoming_path(relative_path, Path(path))
@@ -31,11 +42,17 @@ async def list_directory_contents(path: str, req: Request):
         contents = await asyncio.to_thread(
             get_directory_contents, folder_path, relative_path
         )
+        if metadata:
+            contents = await media_index.annotate(
+                req.state.user_id,
+                str(folder_path.relative_to(relative_path)),
+                contents,
+            )
         contents = sort_dir_items(contents)
         return contents
 
     except Exception as e:
-        print(e)
+        logger.warning("Error listing directory: %s", e)
         raise HTTPException(status_code=400, detail=str(e))
 
 
@@ -47,9 +64,13 @@ async def create_directory(path: str, req: Request):
             raise PermissionError("User operation denied!")
 
         folder_path = BASE_PATH / req.state.user_id / path
-        folder_path = await ensure_unique_path(folder_path)
-
-        await asyncio.to_thread(folder_path.mkdir, parents=True, exist_ok=False)
+        await asyncio.to_thread(folder_path.parent.mkdir, parents=True, exist_ok=True)
+        folder_path = await ensure_unique_path(folder_path, reserve=True, is_dir=True)
+        file_events.emit(
+            file_events.CREATED,
+            req.state.user_id,
+            str(folder_path.relative_to(BASE_PATH / req.state.user_id)),
+        )
 
         return JSONResponse(
             content={"message": "Directory created successfully."}, status_code=201
@@ -58,7 +79,7 @@ async def create_directory(path: str, req: Request):
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
     except Exception as e:
-        print(f"Error creating directory: {str(e)}")
+        logger.exception("Error creating directory")
         raise HTTPException(status_code=500, detail=str(e) or "Internal server error.")
 
 
@@ -85,5 +106,39 @@ async def search_directory_contents(query: str, req: Request):
         return matching_files if len(matching_files) < 500 else matching_files[:500]
 
     except Exception as e:
-        print(e)
+        logger.warning("Error searching files: %s", e)
+        raise HTTPException(status_code=400, detail=str(e))
+
+
+@router.get("/search/content")
+async def search_file_contents(
+    query: str,
+    req: Request,
+    path: str = HOME,
+    limit: int = CONTENT_SEARCH_PAGE_SIZE,
+    offset: int = 0,
+):
+    try:
+        if not verify_incoming_path(BASE_PATH / req.state.user_id, Path(path)):
+            raise PermissionError("User operation denied!")
+        if not 0 < limit <= CONTENT_SEARCH_MAX_PAGE_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Limit must be between 1 and {CONTENT_SEARCH_MAX_PAGE_SIZE}",
+            )
+        if offset < 0:
+            raise HTTPException(status_code=400, detail="Offset must not be negative")
+
+        return await content_index.search(
+            req.state.user_id, str(Path(path)), query, limit, offset
+        )
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except ValueError as e:
         raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error searching file contents")
+        raise HTTPException(status_code=500, detail="Internal server error.")
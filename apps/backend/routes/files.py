@@ -1,4 +1,5 @@
 import asyncio
+import logging
 import io
 import json
 import shutil
@@ -12,7 +13,18 @@ import zipfile
 
 from config import BASE_PATH
 from models import DeleteItemsRequest, RenameRequest
-from utils import verify_incoming_path, ensure_unique_path, create_zip_buffer
+import file_events
+from file_ops import run_batch
+from logs import audit, audit_batch
+from trash import move_to_trash, restore_from_trash
+from utils import (
+    verify_incoming_path,
+    verify_items,
+    ensure_unique_path,
+    create_zip_buffer,
+    batch_response,
+)
+from delta_sync import StaleBase, apply_delta, public_signature, signature
 from crypto_utils import (
     encrypt_upload_to_file,
     decrypt_stream,
@@ -21,6 +33,8 @@ from crypto_utils import (
     get_plaintext_size,
 )
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/files")
 
 
@@ -33,9 +47,14 @@ async def create_file(path: str, req: Request):
             raise PermissionError("User operation denied!")
 
         folder_path = BASE_PATH / req.state.user_id / path
-        folder_path = await ensure_unique_path(folder_path)
+        folder_path = await ensure_unique_path(folder_path, reserve=True)
 
-        await asyncio.to_thread(ensure_encrypted_empty_file, folder_path)
+        await asyncio.to_thread(ensure_encrypted_empty_file, folder_path, True)
+        file_events.emit(
+            file_events.CREATED,
+            req.state.user_id,
+            str(folder_path.relative_to(BASE_PATH / req.state.user_id)),
+        )
 
         return JSONResponse(
             content={"message": "File created successfully."}, status_code=201
@@ -66,10 +85,17 @@ async def upload_file(path: str, req: Request, file: UploadFile = File(...)):
 
         original_filename = Path(file.filename)
         file_path = user_dir / original_filename.name
-        file_path = await ensure_unique_path(file_path)
-
-        plain_size = await encrypt_upload_to_file(file, file_path)
+        file_path = await ensure_unique_path(file_path, reserve=True)
 
+        try:
+            plain_size = await encrypt_upload_to_file(file, file_path, reserved=True)
+        except BaseException:
+            await asyncio.to_thread(file_path.unlink, missing_ok=True)
+            raise
+
+        relative_file_path = str(file_path.relative_to(BASE_PATH / req.state.user_id))
+        audit("upload", req.state.user_id, path=relative_file_path, size=plain_size)
+        file_events.emit(file_events.CREATED, req.state.user_id, relative_file_path)
         return {
             "filename": file.filename,
             "saved_as": file_path.name,
@@ -86,6 +112,70 @@ async def upload_file(path: str, req: Request, file: UploadFile = File(...)):
         raise HTTPException(status_code=500, detail=f"Unexpected error: {str(e)}")
 
 
+@router.get("/signature")
+async def get_file_signature(path: str, req: Request):
+    try:
+        parent_path = BASE_PATH / req.state.user_id
+        if not verify_incoming_path(parent_path, Path(path)):
+            raise PermissionError("User operation denied!")
+        full_path = parent_path / path
+        if not await asyncio.to_thread(full_path.is_file):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        relative_path = str(Path(path))
+        tag, block_size, blocks = await asyncio.to_thread(
+            signature, req.state.user_id, parent_path, relative_path
+        )
+        size = await asyncio.to_thread(get_plaintext_size, full_path)
+        return public_signature(tag, block_size, blocks, size)
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except StaleBase as e:
+        raise HTTPException(status_code=409, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error computing file signature")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.post("/delta")
+async def upload_file_delta(path: str, etag: str, req: Request):
+    try:
+        parent_path = BASE_PATH / req.state.user_id
+        if not verify_incoming_path(parent_path, Path(path)):
+            raise PermissionError("User operation denied!")
+        if not await asyncio.to_thread((parent_path / path).is_file):
+            raise HTTPException(status_code=404, detail="File not found")
+
+        relative_path = str(Path(path))
+        result = await apply_delta(
+            req.state.user_id, parent_path, relative_path, etag, req.stream()
+        )
+        audit(
+            "upload_delta",
+            req.state.user_id,
+            path=relative_path,
+            size=result["size"],
+            literal_bytes=result["literal_bytes"],
+        )
+        file_events.emit(file_events.MODIFIED, req.state.user_id, relative_path)
+        return result
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except StaleBase as e:
+        raise HTTPException(status_code=412, detail=str(e))
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error applying file delta")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
 @router.head("/download")
 async def download_files_head(req: Request, id: str):
     try:
@@ -157,8 +247,8 @@ async def download_files_head(req: Request, id: str):
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
     except OSError as e:
         raise HTTPException(status_code=500, detail=f"File system error: {str(e)}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    except Exception:
+        logger.exception("Error downloading files")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
@@ -244,8 +334,8 @@ async def download_files(req: Request, id: str):
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
     except OSError as e:
         raise HTTPException(status_code=500, detail=f"File system error: {str(e)}")
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    except Exception:
+        logger.exception("Error downloading files")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
@@ -263,23 +353,20 @@ async def delete_files(item_paths: DeleteItemsRequest, req: Request):
         if len(items_to_delete) == 0:
             raise Exception("No items to delete")
 
-        for item_path in items_to_delete:
-            is_verified = verify_incoming_path(
-                BASE_PATH / req.state.user_id, Path(item_path)
-            )
-            if not is_verified:
-                raise PermissionError("User operation denied!")
-            full_path = BASE_PATH / req.state.user_id / item_path
-            if await asyncio.to_thread(full_path.is_file):
-                print(full_path)
-                await asyncio.to_thread(full_path.unlink)
-            elif await asyncio.to_thread(full_path.is_dir):
-                print(full_path)
-                await asyncio.to_thread(shutil.rmtree, full_path)
-
-        return JSONResponse(
-            content={"message": "Deleted contents successfully."}, status_code=200
+        parent_path = BASE_PATH / req.state.user_id
+        verify_items(items_to_delete, parent_path)
+
+        results = await run_batch(
+            items_to_delete,
+            lambda item_path: move_to_trash(parent_path, item_path),
+            rollback=lambda item_path, info: (
+                restore_from_trash(parent_path, info["id"]) if info else None
+            ),
+            atomic=item_paths.atomic,
         )
+        audit_batch("delete", req.state.user_id, results)
+        file_events.emit_batch(file_events.DELETED, req.state.user_id, results)
+        return batch_response(results, "Deleted contents successfully.")
 
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
@@ -333,6 +420,18 @@ async def rename_file(req: Request, payload: RenameRequest):
             )
 
         await asyncio.to_thread(shutil.move, str(old_full_path), str(new_full_path))
+        audit(
+            "rename",
+            req.state.user_id,
+            path=str(Path(file_path)),
+            new_path=str(Path(file_path).with_name(new_name)),
+        )
+        file_events.emit(
+            file_events.MOVED,
+            req.state.user_id,
+            file_path,
+            str(Path(file_path).with_name(new_name)),
+        )
 
         return JSONResponse(
             content={
@@ -345,6 +444,6 @@ async def rename_file(req: Request, payload: RenameRequest):
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error renaming file: {str(e)}")
+    except Exception:
+        logger.exception("Error renaming file")
         raise HTTPException(status_code=500, detail="Internal server error.")
@@ -0,0 +1,12 @@
+import asyncio
+
+from fastapi import APIRouter, Request
+
+from scrubber import scrubber
+
+router = APIRouter(prefix="/integrity")
+
+
+@router.get("")
+async def get_integrity_status(req: Request):
+    return await asyncio.to_thread(scrubber.status, req.state.user_id)
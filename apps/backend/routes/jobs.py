@@ -0,0 +1,129 @@
+import asyncio
+import logging
+import json
+from pathlib import Path
+from urllib.parse import quote
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import JSONResponse, StreamingResponse
+
+from archives import archive_kind
+from config import BASE_PATH
+from crypto_utils import decrypt_stream, get_plaintext_size
+from jobs import FINISHED_STATES, job_manager, job_result_path
+from models import JobRequest
+from utils import verify_incoming_path, verify_items
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/jobs")
+
+
+@router.post("")
+async def submit_job(req: Request, payload: JobRequest):
+    try:
+        if len(payload.items) == 0:
+            raise HTTPException(status_code=400, detail="No items specified!")
+
+        parent_path = BASE_PATH / req.state.user_id
+        verify_items(payload.items, parent_path)
+
+        if payload.kind in ("move", "copy"):
+            if not payload.destination:
+                raise HTTPException(
+                    status_code=400, detail="Destination is required for this job"
+                )
+        if payload.destination is not None:
+            if not verify_incoming_path(parent_path, Path(payload.destination)):
+                raise PermissionError("User operation denied!")
+        if payload.kind == "extract":
+            for item in payload.items:
+                if archive_kind(Path(item)) is None:
+                    raise HTTPException(
+                        status_code=400, detail=f"Not a supported archive: {item}"
+                    )
+
+        job = await job_manager.submit(
+            req.state.user_id, payload.kind, payload.items, payload.destination
+        )
+        return JSONResponse(content=job.public(), status_code=202)
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error submitting job")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("")
+async def list_jobs(req: Request):
+    return [job.public() for job in await job_manager.list(req.state.user_id)]
+
+
+@router.get("/{job_id}")
+async def get_job(job_id: str, req: Request):
+    job = await job_manager.get(req.state.user_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.public()
+
+
+@router.delete("/{job_id}")
+async def cancel_job(job_id: str, req: Request):
+    job = await job_manager.cancel(req.state.user_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    return job.public()
+
+
+@router.get("/{job_id}/events")
+async def stream_job_events(job_id: str, req: Request):
+    user_id = req.state.user_id
+    if await job_manager.get(user_id, job_id) is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+    async def event_stream():
+        while True:
+            job = await job_manager.get(user_id, job_id)
+            if job is None:
+                break
+            yield f"event: progress\ndata: {json.dumps(job.public())}\n\n"
+            if job.status in FINISHED_STATES:
+                break
+            await job_manager.wait_for_update(job_id, job.version, timeout=15)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+@router.get("/{job_id}/result")
+async def download_job_result(job_id: str, req: Request):
+    job = await job_manager.get(req.state.user_id, job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail="Job not found")
+    if job.kind != "zip":
+        raise HTTPException(status_code=400, detail="Job has no downloadable result")
+    if job.status != "completed":
+        raise HTTPException(status_code=409, detail="Job has not completed")
+
+    result_path = job_result_path(job.id)
+    if not await asyncio.to_thread(result_path.exists):
+        raise HTTPException(status_code=404, detail="Job result has expired")
+
+    logical_size = await asyncio.to_thread(get_plaintext_size, result_path)
+    archive_name = Path(job.items[0]).name
+
+    return StreamingResponse(
+        decrypt_stream(result_path),
+        media_type="application/zip",
+        headers={
+            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(archive_name)}.zip",
+            "Content-Length": str(logical_size),
+            "X-Total-Size": str(logical_size),
+        },
+    )
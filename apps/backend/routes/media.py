@@ -1,23 +1,38 @@
 import asyncio
+import logging
 import os
 import mimetypes
 from pathlib import Path
 from tempfile import NamedTemporaryFile
+from typing import Optional
 
 from fastapi import APIRouter, HTTPException, Request
 from fastapi.background import BackgroundTasks
-from starlette.responses import FileResponse, StreamingResponse
+from starlette.responses import FileResponse, Response, StreamingResponse
 from PIL import Image
-import pypdfium2 as pdfium
-from config import BASE_PATH, VIDEO_FORMATS
-from utils import generate_pdf_thumbnail, verify_incoming_path
+from config import (
+    BASE_PATH,
+    HOME,
+    GALLERY_PAGE_SIZE,
+    GALLERY_MAX_PAGE_SIZE,
+    PDF_DEFAULT_WIDTH,
+)
+from media_index import GALLERY_KINDS, decode_cursor, media_index
+from metrics import THUMBNAIL_SECONDS, timed
+from profiling import stage
+from pdf_pages import PageNotFound, check_page_request, pdf_pages
+from utils import thumbnail_kind, verify_incoming_path
+from video_previews import PreviewError, video_previews, webvtt
 from crypto_utils import (
     is_encrypted_file,
     decrypt_stream,
     decrypt_stream_range,
     get_plaintext_size,
+    chunk_sizes,
 )
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/media")
 
 
@@ -67,7 +82,7 @@ async def stream_media(path: str, req: Request):
                     f.seek(start)
                     bytes_to_read = end - start + 1
                     while bytes_to_read > 0:
-                        chunk_size = min(1024 * 1024, bytes_to_read)
+                        chunk_size = min(chunk_sizes.stream, bytes_to_read)
                         data = f.read(chunk_size)
                         if not data:
                             break
@@ -89,8 +104,8 @@ async def stream_media(path: str, req: Request):
         raise HTTPException(status_code=403, detail=str(e))
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error streaming file: {str(e)}")
+    except Exception:
+        logger.exception("Error streaming file")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
@@ -108,105 +123,216 @@ async def get_thumbnail(path: str, req: Request, background_tasks: BackgroundTas
         if not await asyncio.to_thread(full_image_path.is_file):
             raise HTTPException(status_code=400, detail="Path is not a file")
 
-        src_for_thumb = full_image_path
-        tmp_to_cleanup: list[Path] = []
-
-        if is_encrypted_file(full_image_path):
-            with NamedTemporaryFile(suffix=full_image_path.suffix, delete=False) as tmp:
-                tmp_path = Path(tmp.name)
-                for chunk in decrypt_stream(full_image_path):
-                    tmp.write(chunk)
-            src_for_thumb = tmp_path
-            tmp_to_cleanup.append(tmp_path)
-
-        if src_for_thumb.suffix.lower() in VIDEO_FORMATS:
-            with NamedTemporaryFile(suffix=".jpg", delete=False) as tmp_thumb:
-                thumb_path = tmp_thumb.name
-
-            ffmpeg_cmd = [
-                "ffmpeg",
-                "-y",
-                "-i",
-                str(src_for_thumb),
-                "-ss",
-                "00:00:00.000",
-                "-vframes",
-                "1",
-                "-vf",
-                "scale=320:-1",
-                thumb_path,
-            ]
-            proc = await asyncio.create_subprocess_exec(
-                *ffmpeg_cmd,
-                stdout=asyncio.subprocess.DEVNULL,
-                stderr=asyncio.subprocess.PIPE,
-            )
-            _, _ = await proc.communicate()
-            if proc.returncode != 0 or not os.path.exists(thumb_path):
-                raise HTTPException(
-                    status_code=500, detail="Failed to generate thumbnail"
+        kind = thumbnail_kind(full_image_path)
+        with timed(THUMBNAIL_SECONDS, kind), stage("thumbnail"):
+            if kind == "video":
+                try:
+                    poster = await video_previews.poster(full_image_path)
+                except PreviewError:
+                    raise HTTPException(
+                        status_code=500, detail="Failed to generate thumbnail"
+                    )
+                return Response(
+                    content=poster,
+                    media_type="image/jpeg",
+                    headers={"Cache-Control": "public, max-age=3600"},
+                )
+
+            if kind == "pdf":
+                return Response(
+                    content=await pdf_pages.thumbnail(full_image_path),
+                    media_type="image/png",
+                    headers={"Cache-Control": "public, max-age=3600"},
                 )
 
-            for p in tmp_to_cleanup:
+            tmp_to_cleanup: list[Path] = []
+
+            if is_encrypted_file(full_image_path):
+                with NamedTemporaryFile(
+                    suffix=full_image_path.suffix, delete=False
+                ) as tmp:
+                    tmp_path = Path(tmp.name)
+                    for chunk in decrypt_stream(full_image_path):
+                        tmp.write(chunk)
+                tmp_to_cleanup.append(tmp_path)
+
+            if tmp_to_cleanup:
+                tmp_path = tmp_to_cleanup[0]
                 background_tasks.add_task(
-                    lambda path=p: os.remove(path) if os.path.exists(path) else None
+                    lambda path=tmp_path: (
+                        os.remove(path) if os.path.exists(path) else None
+                    )
+                )
+                return FileResponse(
+                    path=str(tmp_path),
+                    media_type="image/jpeg",
+                    headers={"Cache-Control": "public, max-age=3600"},
+                    background=background_tasks,
                 )
-            background_tasks.add_task(
-                lambda: os.remove(thumb_path) if os.path.exists(thumb_path) else None
-            )
 
             return FileResponse(
-                path=thumb_path,
+                path=str(full_image_path),
                 media_type="image/jpeg",
                 headers={"Cache-Control": "public, max-age=3600"},
-                background=background_tasks,
             )
 
-        elif src_for_thumb.suffix.lower() == ".pdf":
-            if not src_for_thumb.exists():
-                raise HTTPException(status_code=404, detail="PDF not found")
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error serving image")
+        raise HTTPException(status_code=500, detail="Internal server error.")
 
-            with NamedTemporaryFile(suffix=".png", delete=False) as tmp_thumb:
-                thumb_path = tmp_thumb.name
 
-            await asyncio.to_thread(generate_pdf_thumbnail, src_for_thumb, thumb_path)
-            for p in tmp_to_cleanup:
-                background_tasks.add_task(
-                    lambda path=p: os.remove(path) if os.path.exists(path) else None
-                )
-            background_tasks.add_task(
-                lambda: os.remove(thumb_path) if os.path.exists(thumb_path) else None
-            )
+def _video_path(user_id: str, path: str) -> Path:
+    if not verify_incoming_path(BASE_PATH / user_id, Path(path)):
+        raise PermissionError("User operation denied!")
+    full_path = BASE_PATH / user_id / path
+    if not full_path.is_file():
+        raise HTTPException(status_code=404, detail="Video not found")
+    if thumbnail_kind(full_path) != "video":
+        raise HTTPException(status_code=400, detail="Path is not a video")
+    return full_path
 
-            return FileResponse(
-                path=thumb_path,
-                media_type="image/png",
-                headers={"Cache-Control": "public, max-age=3600"},
-                background=background_tasks,
-            )
 
-        if tmp_to_cleanup:
-            tmp_path = tmp_to_cleanup[0]
-            background_tasks.add_task(
-                lambda path=tmp_path: os.remove(path) if os.path.exists(path) else None
-            )
-            return FileResponse(
-                path=str(tmp_path),
-                media_type="image/jpeg",
-                headers={"Cache-Control": "public, max-age=3600"},
-                background=background_tasks,
-            )
+@router.get("/previews/sprite")
+async def get_preview_sprite(path: str, req: Request):
+    try:
+        full_path = await asyncio.to_thread(_video_path, req.state.user_id, path)
+        sprite, _ = await video_previews.sprite(full_path)
+        return Response(
+            content=sprite,
+            media_type="image/jpeg",
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
 
-        return FileResponse(
-            path=str(full_image_path),
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except PreviewError:
+        raise HTTPException(status_code=500, detail="Failed to generate preview")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error serving preview sprite")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("/previews/vtt")
+async def get_preview_vtt(path: str, req: Request):
+    try:
+        full_path = await asyncio.to_thread(_video_path, req.state.user_id, path)
+        _, cues = await video_previews.sprite(full_path)
+        return Response(
+            content=webvtt(cues, f"sprite?{req.url.query}"),
+            media_type="text/vtt",
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except PreviewError:
+        raise HTTPException(status_code=500, detail="Failed to generate preview")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error serving preview cues")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+def _pdf_path(user_id: str, path: str) -> Path:
+    if not verify_incoming_path(BASE_PATH / user_id, Path(path)):
+        raise PermissionError("User operation denied!")
+    full_path = BASE_PATH / user_id / path
+    if not full_path.is_file():
+        raise HTTPException(status_code=404, detail="PDF not found")
+    if thumbnail_kind(full_path) != "pdf":
+        raise HTTPException(status_code=400, detail="Path is not a PDF")
+    return full_path
+
+
+@router.get("/pdf")
+async def get_pdf_info(path: str, req: Request):
+    try:
+        full_path = await asyncio.to_thread(_pdf_path, req.state.user_id, path)
+        return await pdf_pages.info(full_path)
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error reading PDF")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("/pdf/page")
+async def get_pdf_page(
+    path: str,
+    req: Request,
+    page: int = 0,
+    width: int = PDF_DEFAULT_WIDTH,
+    col: Optional[int] = None,
+    row: Optional[int] = None,
+):
+    try:
+        try:
+            tile = check_page_request(width, col, row)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        full_path = await asyncio.to_thread(_pdf_path, req.state.user_id, path)
+        return Response(
+            content=await pdf_pages.page(full_path, page, width, tile),
             media_type="image/jpeg",
-            headers={"Cache-Control": "public, max-age=3600"},
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except PageNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error rendering PDF page")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("/gallery")
+async def get_gallery(
+    req: Request,
+    path: str = HOME,
+    kind: Optional[str] = None,
+    cursor: Optional[str] = None,
+    limit: int = GALLERY_PAGE_SIZE,
+):
+    try:
+        if not verify_incoming_path(BASE_PATH / req.state.user_id, Path(path)):
+            raise PermissionError("User operation denied!")
+        if kind is not None and kind not in GALLERY_KINDS:
+            raise HTTPException(status_code=400, detail="Unknown media kind")
+        if not 0 < limit <= GALLERY_MAX_PAGE_SIZE:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Limit must be between 1 and {GALLERY_MAX_PAGE_SIZE}",
+            )
+        try:
+            position = decode_cursor(cursor) if cursor else None
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+        return await media_index.gallery(
+            req.state.user_id,
+            str(Path(path)),
+            (kind,) if kind else GALLERY_KINDS,
+            limit,
+            position,
         )
 
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error serving image: {str(e)}")
+    except Exception:
+        logger.exception("Error listing gallery")
         raise HTTPException(status_code=500, detail="Internal server error.")
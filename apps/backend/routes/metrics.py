@@ -0,0 +1,68 @@
+import asyncio
+import hmac
+
+from fastapi import APIRouter, HTTPException, Request
+from prometheus_client import CollectorRegistry, CONTENT_TYPE_LATEST
+from prometheus_client.core import GaugeMetricFamily
+from starlette.responses import Response
+
+from config import METRICS_TOKEN
+from jobs import job_manager, ACTIVE_STATES, FINISHED_STATES
+from metrics import render
+from scrubber import scrubber
+
+router = APIRouter()
+
+
+class StateCollector:
+    def collect(self):
+        jobs = GaugeMetricFamily(
+            "pidrive_jobs", "Background jobs by status.", labels=["status"]
+        )
+        counts = job_manager.status_counts()
+        for status in ACTIVE_STATES + FINISHED_STATES:
+            jobs.add_metric([status], counts.get(status, 0))
+        yield jobs
+
+        status = scrubber.status()
+        gauges = {
+            "running": "Whether an integrity scrub pass is running.",
+            "passes_completed": "Integrity scrub passes completed.",
+            "last_pass_finished_at": "Unix time the last scrub pass finished.",
+            "last_pass_seconds": "Duration of the last scrub pass.",
+            "last_pass_files": "Files verified by the last scrub pass.",
+            "last_pass_bytes": "Bytes verified by the last scrub pass.",
+            "current_pass_files": "Files verified so far in the current pass.",
+            "current_pass_bytes": "Bytes verified so far in the current pass.",
+            "files_verified_total": "Files verified across all passes.",
+            "bytes_verified_total": "Bytes verified across all passes.",
+            "corrupt_total": "Corrupt files detected across all passes.",
+            "legacy_upgraded_total": "Legacy files rewritten in the segmented format.",
+        }
+        for key, documentation in gauges.items():
+            value = status.get(key)
+            if value is not None:
+                yield GaugeMetricFamily(
+                    f"pidrive_scrub_{key}", documentation, value=float(value)
+                )
+        yield GaugeMetricFamily(
+            "pidrive_scrub_corrupt_files",
+            "Corrupt files found by the most recent scrub pass.",
+            value=len(status.get("corrupt", [])),
+        )
+
+
+state_registry = CollectorRegistry()
+state_registry.register(StateCollector())
+
+
+@router.get("/metrics")
+async def get_metrics(req: Request):
+    if not METRICS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    expected = f"Bearer {METRICS_TOKEN}".encode()
+    if not hmac.compare_digest(req.headers.get("authorization", "").encode(), expected):
+        raise HTTPException(status_code=401, detail="Invalid metrics token")
+
+    data = await asyncio.to_thread(render, state_registry)
+    return Response(content=data, media_type=CONTENT_TYPE_LATEST)
@@ -1,14 +1,28 @@
 import asyncio
-import os
-import shutil
+import logging
 from pathlib import Path
 
 from fastapi import APIRouter, HTTPException, Request
-from starlette.responses import JSONResponse
 
 from config import BASE_PATH
 from models import MoveItemsRequest, CopyItemsRequest
-from utils import verify_incoming_path, ensure_unique_path, verify_items
+import file_events
+from logs import audit_batch
+from file_ops import (
+    copy_item,
+    delete_item,
+    move_item,
+    restore_moved_item,
+    run_batch,
+)
+from utils import (
+    batch_response,
+    relative_item_path,
+    verify_incoming_path,
+    verify_items,
+)
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/files")
 
@@ -33,52 +47,36 @@ async def move_files(req: Request, payload: MoveItemsRequest):
                 status_code=400, detail="Destination is not a directory"
             )
 
-        dest_resolved = dest_path.resolve()
-
         verify_items(items_list, parent_path)
 
-        for item_path in items_list:
-            src_full_path = parent_path / item_path
-            if not await asyncio.to_thread(src_full_path.exists):
-                raise HTTPException(
-                    status_code=404, detail=f"Source path not found: {item_path}"
-                )
-
-            src_resolved = src_full_path.resolve()
-
-            if src_resolved.parent == dest_resolved:
-                continue
-
-            if src_resolved == dest_resolved or str(dest_resolved).startswith(
-                str(src_resolved) + os.sep
-            ):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Cannot move '{src_full_path.name}' into itself or its subdirectory",
-                )
-
-            new_location = dest_path / src_full_path.name
-            new_location = await ensure_unique_path(new_location)
-
-            await asyncio.to_thread(shutil.move, str(src_full_path), str(new_location))
-
-        return JSONResponse(
-            content={"message": "Moved contents successfully."}, status_code=200
+        results = await run_batch(
+            items_list,
+            lambda item_path: move_item(parent_path / item_path, dest_path),
+            rollback=lambda item_path, new_location: restore_moved_item(
+                parent_path / item_path, new_location
+            ),
+            atomic=payload.atomic,
+            describe=lambda new_location: relative_item_path(new_location, parent_path),
         )
+        audit_batch("move", req.state.user_id, results)
+        file_events.emit_batch(file_events.MOVED, req.state.user_id, results)
+        return batch_response(results, "Moved contents successfully.")
 
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error moving items: {str(e)}")
+        logger.warning("Error moving items: %s", e)
         raise HTTPException(status_code=400, detail=str(e) or "Invalid file name.")
 
 
 @router.patch("/copy")
 async def copy_files(req: Request, payload: CopyItemsRequest):
     try:
-        print("Copy payload:", payload)
+        logger.debug("Copy payload: %s", payload)
         raw_items = payload.items
         if isinstance(raw_items, list):
             items_list = raw_items
@@ -88,7 +86,6 @@ async def copy_files(req: Request, payload: CopyItemsRequest):
             items_list = []
 
         destination = payload.destination
-        print(destination)
         if len(items_list) == 0 or not destination:
             raise Exception("Invalid request payload")
 
@@ -106,45 +103,24 @@ async def copy_files(req: Request, payload: CopyItemsRequest):
                 status_code=400, detail="Destination is not a directory"
             )
 
-        dest_resolved = dest_path.resolve()
-
         verify_items(items_list, parent_path)
 
-        for item_path in items_list:
-            src_full_path = parent_path / item_path
-            if not await asyncio.to_thread(src_full_path.exists):
-                raise HTTPException(
-                    status_code=404, detail=f"Source path not found: {item_path}"
-                )
-
-            src_resolved = src_full_path.resolve()
-
-            if str(dest_resolved).startswith(str(src_resolved) + os.sep):
-                raise HTTPException(
-                    status_code=400,
-                    detail=f"Cannot copy '{src_full_path.name}' into itself or its subdirectory",
-                )
-
-            new_location = dest_path / src_full_path.name
-            new_location = await ensure_unique_path(new_location)
-
-            if await asyncio.to_thread(src_full_path.is_dir):
-                await asyncio.to_thread(
-                    shutil.copytree, str(src_full_path), str(new_location)
-                )
-            else:
-                await asyncio.to_thread(
-                    shutil.copy2, str(src_full_path), str(new_location)
-                )
-
-        return JSONResponse(
-            content={"message": "Copied contents successfully."}, status_code=200
+        results = await run_batch(
+            items_list,
+            lambda item_path: copy_item(parent_path / item_path, dest_path),
+            rollback=lambda item_path, new_location: delete_item(new_location),
+            atomic=payload.atomic,
+            describe=lambda new_location: relative_item_path(new_location, parent_path),
         )
+        file_events.emit_batch(file_events.COPIED, req.state.user_id, results)
+        return batch_response(results, "Copied contents successfully.")
 
     except PermissionError as e:
         raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except HTTPException:
         raise
     except Exception as e:
-        print(f"Error copying items: {str(e)}")
+        logger.warning("Error copying items: %s", e)
         raise HTTPException(status_code=400, detail=str(e) or "Failed to copy items.")
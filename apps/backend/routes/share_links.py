@@ -0,0 +1,62 @@
+import asyncio
+import logging
+from pathlib import Path
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import JSONResponse
+
+from config import BASE_PATH, SHARE_TOKEN_DEFAULT_TTL, SHARE_TOKEN_MAX_TTL
+from logs import audit
+from models import ShareRequest
+from share_tokens import share_links
+from utils import verify_incoming_path
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/shares")
+
+
+@router.post("")
+async def create_share(req: Request, payload: ShareRequest):
+    try:
+        parent_path = BASE_PATH / req.state.user_id
+        if not verify_incoming_path(parent_path, Path(payload.path)):
+            raise PermissionError("User operation denied!")
+        if not payload.permissions:
+            raise HTTPException(status_code=400, detail="No permissions specified!")
+        if not await asyncio.to_thread((parent_path / payload.path).exists):
+            raise HTTPException(status_code=404, detail="Path not found.")
+
+        ttl = min(payload.expires_in or SHARE_TOKEN_DEFAULT_TTL, SHARE_TOKEN_MAX_TTL)
+        token, grant = await asyncio.to_thread(
+            share_links.issue,
+            req.state.user_id,
+            payload.path,
+            payload.permissions,
+            ttl,
+        )
+        audit("share_create", req.state.user_id, path=grant.path, share_id=grant.jti)
+        return JSONResponse(content={**grant.public(), "token": token}, status_code=201)
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error creating share link")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("")
+async def list_shares(req: Request):
+    grants = await asyncio.to_thread(share_links.list, req.state.user_id)
+    return [grant.public() for grant in grants]
+
+
+@router.delete("/{share_id}")
+async def revoke_share(share_id: str, req: Request):
+    revoked = await asyncio.to_thread(share_links.revoke, req.state.user_id, share_id)
+    if not revoked:
+        raise HTTPException(status_code=404, detail="Share link not found")
+    audit("share_revoke", req.state.user_id, share_id=share_id)
+    return JSONResponse(content={"message": "Share link revoked."}, status_code=200)
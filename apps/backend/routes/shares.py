@@ -1,40 +1,133 @@
 import asyncio
+import logging
 from base64 import b64decode
 import io
 import json
 import os
 import zipfile
 import mimetypes
-from tempfile import NamedTemporaryFile
 from urllib.parse import quote
 from fastapi import APIRouter, HTTPException, Request, BackgroundTasks, Response
-from starlette.responses import JSONResponse, StreamingResponse, FileResponse
+from starlette.responses import JSONResponse, StreamingResponse
 from pathlib import Path
+from typing import AsyncIterator, Optional
 from PIL import Image
-import pypdfium2 as pdfium
 
-from config import BASE_PATH, VIDEO_FORMATS
+from config import BASE_PATH, PDF_DEFAULT_WIDTH, SHARE_TOKENS_REQUIRED, VIDEO_FORMATS
+from logs import audit
+from metrics import THUMBNAIL_SECONDS, timed
+from pdf_pages import PageNotFound, check_page_request, pdf_pages
+from profiling import stage
+from share_cache import copy_decrypted, share_cache, share_listing, stream_direct
+from share_tokens import InvalidShareToken, share_links
+from video_previews import PreviewError, video_previews, webvtt
 from utils import (
     list_number_of_items,
     sort_dir_items,
     verify_incoming_path,
-    create_zip_buffer,
+    write_zip,
     get_directory_contents,
+    thumbnail_kind,
 )
 from crypto_utils import (
-    decrypt_stream,
     get_plaintext_size,
     decrypt_to_bytes,
     is_encrypted_file,
     decrypt_stream_range,
+    chunk_sizes,
 )
 
+logger = logging.getLogger(__name__)
+
 router = APIRouter(prefix="/share")
 
 
+def authorize_share(
+    token: Optional[str], user_id: Optional[str], paths: list[str], permission: str
+) -> str:
+    if token is None:
+        if SHARE_TOKENS_REQUIRED or user_id is None:
+            raise HTTPException(status_code=401, detail="Share token required")
+        return user_id
+
+    try:
+        grant = share_links.verify(token)
+    except InvalidShareToken as e:
+        raise HTTPException(status_code=401, detail=str(e))
+    if user_id is not None and user_id != grant.user_id:
+        raise HTTPException(status_code=403, detail="Access denied!")
+    if not all(grant.allows(path, permission) for path in paths):
+        raise HTTPException(status_code=403, detail="Access denied!")
+    return grant.user_id
+
+
+def _is_archive(item_paths: list[dict]) -> bool:
+    return len(item_paths) != 1 or bool(item_paths[0]["is_dir"])
+
+
+def _producer(item_paths: list[dict], parent_path: Path):
+    if _is_archive(item_paths):
+        return lambda out: write_zip(out, item_paths, parent_path)
+    path = parent_path / item_paths[0]["id"]
+    return lambda out: copy_decrypted(path, out)
+
+
+# Serves a shared download through the spool cache or, when it is too large
+# to keep, straight from its producer. A ZIP's length is only known once it
+# is spooled, so oversized ones go out without one.
+async def open_download(
+    item_paths: list[dict], parent_path: Path
+) -> tuple[AsyncIterator[bytes], Optional[int]]:
+    archive = _is_archive(item_paths)
+    listing = await asyncio.to_thread(share_listing, parent_path, item_paths, archive)
+    produce = _producer(item_paths, parent_path)
+    if listing.size > share_cache.max_entry_bytes:
+        return stream_direct(produce), None if archive else listing.size
+
+    entry = share_cache.open(listing.key, produce)
+    if not archive:
+        return entry.stream(), listing.size
+    try:
+        await entry.wait()
+    except BaseException:
+        entry.release()
+        raise
+    return entry.stream(), entry.written
+
+
+async def download_length(
+    item_paths: list[dict], parent_path: Path
+) -> Optional[int]:
+    if not _is_archive(item_paths):
+        return get_plaintext_size(parent_path / item_paths[0]["id"])
+    listing = await asyncio.to_thread(share_listing, parent_path, item_paths, True)
+    if listing.size > share_cache.max_entry_bytes:
+        return None
+    entry = share_cache.open(listing.key, _producer(item_paths, parent_path))
+    try:
+        await entry.wait()
+    finally:
+        entry.release()
+    return entry.written
+
+
+def download_headers(filename: str, length: Optional[int]) -> dict[str, str]:
+    headers = {"Content-Disposition": f"attachment; filename*=UTF-8''{quote(filename)}"}
+    if length is not None:
+        headers["Content-Length"] = str(length)
+        headers["X-Total-Size"] = str(length)
+    return headers
+
+
 @router.get("/contents")
-async def get_shared_directory_contents(user_id: str, item_path: str, req: Request):
+async def get_shared_directory_contents(
+    item_path: str,
+    req: Request,
+    user_id: Optional[str] = None,
+    token: Optional[str] = None,
+):
     try:
+        user_id = authorize_share(token, user_id, [item_path], "view")
         user_folder = BASE_PATH / user_id
 
         if not verify_incoming_path(user_folder, Path(item_path)):
@@ -72,19 +165,19 @@ async def get_shared_directory_contents(user_id: str, item_path: str, req: Reque
 
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error fetching shared directory contents: {str(e)}")
+    except Exception:
+        logger.exception("Error fetching shared directory contents")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 @router.get("/download")
-async def download_shared_items(user_id: str, id: str, req: Request):
+async def download_shared_items(
+    id: str, req: Request, user_id: Optional[str] = None, token: Optional[str] = None
+):
     try:
         if not id:
             raise HTTPException(status_code=400, detail="Invalid id provided!")
 
-        parent_path = BASE_PATH / user_id
-
         try:
             decoded = b64decode(id).decode("utf-8")
             item_paths = json.loads(decoded)
@@ -94,78 +187,57 @@ async def download_shared_items(user_id: str, id: str, req: Request):
         if not item_paths:
             raise HTTPException(status_code=400, detail="No items specified!")
 
+        user_id = authorize_share(
+            token, user_id, [itm["id"] for itm in item_paths], "download"
+        )
+        parent_path = BASE_PATH / user_id
+
         for itm in item_paths:
             is_valid = verify_incoming_path(parent_path, Path(itm["id"]))
             if not is_valid:
                 raise HTTPException(status_code=403, detail="Access denied!")
 
-        if len(item_paths) == 1:
-            to_download_item = item_paths[0]
-            download_item_path = parent_path / Path(to_download_item["id"])
+        audit(
+            "share_download",
+            user_id,
+            paths=[itm["id"] for itm in item_paths],
+            client=req.client.host if req.client else None,
+        )
 
+        if len(item_paths) == 1:
+            download_item_path = parent_path / Path(item_paths[0]["id"])
             if not download_item_path.exists():
                 raise HTTPException(status_code=404, detail="Path not found.")
 
-            if bool(to_download_item["is_dir"]):
-                zip_buffer, content_length = await create_zip_buffer(
-                    [to_download_item], parent_path
-                )
-                return StreamingResponse(
-                    zip_buffer,
-                    media_type="application/zip",
-                    headers={
-                        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(to_download_item['name'])}.zip",
-                        "X-Total-Size": str(content_length),
-                        "Content-Length": str(content_length),
-                    },
-                )
-
-            else:
-                logical_size = get_plaintext_size(download_item_path)
-
-                def iter_decrypted():
-                    for chunk in decrypt_stream(download_item_path):
-                        yield chunk
-
-                return StreamingResponse(
-                    iter_decrypted(),
-                    media_type="application/octet-stream",
-                    headers={
-                        "Content-Disposition": f"attachment; filename*=UTF-8''{quote(to_download_item['name'])}",
-                        "Content-Length": str(logical_size),
-                        "X-Total-Size": str(logical_size),
-                    },
-                )
-
-        else:
-            zip_buffer, content_length = await create_zip_buffer(
-                item_paths, parent_path
-            )
-            return StreamingResponse(
-                zip_buffer,
-                media_type="application/zip",
-                headers={
-                    "Content-Disposition": f"attachment; filename*=UTF-8''{quote(item_paths[0]['name'])}.zip",
-                    "Content-Length": str(content_length),
-                    "X-Total-Size": str(content_length),
-                },
-            )
+        filename = item_paths[0]["name"]
+        if _is_archive(item_paths):
+            filename += ".zip"
+        body, length = await open_download(item_paths, parent_path)
+        return StreamingResponse(
+            body,
+            media_type=(
+                "application/zip"
+                if _is_archive(item_paths)
+                else "application/octet-stream"
+            ),
+            headers=download_headers(filename, length),
+        )
 
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    except Exception:
+        logger.exception("Error downloading shared items")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 @router.head("/download")
-async def download_shared_items_head(user_id: str, id: str, req: Request):
+async def download_shared_items_head(
+    id: str, req: Request, user_id: Optional[str] = None, token: Optional[str] = None
+):
     try:
         if not id:
             raise HTTPException(status_code=400, detail="Invalid id provided!")
 
-        parent_path = BASE_PATH / user_id
-
         try:
             decoded = b64decode(id).decode("utf-8")
             item_paths = json.loads(decoded)
@@ -175,57 +247,43 @@ async def download_shared_items_head(user_id: str, id: str, req: Request):
         if not item_paths:
             raise HTTPException(status_code=400, detail="No items specified!")
 
+        user_id = authorize_share(
+            token, user_id, [itm["id"] for itm in item_paths], "download"
+        )
+        parent_path = BASE_PATH / user_id
+
         for itm in item_paths:
             is_valid = verify_incoming_path(parent_path, Path(itm["id"]))
             if not is_valid:
                 raise HTTPException(status_code=403, detail="Access denied!")
 
         if len(item_paths) == 1:
-            to_download_item = item_paths[0]
-            download_item_path = parent_path / Path(to_download_item["id"])
-
+            download_item_path = parent_path / Path(item_paths[0]["id"])
             if not download_item_path.exists():
                 raise HTTPException(status_code=404, detail="Path not found.")
 
-            if bool(to_download_item["is_dir"]):
-                zip_buffer, content_length = await create_zip_buffer(
-                    [to_download_item], parent_path
-                )
-                headers = {
-                    "Content-Disposition": f"attachment; filename*=UTF-8''{quote(to_download_item['name'])}.zip",
-                    "X-Total-Size": str(content_length),
-                    "Content-Length": str(content_length),
-                }
-                zip_buffer.close()
-                return Response(status_code=200, headers=headers)
-
-            logical_size = get_plaintext_size(download_item_path)
-            headers = {
-                "Content-Disposition": f"attachment; filename*=UTF-8''{quote(to_download_item['name'])}",
-                "Content-Length": str(logical_size),
-                "X-Total-Size": str(logical_size),
-            }
-            return Response(status_code=200, headers=headers)
-
-        zip_buffer, content_length = await create_zip_buffer(item_paths, parent_path)
-        headers = {
-            "Content-Disposition": f"attachment; filename*=UTF-8''{quote(item_paths[0]['name'])}.zip",
-            "Content-Length": str(content_length),
-            "X-Total-Size": str(content_length),
-        }
-        zip_buffer.close()
-        return Response(status_code=200, headers=headers)
+        filename = item_paths[0]["name"]
+        if _is_archive(item_paths):
+            filename += ".zip"
+        length = await download_length(item_paths, parent_path)
+        return Response(status_code=200, headers=download_headers(filename, length))
 
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Unexpected error: {e}")
+    except Exception:
+        logger.exception("Error downloading shared items")
         raise HTTPException(status_code=500, detail="Internal server error")
 
 
 @router.get("/stream")
-async def stream_shared_media(path: str, user_id: str, req: Request = None):
+async def stream_shared_media(
+    path: str,
+    user_id: Optional[str] = None,
+    token: Optional[str] = None,
+    req: Request = None,
+):
     try:
+        user_id = authorize_share(token, user_id, [path], "view")
         parent_path = BASE_PATH / user_id
         full_file_path = parent_path / path
 
@@ -270,7 +328,7 @@ async def stream_shared_media(path: str, user_id: str, req: Request = None):
                     f.seek(start)
                     bytes_to_read = end - start + 1
                     while bytes_to_read > 0:
-                        chunk_size = min(1024 * 1024, bytes_to_read)
+                        chunk_size = min(chunk_sizes.stream, bytes_to_read)
                         data = f.read(chunk_size)
                         if not data:
                             break
@@ -290,21 +348,23 @@ async def stream_shared_media(path: str, user_id: str, req: Request = None):
 
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error streaming shared file: {str(e)}")
+    except Exception:
+        logger.exception("Error streaming shared file")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
 @router.get("/thumbnails")
 async def get_shared_thumbnail(
     path: str,
-    user_id: str,
-    linkId: str,
+    user_id: Optional[str] = None,
+    linkId: str = None,
     password: str = None,
+    token: Optional[str] = None,
     req: Request = None,
     background_tasks: BackgroundTasks = None,
 ):
     try:
+        user_id = authorize_share(token, user_id, [path], "view")
         parent_path = BASE_PATH / user_id
         full_file_path = parent_path / path
 
@@ -315,86 +375,178 @@ async def get_shared_thumbnail(
         if not full_file_path.exists():
             raise HTTPException(status_code=404, detail="File not found")
 
-        file_extension = full_file_path.suffix.lower()
+        kind = thumbnail_kind(full_file_path)
+        with timed(THUMBNAIL_SECONDS, kind), stage("thumbnail"):
+            file_extension = full_file_path.suffix.lower()
 
-        if file_extension in [".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"]:
-            if is_encrypted_file(full_file_path):
-                decrypted_data = decrypt_to_bytes(full_file_path)
-                img = Image.open(io.BytesIO(decrypted_data))
-            else:
-                img = Image.open(full_file_path)
-
-            img.thumbnail((400, 400), Image.Resampling.LANCZOS)
-            img_byte_arr = io.BytesIO()
-            img_format = "JPEG" if file_extension in [".jpg", ".jpeg"] else "PNG"
-            img.save(img_byte_arr, format=img_format, quality=85)
-            img_byte_arr.seek(0)
-
-            return StreamingResponse(
-                img_byte_arr,
-                media_type=f"image/{img_format.lower()}",
-                headers={"Cache-Control": "public, max-age=3600"},
-            )
+            if file_extension in [".jpg", ".jpeg", ".png", ".gif", ".bmp", ".webp"]:
+                if is_encrypted_file(full_file_path):
+                    decrypted_data = decrypt_to_bytes(full_file_path)
+                    img = Image.open(io.BytesIO(decrypted_data))
+                else:
+                    img = Image.open(full_file_path)
 
-        elif file_extension == ".pdf":
-            with NamedTemporaryFile(suffix=".png", delete=False) as tmp_thumb:
-                thumb_path = tmp_thumb.name
+                img.thumbnail((400, 400), Image.Resampling.LANCZOS)
+                img_byte_arr = io.BytesIO()
+                img_format = "JPEG" if file_extension in [".jpg", ".jpeg"] else "PNG"
+                img.save(img_byte_arr, format=img_format, quality=85)
+                img_byte_arr.seek(0)
 
-            def generate_pdf_thumbnail():
-                src_for_thumb = full_file_path
-                tmp_to_cleanup = []
+                return StreamingResponse(
+                    img_byte_arr,
+                    media_type=f"image/{img_format.lower()}",
+                    headers={"Cache-Control": "public, max-age=3600"},
+                )
 
-                if is_encrypted_file(full_file_path):
-                    with NamedTemporaryFile(
-                        suffix=full_file_path.suffix, delete=False
-                    ) as tmp:
-                        tmp_path = Path(tmp.name)
-                        for chunk in decrypt_stream(full_file_path):
-                            tmp.write(chunk)
-                    src_for_thumb = tmp_path
-                    tmp_to_cleanup.append(tmp_path)
+            elif file_extension == ".pdf":
+                return Response(
+                    content=await pdf_pages.thumbnail(full_file_path),
+                    media_type="image/png",
+                    headers={"Cache-Control": "public, max-age=3600"},
+                )
 
+            elif file_extension in VIDEO_FORMATS:
                 try:
-                    pdf = pdfium.PdfDocument(src_for_thumb)
-                    first_page = pdf[0]
-                    bitmap = first_page.render(scale=2)
-                    pil_image = bitmap.to_pil()
-                    pil_image.thumbnail((512, 512))
-                    pil_image.save(thumb_path, "PNG")
-                finally:
-                    for p in tmp_to_cleanup:
-                        if p.exists():
-                            os.remove(p)
-
-            await asyncio.to_thread(generate_pdf_thumbnail)
-
-            if background_tasks:
-                background_tasks.add_task(
-                    lambda: (
-                        os.remove(thumb_path) if os.path.exists(thumb_path) else None
+                    poster = await video_previews.poster(full_file_path)
+                except PreviewError:
+                    raise HTTPException(
+                        status_code=500, detail="Failed to generate thumbnail"
                     )
+                return Response(
+                    content=poster,
+                    media_type="image/jpeg",
+                    headers={"Cache-Control": "public, max-age=3600"},
                 )
 
-            return FileResponse(
-                path=thumb_path,
-                media_type="image/png",
-                headers={"Cache-Control": "public, max-age=3600"},
-                background=background_tasks,
-            )
+            else:
+                raise HTTPException(
+                    status_code=400,
+                    detail="Unsupported file type for thumbnail generation",
+                )
 
-        elif file_extension in VIDEO_FORMATS:
-            raise HTTPException(
-                status_code=404,
-                detail="Video thumbnails not yet supported for shared files",
-            )
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error generating shared thumbnail")
+        raise HTTPException(status_code=500, detail="Internal server error.")
 
-        else:
-            raise HTTPException(
-                status_code=400, detail="Unsupported file type for thumbnail generation"
-            )
 
+def _shared_video_path(user_id: str, path: str) -> Path:
+    parent_path = BASE_PATH / user_id
+    if not verify_incoming_path(parent_path, Path(path)):
+        raise HTTPException(status_code=403, detail="Access denied!")
+    full_path = parent_path / path
+    if not full_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    if full_path.suffix.lower() not in VIDEO_FORMATS:
+        raise HTTPException(status_code=400, detail="File is not a video")
+    return full_path
+
+
+@router.get("/previews/sprite")
+async def get_shared_preview_sprite(
+    path: str, user_id: Optional[str] = None, token: Optional[str] = None
+):
+    try:
+        user_id = authorize_share(token, user_id, [path], "view")
+        full_path = await asyncio.to_thread(_shared_video_path, user_id, path)
+        sprite, _ = await video_previews.sprite(full_path)
+        return Response(
+            content=sprite,
+            media_type="image/jpeg",
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
+
+    except PreviewError:
+        raise HTTPException(status_code=500, detail="Failed to generate preview")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error serving shared preview sprite")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("/previews/vtt")
+async def get_shared_preview_vtt(
+    path: str,
+    req: Request,
+    user_id: Optional[str] = None,
+    token: Optional[str] = None,
+):
+    try:
+        user_id = authorize_share(token, user_id, [path], "view")
+        full_path = await asyncio.to_thread(_shared_video_path, user_id, path)
+        _, cues = await video_previews.sprite(full_path)
+        return Response(
+            content=webvtt(cues, f"sprite?{req.url.query}"),
+            media_type="text/vtt",
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
+
+    except PreviewError:
+        raise HTTPException(status_code=500, detail="Failed to generate preview")
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error serving shared preview cues")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+def _shared_pdf_path(user_id: str, path: str) -> Path:
+    parent_path = BASE_PATH / user_id
+    if not verify_incoming_path(parent_path, Path(path)):
+        raise HTTPException(status_code=403, detail="Access denied!")
+    full_path = parent_path / path
+    if not full_path.is_file():
+        raise HTTPException(status_code=404, detail="File not found")
+    if thumbnail_kind(full_path) != "pdf":
+        raise HTTPException(status_code=400, detail="File is not a PDF")
+    return full_path
+
+
+@router.get("/pdf")
+async def get_shared_pdf_info(
+    path: str, user_id: Optional[str] = None, token: Optional[str] = None
+):
+    try:
+        user_id = authorize_share(token, user_id, [path], "view")
+        full_path = await asyncio.to_thread(_shared_pdf_path, user_id, path)
+        return await pdf_pages.info(full_path)
+
+    except HTTPException:
+        raise
+    except Exception:
+        logger.exception("Error reading shared PDF")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.get("/pdf/page")
+async def get_shared_pdf_page(
+    path: str,
+    user_id: Optional[str] = None,
+    token: Optional[str] = None,
+    page: int = 0,
+    width: int = PDF_DEFAULT_WIDTH,
+    col: Optional[int] = None,
+    row: Optional[int] = None,
+):
+    try:
+        user_id = authorize_share(token, user_id, [path], "view")
+        try:
+            tile = check_page_request(width, col, row)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+        full_path = await asyncio.to_thread(_shared_pdf_path, user_id, path)
+        return Response(
+            content=await pdf_pages.page(full_path, page, width, tile),
+            media_type="image/jpeg",
+            headers={"Cache-Control": "private, max-age=3600"},
+        )
+
+    except PageNotFound as e:
+        raise HTTPException(status_code=404, detail=str(e))
     except HTTPException:
         raise
-    except Exception as e:
-        print(f"Error generating shared thumbnail: {str(e)}")
+    except Exception:
+        logger.exception("Error rendering shared PDF page")
         raise HTTPException(status_code=500, detail="Internal server error.")
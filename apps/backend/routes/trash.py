@@ -0,0 +1,77 @@
+import asyncio
+import logging
+
+from fastapi import APIRouter, HTTPException, Request
+from starlette.responses import JSONResponse
+
+from config import BASE_PATH
+import file_events
+from models import TrashEntriesRequest
+from trash import list_trash, purge_from_trash, restore_from_trash, trash_purger
+
+logger = logging.getLogger(__name__)
+
+router = APIRouter(prefix="/trash")
+
+
+@router.get("")
+async def list_trash_contents(req: Request):
+    try:
+        return await asyncio.to_thread(list_trash, BASE_PATH / req.state.user_id)
+    except Exception:
+        logger.exception("Error listing trash")
+        raise HTTPException(status_code=500, detail="Internal server error.")
+
+
+@router.post("/restore")
+async def restore_trash_items(req: Request, payload: TrashEntriesRequest):
+    try:
+        if len(payload.ids) == 0:
+            raise HTTPException(status_code=400, detail="No items to restore")
+
+        parent_path = BASE_PATH / req.state.user_id
+        restored = []
+        for entry_id in payload.ids:
+            target = await asyncio.to_thread(restore_from_trash, parent_path, entry_id)
+            restored.append(str(target.relative_to(parent_path)))
+            file_events.emit(file_events.CREATED, req.state.user_id, restored[-1])
+
+        return JSONResponse(
+            content={"message": "Restored contents successfully.", "items": restored},
+            status_code=200,
+        )
+
+    except PermissionError as e:
+        raise HTTPException(status_code=403, detail=str(e) or "Permission denied.")
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except HTTPException:
+        raise
+    except Exception as e:
+        logger.exception("Error restoring items")
+        raise HTTPException(status_code=400, detail=str(e) or "Failed to restore.")
+
+
+@router.delete("")
+async def purge_trash_items(req: Request, payload: TrashEntriesRequest = None):
+    try:
+        parent_path = BASE_PATH / req.state.user_id
+        if payload is None or len(payload.ids) == 0:
+            entries = await asyncio.to_thread(list_trash, parent_path)
+            entry_ids = [entry["id"] for entry in entries]
+        else:
+            entry_ids = payload.ids
+
+        for entry_id in entry_ids:
+            await asyncio.to_thread(purge_from_trash, parent_path, entry_id)
+        trash_purger.wakeup()
+
+        return JSONResponse(
+            content={"message": "Purged trash successfully."}, status_code=200
+        )
+
+    except FileNotFoundError as e:
+        raise HTTPException(status_code=404, detail=str(e))
+    except Exception as e:
+        logger.exception("Error purging trash")
+        raise HTTPException(status_code=400, detail=str(e) or "Failed to purge.")
@@ -1,10 +1,13 @@
 import asyncio
+import logging
 from fastapi import APIRouter, HTTPException, Request
 from starlette.responses import JSONResponse
 from pathlib import Path
 
 from config import BASE_PATH, HOME
-from utils import compute_folder_size
+from utils import compute_folder_usage
+
+logger = logging.getLogger(__name__)
 
 router = APIRouter(prefix="/users")
 
@@ -14,21 +17,29 @@ async def initialize_user(req: Request):
     user_folder = BASE_PATH / req.state.user_id / HOME
     try:
         await asyncio.to_thread(user_folder.mkdir, parents=True, exist_ok=False)
-        size = await asyncio.to_thread(compute_folder_size, user_folder)
+        size, physical_size = await asyncio.to_thread(compute_folder_usage, user_folder)
         return JSONResponse(
-            content={"message": "Directory created successfully.", "storage": size},
+            content={
+                "message": "Directory created successfully.",
+                "storage": size,
+                "physical_storage": physical_size,
+            },
             status_code=201,
         )
     except FileExistsError:
-        size = await asyncio.to_thread(compute_folder_size, user_folder)
+        size, physical_size = await asyncio.to_thread(compute_folder_usage, user_folder)
         return JSONResponse(
-            content={"message": "Directory already exists.", "storage": size},
+            content={
+                "message": "Directory already exists.",
+                "storage": size,
+                "physical_storage": physical_size,
+            },
             status_code=200,
         )
     except PermissionError:
         raise HTTPException(status_code=403, detail="Permission denied.")
-    except Exception as e:
-        print(f"Error creating directory for user: {str(e)}")
+    except Exception:
+        logger.exception("Error creating directory for user")
         raise HTTPException(status_code=500, detail="Internal server error.")
 
 
@@ -36,11 +47,15 @@ async def initialize_user(req: Request):
 async def get_user_storage(req: Request):
     user_folder = BASE_PATH / req.state.user_id / HOME
     try:
-        size = await asyncio.to_thread(compute_folder_size, user_folder)
+        size, physical_size = await asyncio.to_thread(compute_folder_usage, user_folder)
         return JSONResponse(
-            content={"message": "Successfully fetched user storage.", "storage": size},
+            content={
+                "message": "Successfully fetched user storage.",
+                "storage": size,
+                "physical_storage": physical_size,
+            },
             status_code=200,
         )
-    except Exception as e:
-        print(f"Error fetching storage: {str(e)}")
+    except Exception:
+        logger.exception("Error fetching storage")
         raise HTTPException(status_code=500, detail="Internal server error.")
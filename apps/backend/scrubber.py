@@ -0,0 +1,308 @@
+import asyncio
+import logging
+import errno
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from cryptography.exceptions import InvalidTag
+
+from config import (
+    BASE_PATH,
+    STATE_PATH,
+    COMPRESSION,
+    SCRUB_INTERVAL,
+    SCRUB_RATE_BYTES,
+    SCRUB_UPGRADE_LEGACY,
+)
+from blob_store import get_chunk, read_manifest, walk_files
+from crypto_utils import (
+    MAGIC,
+    MANIFEST_MAGIC,
+    SEGMENTED_MAGIC,
+    SegmentedWriter,
+    decrypt_stream,
+    is_compressible,
+    iter_segmented_range,
+    read_magic,
+)
+from locks import FileLock
+
+logger = logging.getLogger(__name__)
+
+SCRUB_STATE_PATH = STATE_PATH / "scrub.json"
+SCRUB_TMP_PATH = STATE_PATH / "tmp"
+
+MAX_REPORTED_CORRUPT = 1000
+PERSIST_EVERY_FILES = 500
+LEADER_RETRY_INTERVAL = 60
+
+
+class ScrubStopped(Exception):
+    pass
+
+
+class RateLimiter:
+    def __init__(self, rate: int, stop: threading.Event):
+        self.rate = rate
+        self._stop = stop
+        self._started = time.monotonic()
+        self._consumed = 0
+
+    def consume(self, amount: int) -> None:
+        if self._stop.is_set():
+            raise ScrubStopped()
+        if self.rate <= 0:
+            return
+        self._consumed += amount
+        delay = self._consumed / self.rate - (time.monotonic() - self._started)
+        if delay > 0 and self._stop.wait(delay):
+            raise ScrubStopped()
+
+
+def _default_stats() -> dict:
+    return {
+        "running": False,
+        "passes_completed": 0,
+        "last_pass_started_at": None,
+        "last_pass_finished_at": None,
+        "last_pass_seconds": None,
+        "last_pass_files": 0,
+        "last_pass_bytes": 0,
+        "current_pass_files": 0,
+        "current_pass_bytes": 0,
+        "files_verified_total": 0,
+        "bytes_verified_total": 0,
+        "corrupt_total": 0,
+        "legacy_upgraded_total": 0,
+        "corrupt": [],
+    }
+
+
+def _upgrade_legacy(path: Path, limiter: RateLimiter) -> bool:
+    before = path.stat()
+    SCRUB_TMP_PATH.mkdir(parents=True, exist_ok=True)
+    tmp_path = SCRUB_TMP_PATH / f"{uuid.uuid4().hex}.upgrade"
+    writer = None
+    try:
+        for chunk in decrypt_stream(path):
+            if writer is None:
+                writer = SegmentedWriter(
+                    tmp_path,
+                    compress=COMPRESSION == "auto" and is_compressible(chunk),
+                )
+            writer.write(chunk)
+            limiter.consume(len(chunk))
+        if writer is None:
+            writer = SegmentedWriter(tmp_path)
+        writer.close()
+
+        after = path.stat()
+        if (before.st_ino, before.st_size, before.st_mtime_ns) != (
+            after.st_ino,
+            after.st_size,
+            after.st_mtime_ns,
+        ):
+            return False
+        try:
+            os.replace(tmp_path, path)
+        except OSError as e:
+            if e.errno == errno.EXDEV:
+                return False
+            raise
+        os.utime(path, ns=(before.st_atime_ns, before.st_mtime_ns))
+        return True
+    finally:
+        tmp_path.unlink(missing_ok=True)
+
+
+def _verify_v1(path: Path, limiter: RateLimiter) -> bool:
+    if SCRUB_UPGRADE_LEGACY:
+        return _upgrade_legacy(path, limiter)
+    for chunk in decrypt_stream(path):
+        limiter.consume(len(chunk))
+    return False
+
+
+def _verify_segmented(path: Path, limiter: RateLimiter) -> None:
+    for chunk in iter_segmented_range(path):
+        limiter.consume(len(chunk))
+
+
+def _verify_manifest(path: Path, limiter: RateLimiter, seen: set[bytes]) -> None:
+    _, entries = read_manifest(path)
+    for chunk, _ in entries:
+        if chunk in seen:
+            continue
+        try:
+            data = get_chunk(chunk)
+        except FileNotFoundError:
+            raise ValueError(f"Missing chunk {chunk.hex()}")
+        limiter.consume(len(data))
+        seen.add(chunk)
+
+
+class Scrubber:
+    def __init__(self, interval: int, rate: int):
+        self.interval = interval
+        self.rate = rate
+        self.stats = _default_stats()
+        self._lock = threading.Lock()
+        self._leader = FileLock("scrubber")
+        self._stop = threading.Event()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        self._stop.clear()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        self._stop.set()
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._leader.release()
+
+    def status(self, user_id: Optional[str] = None) -> dict:
+        if not self._leader.held:
+            self._load()
+        with self._lock:
+            data = dict(self.stats)
+            corrupt = list(data.pop("corrupt"))
+        if user_id is None:
+            data["corrupt"] = corrupt
+        else:
+            prefix = f"{user_id}/"
+            data["corrupt"] = [
+                {**entry, "path": entry["path"][len(prefix) :]}
+                for entry in corrupt
+                if entry["path"].startswith(prefix)
+            ]
+        return data
+
+    def _load(self) -> None:
+        try:
+            stored = json.loads(SCRUB_STATE_PATH.read_text())
+        except FileNotFoundError:
+            return
+        except (OSError, ValueError) as e:
+            logger.warning("Ignoring unreadable scrub state: %s", e)
+            return
+        with self._lock:
+            self.stats.update(stored)
+
+    def _persist(self) -> None:
+        SCRUB_STATE_PATH.parent.mkdir(parents=True, exist_ok=True)
+        tmp_path = SCRUB_STATE_PATH.with_suffix(".json.tmp")
+        with self._lock:
+            data = json.dumps(self.stats)
+        tmp_path.write_text(data)
+        os.replace(tmp_path, SCRUB_STATE_PATH)
+
+    def _next_pass_delay(self) -> float:
+        finished = self.stats["last_pass_finished_at"]
+        if finished is None:
+            return 0
+        return max(0.0, finished + self.interval - time.time())
+
+    async def _run(self) -> None:
+        while not self._leader.acquire(blocking=False):
+            await asyncio.sleep(LEADER_RETRY_INTERVAL)
+        await asyncio.to_thread(self._load)
+        with self._lock:
+            self.stats["running"] = False
+            self.stats["current_pass_files"] = 0
+            self.stats["current_pass_bytes"] = 0
+        while True:
+            await asyncio.sleep(self._next_pass_delay())
+            try:
+                await asyncio.to_thread(self.scrub_all)
+            except ScrubStopped:
+                return
+            except Exception:
+                logger.exception("Integrity scrub failed")
+                await asyncio.sleep(self.interval)
+
+    def scrub_all(self) -> None:
+        limiter = RateLimiter(self.rate, self._stop)
+        seen_chunks: set[bytes] = set()
+        corrupt: list[dict] = []
+        started = time.time()
+        with self._lock:
+            self.stats["running"] = True
+            self.stats["last_pass_started_at"] = started
+            self.stats["current_pass_files"] = 0
+            self.stats["current_pass_bytes"] = 0
+
+        try:
+            for count, path in enumerate(walk_files(BASE_PATH), start=1):
+                error = self._scrub_file(path, limiter, seen_chunks)
+                if error is not None:
+                    corrupt.append(
+                        {
+                            "path": str(path.relative_to(BASE_PATH)),
+                            "error": error,
+                            "detected_at": time.time(),
+                        }
+                    )
+                    with self._lock:
+                        self.stats["corrupt_total"] += 1
+                        self.stats["corrupt"] = corrupt[:MAX_REPORTED_CORRUPT]
+                if count % PERSIST_EVERY_FILES == 0:
+                    self._persist()
+        finally:
+            with self._lock:
+                self.stats["running"] = False
+
+        finished = time.time()
+        with self._lock:
+            self.stats["passes_completed"] += 1
+            self.stats["last_pass_finished_at"] = finished
+            self.stats["last_pass_seconds"] = finished - started
+            self.stats["last_pass_files"] = self.stats["current_pass_files"]
+            self.stats["last_pass_bytes"] = self.stats["current_pass_bytes"]
+            self.stats["corrupt"] = corrupt[:MAX_REPORTED_CORRUPT]
+        self._persist()
+
+    def _scrub_file(
+        self, path: Path, limiter: RateLimiter, seen_chunks: set[bytes]
+    ) -> Optional[str]:
+        try:
+            size = path.stat().st_size
+            magic = read_magic(path)
+            if magic == SEGMENTED_MAGIC:
+                _verify_segmented(path, limiter)
+            elif magic == MAGIC:
+                if _verify_v1(path, limiter):
+                    with self._lock:
+                        self.stats["legacy_upgraded_total"] += 1
+            elif magic == MANIFEST_MAGIC:
+                _verify_manifest(path, limiter, seen_chunks)
+            else:
+                return None
+        except (FileNotFoundError, NotADirectoryError):
+            return None
+        except ScrubStopped:
+            raise
+        except InvalidTag:
+            return "Authentication failed"
+        except ValueError as e:
+            return str(e) or "Malformed file"
+        except OSError as e:
+            logger.warning("Could not scrub %s: %s", path, e)
+            return None
+
+        with self._lock:
+            self.stats["current_pass_files"] += 1
+            self.stats["current_pass_bytes"] += size
+            self.stats["files_verified_total"] += 1
+            self.stats["bytes_verified_total"] += size
+        return None
+
+
+scrubber = Scrubber(SCRUB_INTERVAL, SCRUB_RATE_BYTES)
@@ -0,0 +1,365 @@
+import asyncio
+import hashlib
+import json
+import logging
+import os
+import queue
+import shutil
+import uuid
+import weakref
+from pathlib import Path
+from typing import AsyncIterator, Callable, NamedTuple, Optional
+
+from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+
+from config import SHARE_CACHE_PATH, SHARE_CACHE_MAX_BYTES, SHARE_CACHE_MAX_ENTRY_BYTES
+from crypto_utils import decrypt_stream, get_plaintext_size
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+SPOOL_SEGMENT_SIZE = 1024 * 1024
+NONCE_LEN = 12
+PIPE_DEPTH = 4
+# Headers, data descriptor and central directory record of one ZIP entry,
+# Zip64 extras included, not counting its name, which appears twice.
+ZIP_ENTRY_OVERHEAD = 256
+ZIP_END_OVERHEAD = 256
+
+
+class DownloadAbandoned(Exception):
+    pass
+
+
+class EntryTooLarge(Exception):
+    pass
+
+
+class ShareListing(NamedTuple):
+    key: str
+    # An upper bound on the bytes the download produces.
+    size: int
+
+
+def _deflate_bound(size: int) -> int:
+    return size + (size >> 12) + (size >> 14) + (size >> 25) + 64
+
+
+# One walk over the shared items names the cache entry after every file's
+# identity and bounds the download's size before any of it is produced.
+def share_listing(
+    parent_path: Path, item_paths: list[dict], archive: bool
+) -> ShareListing:
+    digest = hashlib.sha256(str(parent_path).encode())
+    digest.update(json.dumps(item_paths, sort_keys=True).encode())
+    size = ZIP_END_OVERHEAD if archive else 0
+    for item in item_paths:
+        path = parent_path / item["id"]
+        for file in path.rglob("*") if item["is_dir"] else [path]:
+            st = file.stat()
+            digest.update(
+                f"{file}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}\n".encode()
+            )
+            if not file.is_file():
+                continue
+            plain_size = get_plaintext_size(file)
+            if archive:
+                name_size = len(str(file.relative_to(parent_path)).encode())
+                size += _deflate_bound(plain_size) + ZIP_ENTRY_OVERHEAD + 2 * name_size
+            else:
+                size += plain_size
+    return ShareListing(digest.hexdigest(), size)
+
+
+def copy_decrypted(path: Path, out) -> None:
+    for chunk in decrypt_stream(path):
+        out.write(chunk)
+
+
+# One producer thread writes plaintext into the entry, which seals it in
+# segments under a key that never leaves memory. Readers on the event loop
+# follow the producer segment by segment. Production stops once the entry
+# outgrows its cap or every reader has gone.
+class SpoolEntry:
+    def __init__(self, path: Path, max_bytes: int):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._aead = AESGCM(AESGCM.generate_key(bit_length=256))
+        self._out = path.open("xb")
+        self._fd = os.open(path, os.O_RDONLY)
+        weakref.finalize(self, os.close, self._fd)
+        self._loop = asyncio.get_running_loop()
+        self._changed = asyncio.Event()
+        self._buffer = bytearray()
+        self._offset = 0
+        self.segments: list[tuple[int, int]] = []
+        self.written = 0
+        self.complete = False
+        self.error: Optional[BaseException] = None
+        self.abandoned = False
+        self.readers = 0
+        self.frequency = 0
+        self.priority = 0.0
+
+    def write(self, data) -> int:
+        if self.abandoned:
+            raise DownloadAbandoned("Nobody is reading the download")
+        self._buffer += data
+        self.written += len(data)
+        if self.written > self.max_bytes:
+            raise EntryTooLarge("Download outgrew the share cache")
+        while len(self._buffer) >= SPOOL_SEGMENT_SIZE:
+            self._seal(bytes(self._buffer[:SPOOL_SEGMENT_SIZE]))
+            del self._buffer[:SPOOL_SEGMENT_SIZE]
+        return len(data)
+
+    def tell(self) -> int:
+        return self.written
+
+    def flush(self) -> None:
+        pass
+
+    def _seal(self, plaintext: bytes) -> None:
+        nonce = len(self.segments).to_bytes(NONCE_LEN, "big")
+        sealed = self._aead.encrypt(nonce, plaintext, None)
+        self._out.write(sealed)
+        self._out.flush()
+        self.segments.append((self._offset, len(sealed)))
+        self._offset += len(sealed)
+        self._notify()
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        try:
+            if error is None and self._buffer:
+                self._seal(bytes(self._buffer))
+                self._buffer.clear()
+        except BaseException as e:
+            error = e
+        finally:
+            self._out.close()
+        if error is not None:
+            self.error = error
+        else:
+            self.complete = True
+        self._notify()
+
+    def _notify(self) -> None:
+        self._loop.call_soon_threadsafe(self._wake)
+
+    def _wake(self) -> None:
+        self._changed.set()
+        self._changed = asyncio.Event()
+
+    async def wait(self) -> None:
+        while not self.complete and self.error is None:
+            await self._changed.wait()
+        if self.error is not None:
+            raise self.error
+
+    def release(self) -> None:
+        # Every open() is matched by a release(), which stream() does when it
+        # ends; an entry nobody reads any more is not worth finishing.
+        self.readers -= 1
+        if self.readers == 0 and not self.complete and self.error is None:
+            self.abandoned = True
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        index = 0
+        try:
+            while True:
+                if index < len(self.segments):
+                    yield await asyncio.to_thread(self._read, index)
+                    index += 1
+                elif self.error is not None:
+                    raise self.error
+                elif self.complete:
+                    return
+                else:
+                    await self._changed.wait()
+        finally:
+            self.release()
+
+    def _read(self, index: int) -> bytes:
+        offset, length = self.segments[index]
+        sealed = os.pread(self._fd, length, offset)
+        return self._aead.decrypt(index.to_bytes(NONCE_LEN, "big"), sealed, None)
+
+
+# Hands a download too large to keep from its producer thread to its one
+# reader a few segments at a time; none of it touches the disk. Both sides
+# poll, so either one notices when the other has gone.
+class Pipe:
+    def __init__(self):
+        self._queue: queue.Queue = queue.Queue(PIPE_DEPTH)
+        self._buffer = bytearray()
+        self.written = 0
+        self.closed = False
+
+    def write(self, data) -> int:
+        self._buffer += data
+        self.written += len(data)
+        if len(self._buffer) >= SPOOL_SEGMENT_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def tell(self) -> int:
+        return self.written
+
+    def flush(self) -> None:
+        pass
+
+    def _put(self, item) -> None:
+        while not self.closed:
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                pass
+        raise DownloadAbandoned("Nobody is reading the download")
+
+    def finish(self, error: Optional[BaseException] = None) -> None:
+        if error is None and self._buffer:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        self._put(error)
+
+    def read(self):
+        while not self.closed:
+            try:
+                return self._queue.get(timeout=1)
+            except queue.Empty:
+                pass
+
+
+async def stream_direct(produce: Callable[[Pipe], None]) -> AsyncIterator[bytes]:
+    pipe = Pipe()
+
+    def run() -> None:
+        error = None
+        try:
+            produce(pipe)
+        except BaseException as e:
+            error = e
+        try:
+            pipe.finish(error)
+        except DownloadAbandoned:
+            pass
+
+    producer = asyncio.create_task(asyncio.to_thread(run))
+    try:
+        while True:
+            item = await asyncio.to_thread(pipe.read)
+            if item is None:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        pipe.closed = True
+        await asyncio.gather(producer, return_exceptions=True)
+
+
+# Keeps finished spools for popular shared downloads, evicting by
+# GreedyDual-Size-Frequency so small, frequently fetched items outlive large
+# one-off archives. Each worker keeps its own spool directory.
+class ShareCache:
+    def __init__(self, root: Path, max_bytes: int, max_entry_bytes: int):
+        self.root = root
+        self.path = root / str(os.getpid())
+        self.max_bytes = max_bytes
+        self.max_entry_bytes = max_entry_bytes
+        self._entries: dict[str, SpoolEntry] = {}
+        self._clock = 0.0
+        self._producers: set[asyncio.Task] = set()
+
+    async def start(self) -> None:
+        self.path = self.root / str(os.getpid())
+        await asyncio.to_thread(self._prepare)
+
+    async def stop(self) -> None:
+        for task in self._producers:
+            task.cancel()
+        await asyncio.gather(*self._producers, return_exceptions=True)
+        self._entries.clear()
+        await asyncio.to_thread(shutil.rmtree, self.path, True)
+
+    def _prepare(self) -> None:
+        self.root.mkdir(parents=True, exist_ok=True)
+        for stale in self.root.iterdir():
+            if not stale.name.isdigit() or not _process_alive(int(stale.name)):
+                shutil.rmtree(stale, ignore_errors=True)
+        shutil.rmtree(self.path, ignore_errors=True)
+        self.path.mkdir()
+
+    def open(self, key: str, produce: Callable[[SpoolEntry], None]) -> SpoolEntry:
+        entry = self._entries.get(key)
+        if entry is not None and entry.abandoned:
+            entry = None
+        record_cache("share_download", entry is not None)
+        if entry is None:
+            entry = SpoolEntry(self.path / uuid.uuid4().hex, self.max_entry_bytes)
+            self._entries[key] = entry
+            task = asyncio.create_task(self._produce(key, entry, produce))
+            self._producers.add(task)
+            task.add_done_callback(self._producers.discard)
+        entry.readers += 1
+        entry.frequency += 1
+        entry.priority = self._clock + entry.frequency / max(entry.written, 1)
+        return entry
+
+    async def _produce(
+        self, key: str, entry: SpoolEntry, produce: Callable[[SpoolEntry], None]
+    ) -> None:
+        def run() -> None:
+            try:
+                produce(entry)
+            except BaseException as e:
+                entry.finish(e)
+                raise
+            entry.finish()
+
+        try:
+            await asyncio.to_thread(run)
+        except (DownloadAbandoned, EntryTooLarge) as e:
+            logger.info("Stopped spooling shared download: %s", e)
+            self._discard(key, entry)
+            return
+        except Exception:
+            logger.exception("Failed to spool shared download")
+            self._discard(key, entry)
+            return
+
+        entry.priority = self._clock + entry.frequency / max(entry.written, 1)
+        self._evict()
+
+    def _evict(self) -> None:
+        total = sum(entry.written for entry in self._entries.values())
+        finished = [item for item in self._entries.items() if item[1].complete]
+        for key, entry in sorted(finished, key=lambda item: item[1].priority):
+            if total <= self.max_bytes:
+                break
+            self._clock = entry.priority
+            total -= entry.written
+            self._discard(key, entry)
+
+    def _discard(self, key: str, entry: SpoolEntry) -> None:
+        # Readers already streaming keep the file open, so it can go now.
+        if self._entries.get(key) is entry:
+            del self._entries[key]
+        entry.path.unlink(missing_ok=True)
+
+
+def _process_alive(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+share_cache = ShareCache(
+    SHARE_CACHE_PATH, SHARE_CACHE_MAX_BYTES, SHARE_CACHE_MAX_ENTRY_BYTES
+)
@@ -0,0 +1,216 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from functools import lru_cache
+from typing import Optional
+
+from cryptography.hazmat.primitives import hashes
+from cryptography.hazmat.primitives.kdf.hkdf import HKDF
+
+from config import SHARE_REVOCATION_REFRESH
+from crypto_utils import _load_master_key
+from state_db import connect, transaction
+
+logger = logging.getLogger(__name__)
+
+PERMISSIONS = ("view", "download")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS shares (
+    jti TEXT PRIMARY KEY,
+    user_id TEXT NOT NULL,
+    path TEXT NOT NULL,
+    permissions TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    expires_at REAL NOT NULL,
+    revoked_at REAL
+);
+CREATE INDEX IF NOT EXISTS shares_user ON shares (user_id, created_at);
+CREATE INDEX IF NOT EXISTS shares_expiry ON shares (expires_at);
+"""
+
+
+class InvalidShareToken(Exception):
+    pass
+
+
+@dataclass(frozen=True)
+class ShareGrant:
+    jti: str
+    user_id: str
+    path: str
+    permissions: tuple[str, ...]
+    expires_at: int
+
+    def allows(self, path: str, permission: str) -> bool:
+        if permission not in self.permissions:
+            return False
+        requested = os.path.normpath(path)
+        return requested == self.path or requested.startswith(self.path + "/")
+
+    def public(self) -> dict:
+        return {
+            "id": self.jti,
+            "path": self.path,
+            "permissions": list(self.permissions),
+            "expires_at": self.expires_at,
+        }
+
+
+def _b64encode(data: bytes) -> str:
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+def _b64decode(data: str) -> bytes:
+    return base64.urlsafe_b64decode(data + "=" * (-len(data) % 4))
+
+
+@lru_cache(maxsize=1)
+def _signing_key() -> bytes:
+    hkdf = HKDF(
+        algorithm=hashes.SHA256(),
+        length=32,
+        salt=None,
+        info=b"pidrive-self:share-token:v1",
+    )
+    return hkdf.derive(_load_master_key())
+
+
+def _sign(payload: str) -> bytes:
+    digest = hmac.new(_signing_key(), payload.encode(), hashlib.sha256).digest()
+    return _b64encode(digest).encode("ascii")
+
+
+# Tokens carry their own scope and expiry, so verifying one is an HMAC and a
+# set lookup. Revocations live in SQLite and are mirrored into memory; other
+# workers pick them up within one refresh interval.
+class ShareLinks:
+    def __init__(self, refresh_interval: float):
+        self.refresh_interval = refresh_interval
+        self._revoked: frozenset[str] = frozenset()
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        await asyncio.to_thread(connect().executescript, SCHEMA)
+        await asyncio.to_thread(self.refresh)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        while True:
+            await asyncio.sleep(self.refresh_interval)
+            try:
+                await asyncio.to_thread(self.refresh)
+            except Exception:
+                logger.exception("Failed to refresh share revocations")
+
+    def refresh(self) -> None:
+        with transaction() as conn:
+            conn.execute("DELETE FROM shares WHERE expires_at < ?", (time.time(),))
+            rows = conn.execute(
+                "SELECT jti FROM shares WHERE revoked_at IS NOT NULL"
+            ).fetchall()
+        self._revoked = frozenset(row["jti"] for row in rows)
+
+    def issue(
+        self, user_id: str, path: str, permissions: list[str], ttl: int
+    ) -> tuple[str, ShareGrant]:
+        now = time.time()
+        grant = ShareGrant(
+            jti=uuid.uuid4().hex,
+            user_id=user_id,
+            path=os.path.normpath(path),
+            permissions=tuple(p for p in PERMISSIONS if p in permissions),
+            expires_at=int(now + ttl),
+        )
+        with transaction() as conn:
+            conn.execute(
+                "INSERT INTO shares (jti, user_id, path, permissions, created_at,"
+                " expires_at) VALUES (?, ?, ?, ?, ?, ?)",
+                (
+                    grant.jti,
+                    grant.user_id,
+                    grant.path,
+                    ",".join(grant.permissions),
+                    now,
+                    grant.expires_at,
+                ),
+            )
+        claims = {
+            "jti": grant.jti,
+            "sub": grant.user_id,
+            "path": grant.path,
+            "perms": list(grant.permissions),
+            "exp": grant.expires_at,
+        }
+        payload = _b64encode(json.dumps(claims, separators=(",", ":")).encode())
+        return f"{payload}.{_sign(payload).decode('ascii')}", grant
+
+    def verify(self, token: str) -> ShareGrant:
+        payload, _, signature = token.partition(".")
+        if not hmac.compare_digest(signature.encode(), _sign(payload)):
+            raise InvalidShareToken("Invalid share token")
+        try:
+            claims = json.loads(_b64decode(payload))
+            grant = ShareGrant(
+                jti=claims["jti"],
+                user_id=claims["sub"],
+                path=claims["path"],
+                permissions=tuple(claims["perms"]),
+                expires_at=claims["exp"],
+            )
+        except Exception:
+            raise InvalidShareToken("Invalid share token")
+        if grant.expires_at <= time.time():
+            raise InvalidShareToken("Share link has expired")
+        if grant.jti in self._revoked:
+            raise InvalidShareToken("Share link has been revoked")
+        return grant
+
+    def revoke(self, user_id: str, jti: str) -> bool:
+        with transaction() as conn:
+            revoked = conn.execute(
+                "UPDATE shares SET revoked_at = ?"
+                " WHERE jti = ? AND user_id = ? AND revoked_at IS NULL",
+                (time.time(), jti, user_id),
+            ).rowcount
+        if revoked:
+            self._revoked = self._revoked | {jti}
+        return bool(revoked)
+
+    def list(self, user_id: str) -> list[ShareGrant]:
+        rows = (
+            connect()
+            .execute(
+                "SELECT jti, path, permissions, expires_at FROM shares"
+                " WHERE user_id = ? AND revoked_at IS NULL AND expires_at > ?"
+                " ORDER BY created_at",
+                (user_id, time.time()),
+            )
+            .fetchall()
+        )
+        return [
+            ShareGrant(
+                jti=row["jti"],
+                user_id=user_id,
+                path=row["path"],
+                permissions=tuple(row["permissions"].split(",")),
+                expires_at=int(row["expires_at"]),
+            )
+            for row in rows
+        ]
+
+
+share_links = ShareLinks(SHARE_REVOCATION_REFRESH)
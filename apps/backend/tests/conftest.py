@@ -0,0 +1,8 @@
+import base64
+import os
+import tempfile
+
+# Modules read their configuration on import, so the environment has to be
+# in place before any of them are collected.
+os.environ["BASE_PATH"] = tempfile.mkdtemp(prefix="pidrive-test-")
+os.environ.setdefault("FILES_MASTER_KEY", base64.b64encode(os.urandom(32)).decode())
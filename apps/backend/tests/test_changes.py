@@ -0,0 +1,33 @@
+import os
+
+from changes import REMOVED, UPDATED, _describe
+from config import BASE_PATH
+from crypto_utils import encrypt_chunks_to_file
+
+
+def test_describe_reports_plaintext_size_of_encrypted_files():
+    folder = BASE_PATH / "journal-user" / "docs"
+    folder.mkdir(parents=True, exist_ok=True)
+    data = os.urandom(100_000)
+    encrypt_chunks_to_file([data], folder / "report.bin")
+    assert (folder / "report.bin").stat().st_size != len(data)
+
+    entry = _describe("journal-user", "docs/report.bin", UPDATED, False)
+
+    assert entry["size"] == len(data)
+    assert entry["is_dir"] is False
+
+
+def test_describe_plain_file_and_folder():
+    folder = BASE_PATH / "journal-user" / "plain"
+    folder.mkdir(parents=True, exist_ok=True)
+    (folder / "notes.txt").write_bytes(b"hello")
+
+    assert _describe("journal-user", "plain/notes.txt", UPDATED, False)["size"] == 5
+    entry = _describe("journal-user", "plain", UPDATED, True)
+    assert entry["size"] is None and entry["subtree"] is True
+
+
+def test_describe_missing_path_is_removed():
+    entry = _describe("journal-user", "gone.txt", UPDATED, False)
+    assert entry == {"path": "gone.txt", "op": REMOVED}
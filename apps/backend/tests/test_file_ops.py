@@ -0,0 +1,11 @@
+from file_ops import _batch_groups
+
+
+def test_overlapping_items_share_a_group_in_request_order():
+    items = ["Home/a/b", "Home/c", "Home/a", "Home/a/d/e", "Home/x/c"]
+    assert sorted(_batch_groups(items)) == [[0, 2, 3], [1, 4]]
+
+
+def test_unrelated_items_run_apart():
+    items = ["Home/a", "Home/ab", "Home/b/c"]
+    assert sorted(_batch_groups(items)) == [[0], [1], [2]]
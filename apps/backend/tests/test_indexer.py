@@ -0,0 +1,19 @@
+import pytest
+
+from content_index import ContentIndex
+from indexer import FileIndexer
+from media_index import MediaIndex
+
+
+def test_indexers_implement_every_hook():
+    for indexer in (ContentIndex, MediaIndex):
+        assert not indexer.__abstractmethods__
+
+
+def test_incomplete_indexer_fails_on_construction():
+    class Partial(FileIndexer):
+        def accepts(self, path):
+            return True
+
+    with pytest.raises(TypeError):
+        Partial(1, 1, 60)
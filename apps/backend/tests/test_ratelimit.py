@@ -0,0 +1,42 @@
+import pytest
+
+from config import BASE_PATH
+from ratelimit import ANONYMOUS, RateLimited, RateLimiter, limit_key
+from share_tokens import SCHEMA, share_links
+from state_db import connect
+
+
+def share_scope(**query: str) -> tuple[dict, dict[str, list[str]]]:
+    return {"path": "/share/download"}, {k: [v] for k, v in query.items()}
+
+
+def test_unverified_link_ids_share_one_bucket():
+    keys = {
+        limit_key(*share_scope(linkId=f"link-{i}", user_id="nobody"))
+        for i in range(10)
+    }
+    assert keys == {ANONYMOUS}
+
+
+def test_changing_link_id_does_not_get_a_new_bucket():
+    limiter = RateLimiter({"zip": (100, 100, 2, 4)}, (100, 100, 1), 100, 1)
+    first = limit_key(*share_scope(linkId="a"))
+    limiter.acquire("zip", first)
+    with pytest.raises(RateLimited) as e:
+        limiter.acquire("zip", limit_key(*share_scope(linkId="b")))
+    assert e.value.reason == "concurrency"
+    limiter.release("zip", first)
+
+
+def test_forged_token_is_anonymous():
+    assert limit_key(*share_scope(token="e30.forged")) == ANONYMOUS
+
+
+def test_verified_identities_get_their_own_buckets():
+    (BASE_PATH / "owner").mkdir(exist_ok=True)
+    connect().executescript(SCHEMA)
+    token, grant = share_links.issue("owner", "docs", ["download"], 60)
+
+    assert limit_key(*share_scope(token=token)) == f"token:{grant.jti}"
+    assert limit_key(*share_scope(user_id="owner", linkId="x")) == "share:owner"
+    assert limit_key(*share_scope(user_id="../owner")) == ANONYMOUS
@@ -0,0 +1,244 @@
+import asyncio
+import logging
+import json
+import os
+import re
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+from config import (
+    BASE_PATH,
+    TRASH,
+    TRASH_RETENTION_SECONDS,
+    TRASH_MAX_BYTES,
+    TRASH_PURGE_INTERVAL,
+    STORAGE_BACKEND,
+    BLOB_GC_INTERVAL,
+)
+from blob_store import collect_garbage
+from file_ops import count_tree, delete_item, replace_reserved
+from locks import LOCKS_PATH, FileLock
+from utils import unique_path, verify_incoming_path
+
+logger = logging.getLogger(__name__)
+
+PURGING = ".purging"
+
+WAKEUP_PATH = LOCKS_PATH / "trash-purger.wakeup"
+WAKEUP_POLL_INTERVAL = 2.0
+
+ENTRY_ID_PATTERN = re.compile(r"[0-9a-f]{32}")
+
+
+def trash_path(parent_path: Path) -> Path:
+    return parent_path / TRASH
+
+
+def _entry_paths(parent_path: Path, entry_id: str) -> tuple[Path, Path]:
+    if not ENTRY_ID_PATTERN.fullmatch(entry_id):
+        raise ValueError(f"Invalid trash entry: {entry_id}")
+    trash_dir = trash_path(parent_path)
+    return trash_dir / entry_id, trash_dir / f"{entry_id}.json"
+
+
+def _write_info(info_path: Path, info: dict) -> None:
+    tmp_path = info_path.with_suffix(".json.tmp")
+    with tmp_path.open("w") as f:
+        json.dump(info, f)
+    os.replace(tmp_path, info_path)
+
+
+def move_to_trash(parent_path: Path, item_path: str) -> Optional[dict]:
+    full_path = parent_path / item_path
+    if not full_path.exists() and not full_path.is_symlink():
+        return None
+
+    trash_dir = trash_path(parent_path)
+    trash_dir.mkdir(exist_ok=True)
+
+    entry_id = uuid.uuid4().hex
+    entry_path, info_path = _entry_paths(parent_path, entry_id)
+    info = {
+        "id": entry_id,
+        "original_path": str(Path(item_path)),
+        "name": full_path.name,
+        "is_dir": full_path.is_dir(),
+        "deleted_at": time.time(),
+        "size": None,
+    }
+    _write_info(info_path, info)
+    try:
+        os.rename(full_path, entry_path)
+    except BaseException:
+        info_path.unlink(missing_ok=True)
+        raise
+    return info
+
+
+def list_trash(parent_path: Path) -> list[dict]:
+    trash_dir = trash_path(parent_path)
+    if not trash_dir.is_dir():
+        return []
+    entries = []
+    for info_path in trash_dir.glob("*.json"):
+        entry_path = info_path.with_suffix("")
+        if not entry_path.exists() and not entry_path.is_symlink():
+            continue
+        try:
+            entries.append(json.loads(info_path.read_text()))
+        except (OSError, ValueError):
+            continue
+    return sorted(entries, key=lambda entry: entry["deleted_at"], reverse=True)
+
+
+def restore_from_trash(parent_path: Path, entry_id: str) -> Path:
+    entry_path, info_path = _entry_paths(parent_path, entry_id)
+    if not info_path.exists():
+        raise FileNotFoundError(f"Trash entry not found: {entry_id}")
+
+    info = json.loads(info_path.read_text())
+    original_path = Path(info["original_path"])
+    if not verify_incoming_path(parent_path, original_path):
+        raise PermissionError("User operation denied!")
+
+    target = parent_path / original_path
+    target.parent.mkdir(parents=True, exist_ok=True)
+    target = unique_path(target, reserve=True, is_dir=entry_path.is_dir())
+    replace_reserved(entry_path, target)
+    info_path.unlink(missing_ok=True)
+    return target
+
+
+def purge_from_trash(parent_path: Path, entry_id: str) -> None:
+    entry_path, info_path = _entry_paths(parent_path, entry_id)
+    if not info_path.exists():
+        raise FileNotFoundError(f"Trash entry not found: {entry_id}")
+
+    purging_dir = trash_path(parent_path) / PURGING
+    purging_dir.mkdir(exist_ok=True)
+    if entry_path.exists() or entry_path.is_symlink():
+        os.rename(entry_path, purging_dir / entry_id)
+    info_path.unlink(missing_ok=True)
+
+
+def _drain_purging(trash_dir: Path) -> None:
+    purging_dir = trash_dir / PURGING
+    if not purging_dir.is_dir():
+        return
+    for entry in purging_dir.iterdir():
+        delete_item(entry)
+
+
+def purge_user_trash(parent_path: Path) -> None:
+    trash_dir = trash_path(parent_path)
+    if not trash_dir.is_dir():
+        return
+
+    _drain_purging(trash_dir)
+
+    now = time.time()
+    kept = []
+    for info in list_trash(parent_path):
+        if now - info["deleted_at"] > TRASH_RETENTION_SECONDS:
+            purge_from_trash(parent_path, info["id"])
+            continue
+        if info["size"] is None:
+            entry_path, info_path = _entry_paths(parent_path, info["id"])
+            info["size"] = count_tree(entry_path)[1]
+            _write_info(info_path, info)
+        kept.append(info)
+
+    if TRASH_MAX_BYTES > 0:
+        total = sum(info["size"] for info in kept)
+        for info in reversed(kept):
+            if total <= TRASH_MAX_BYTES:
+                break
+            purge_from_trash(parent_path, info["id"])
+            total -= info["size"]
+
+    for info_path in trash_dir.glob("*.json"):
+        entry_path = info_path.with_suffix("")
+        if not entry_path.exists() and not entry_path.is_symlink():
+            info_path.unlink(missing_ok=True)
+
+    _drain_purging(trash_dir)
+
+
+def purge_all_trash() -> None:
+    if not BASE_PATH.is_dir():
+        return
+    for user_dir in BASE_PATH.iterdir():
+        if not (user_dir / TRASH).is_dir():
+            continue
+        try:
+            purge_user_trash(user_dir)
+        except Exception:
+            logger.exception("Error purging trash for %s", user_dir.name)
+
+
+class TrashPurger:
+    def __init__(self, interval: int):
+        self.interval = interval
+        self._leader = FileLock("trash-purger")
+        self._wakeup: Optional[asyncio.Event] = None
+        self._task: Optional[asyncio.Task] = None
+        self._last_gc = 0.0
+        self._last_wakeup = 0.0
+
+    async def start(self) -> None:
+        self._wakeup = asyncio.Event()
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+        self._leader.release()
+
+    def wakeup(self) -> None:
+        if self._leader.held:
+            self._wakeup.set()
+            return
+        WAKEUP_PATH.parent.mkdir(parents=True, exist_ok=True)
+        WAKEUP_PATH.touch()
+
+    def _wakeup_requested(self) -> bool:
+        try:
+            requested = WAKEUP_PATH.stat().st_mtime
+        except FileNotFoundError:
+            return False
+        if requested <= self._last_wakeup:
+            return False
+        self._last_wakeup = requested
+        return True
+
+    async def _wait(self) -> None:
+        deadline = time.monotonic() + self.interval
+        while time.monotonic() < deadline:
+            timeout = min(WAKEUP_POLL_INTERVAL, deadline - time.monotonic())
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), max(timeout, 0))
+                break
+            except asyncio.TimeoutError:
+                pass
+            if self._leader.held and self._wakeup_requested():
+                break
+        self._wakeup.clear()
+
+    async def _run(self) -> None:
+        while True:
+            if self._leader.acquire(blocking=False):
+                await asyncio.to_thread(purge_all_trash)
+                if (
+                    STORAGE_BACKEND == "dedup"
+                    and time.time() - self._last_gc >= BLOB_GC_INTERVAL
+                ):
+                    self._last_gc = time.time()
+                    await asyncio.to_thread(collect_garbage)
+            await self._wait()
+
+
+trash_purger = TrashPurger(TRASH_PURGE_INTERVAL)
@@ -1,16 +1,28 @@
 import os
 import asyncio
 import io
+import re
+import threading
 import zipfile
 from pathlib import Path
-from config import HOME
+from config import HOME, VIDEO_FORMATS
 from typing import Optional
-import pypdfium2 as pdfium
+from starlette.responses import JSONResponse
 from crypto_utils import (
     get_plaintext_size,
     is_encrypted_file,
+    is_manifest_file,
     decrypt_stream,
 )
+from blob_store import physical_chunk_size, read_manifest
+from metrics import DIRECTORY_ENTRIES, ZIP_SECONDS, record_cache, timed
+from profiling import stage
+
+UNIQUE_PATH_CACHE_SIZE = 4096
+UNIQUE_PATH_RESCAN_AFTER = 8
+
+_next_suffix: dict[tuple[str, str], int] = {}
+_next_suffix_lock = threading.Lock()
 
 
 def verify_incoming_path(base_path: Path, incoming_path: Path) -> bool:
@@ -42,9 +54,39 @@ def compute_folder_size(folder_path: Path) -> int:
     return total_size
 
 
+def compute_folder_usage(folder_path: Path) -> tuple[int, int]:
+    logical_size = 0
+    physical_size = 0
+    chunks: set[bytes] = set()
+    try:
+        for root, _, files in os.walk(folder_path):
+            for name in files:
+                file_path = Path(root) / name
+                try:
+                    disk_size = file_path.stat().st_size
+                    physical_size += disk_size
+                    if is_manifest_file(file_path):
+                        plain_size, entries = read_manifest(file_path)
+                        logical_size += plain_size
+                        chunks.update(chunk for chunk, _ in entries)
+                    elif is_encrypted_file(file_path):
+                        logical_size += get_plaintext_size(file_path)
+                    else:
+                        logical_size += disk_size
+                except (OSError, ValueError):
+                    continue
+    except Exception as e:
+        raise RuntimeError(f"Failed to compute folder size: {e}")
+    return logical_size, physical_size + physical_chunk_size(chunks)
+
+
 def list_number_of_items(entry) -> Optional[int]:
     try:
-        return len(list(os.scandir(entry))) if entry.is_dir() else None
+        if not entry.is_dir():
+            return None
+        count = len(list(os.scandir(entry)))
+        DIRECTORY_ENTRIES.labels("child_count").inc(count)
+        return count
     except (FileNotFoundError, OSError):
         return -1
 
@@ -85,34 +127,94 @@ def item_metadata(entry, index: int, relative_path: Path) -> dict:
     }
 
 
-async def ensure_unique_path(original_path: Path) -> Path:
-    result_path = original_path
-    counter = 1
+def _suffixed_path(original_path: Path, counter: int) -> Path:
+    if original_path.suffix:
+        return original_path.with_name(
+            f"{original_path.stem}-{counter}{original_path.suffix}"
+        )
+    return original_path.with_name(f"{original_path.name}-{counter}")
+
+
+def _highest_suffix(original_path: Path) -> int:
+    if original_path.suffix:
+        stem, suffix = original_path.stem, original_path.suffix
+    else:
+        stem, suffix = original_path.name, ""
+    pattern = re.compile(re.escape(stem) + r"-(\d+)" + re.escape(suffix))
+    highest = 0
+    scanned = 0
+    with os.scandir(original_path.parent) as entries:
+        for entry in entries:
+            scanned += 1
+            match = pattern.fullmatch(entry.name)
+            if match:
+                highest = max(highest, int(match.group(1)))
+    DIRECTORY_ENTRIES.labels("unique_name").inc(scanned)
+    return highest
+
 
-    while await asyncio.to_thread(result_path.exists):
-        if original_path.suffix:
-            result_path = original_path.with_name(
-                f"{original_path.stem}-{counter}{original_path.suffix}"
-            )
+def _claim_path(path: Path, reserve: bool, is_dir: bool) -> bool:
+    if not reserve:
+        return not os.path.lexists(path)
+    try:
+        if is_dir:
+            path.mkdir()
         else:
-            result_path = original_path.with_name(f"{original_path.name}-{counter}")
+            os.close(os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o666))
+        return True
+    except FileExistsError:
+        return False
+
+
+def unique_path(
+    original_path: Path, reserve: bool = False, is_dir: bool = False
+) -> Path:
+    if _claim_path(original_path, reserve, is_dir):
+        return original_path
+
+    key = (str(original_path.parent), original_path.name)
+    with _next_suffix_lock:
+        counter = _next_suffix.get(key)
+    misses = 0
+    record_cache("unique_suffix", counter is not None)
+    if counter is None:
+        counter = _highest_suffix(original_path) + 1
+
+    result_path = _suffixed_path(original_path, counter)
+    while not _claim_path(result_path, reserve, is_dir):
         counter += 1
+        misses += 1
+        if misses == UNIQUE_PATH_RESCAN_AFTER:
+            counter = max(counter, _highest_suffix(original_path) + 1)
+        result_path = _suffixed_path(original_path, counter)
+
+    with _next_suffix_lock:
+        if len(_next_suffix) >= UNIQUE_PATH_CACHE_SIZE:
+            _next_suffix.clear()
+        _next_suffix[key] = max(_next_suffix.get(key, 0), counter + 1)
 
     return result_path
 
 
-def generate_pdf_thumbnail(src_thumb: str, thumb_path: str):
-    pdf = pdfium.PdfDocument(src_thumb)
-    first_page = pdf[0]
-    bitmap = first_page.render(scale=2)
-    pil_image = bitmap.to_pil()
-    pil_image.thumbnail((512, 512))
-    pil_image.save(thumb_path, "PNG")
+async def ensure_unique_path(
+    original_path: Path, reserve: bool = False, is_dir: bool = False
+) -> Path:
+    return await asyncio.to_thread(unique_path, original_path, reserve, is_dir)
 
 
-async def create_zip_buffer(item_paths, parent_path):
-    zip_buffer = io.BytesIO()
-    with zipfile.ZipFile(zip_buffer, "w", compression=zipfile.ZIP_DEFLATED) as zipf:
+def thumbnail_kind(path: Path) -> str:
+    suffix = path.suffix.lower()
+    if suffix in VIDEO_FORMATS:
+        return "video"
+    if suffix == ".pdf":
+        return "pdf"
+    return "image"
+
+
+def write_zip(fileobj, item_paths, parent_path, on_progress=None):
+    with timed(ZIP_SECONDS), stage("zip"), zipfile.ZipFile(
+        fileobj, "w", compression=zipfile.ZIP_DEFLATED
+    ) as zipf:
         for to_download_item in item_paths:
             download_item_path = parent_path / Path(to_download_item["id"])
 
@@ -129,34 +231,39 @@ async def create_zip_buffer(item_paths, parent_path):
                             arc = str(Path(prefix) / relative_arc)
                         else:
                             arc = str(relative_arc)
-                        if is_encrypted_file(path):
-                            with zipf.open(arc, "w") as dest:
-                                for chunk in decrypt_stream(path):
-                                    dest.write(chunk)
-                        else:
-                            zipf.write(path, arcname=arc)
+                        _write_zip_entry(zipf, path, arc, on_progress)
             else:
                 if prefix:
                     arc = str(prefix)
                 else:
                     arc = str(to_download_item["name"])
-                if is_encrypted_file(download_item_path):
-                    with zipf.open(arc, "w") as dest:
-                        for chunk in decrypt_stream(download_item_path):
-                            dest.write(chunk)
-                else:
-                    zipf.write(
-                        download_item_path,
-                        arcname=arc,
-                    )
+                _write_zip_entry(zipf, download_item_path, arc, on_progress)
+
+
+def _write_zip_entry(zipf, path: Path, arc: str, on_progress=None):
+    if is_encrypted_file(path):
+        with zipf.open(arc, "w") as dest:
+            for chunk in decrypt_stream(path):
+                dest.write(chunk)
+                if on_progress:
+                    on_progress(len(chunk))
+    else:
+        zipf.write(path, arcname=arc)
+        if on_progress:
+            on_progress(path.stat().st_size)
+
+
+async def create_zip_buffer(item_paths, parent_path):
+    zip_buffer = io.BytesIO()
+    write_zip(zip_buffer, item_paths, parent_path)
     zip_buffer.seek(0)
     content_length = len(zip_buffer.getvalue())
     return zip_buffer, content_length
 
 
 def get_directory_contents(folder_path: Path, relative_path: Path):
-    with os.scandir(folder_path) as entries:
-        return [
+    with stage("listing"), os.scandir(folder_path) as entries:
+        contents = [
             {
                 "id": str(Path(entry.path).relative_to(str(relative_path))),
                 "order_no": i,
@@ -174,6 +281,8 @@ def get_directory_contents(folder_path: Path, relative_path: Path):
             }
             for i, entry in enumerate(entries)
         ]
+    DIRECTORY_ENTRIES.labels("listing").inc(len(contents))
+    return contents
 
 
 def verify_items(items, parent_path):
@@ -181,3 +290,30 @@ def verify_items(items, parent_path):
         is_valid = verify_incoming_path(parent_path, Path(item_path))
         if not is_valid:
             raise PermissionError("User operation denied!")
+
+
+def relative_item_path(path: Optional[Path], parent_path: Path) -> Optional[str]:
+    if path is None:
+        return None
+    return str(path.relative_to(parent_path))
+
+
+def batch_response(results: list[dict], message: str) -> JSONResponse:
+    failed = [result for result in results if not result["success"]]
+    if not failed:
+        return JSONResponse(
+            content={"message": message, "results": results}, status_code=200
+        )
+    if len(failed) == len(results):
+        first = next((r for r in failed if not r.get("rolled_back")), failed[0])
+        return JSONResponse(
+            content={"detail": first["error"], "results": results},
+            status_code=first.get("status", 400),
+        )
+    return JSONResponse(
+        content={
+            "message": f"{len(failed)} of {len(results)} items failed.",
+            "results": results,
+        },
+        status_code=207,
+    )
@@ -0,0 +1,315 @@
+import asyncio
+import hashlib
+import json
+import logging
+import math
+import os
+import shutil
+import uuid
+from io import BytesIO
+from pathlib import Path
+from tempfile import NamedTemporaryFile
+from typing import Callable, Optional
+
+from PIL import Image
+
+from config import (
+    PREVIEW_CACHE_PATH,
+    PREVIEW_CACHE_MAX_BYTES,
+    PREVIEW_FFMPEG_CONCURRENCY,
+    PREVIEW_SPRITE_INTERVAL,
+    PREVIEW_SPRITE_MAX_TILES,
+)
+from crypto_utils import (
+    SegmentedWriter,
+    decrypt_stream,
+    decrypt_to_bytes,
+    is_encrypted_file,
+)
+from metrics import record_cache
+
+logger = logging.getLogger(__name__)
+
+POSTER_WIDTH = 320
+POSTER_MAX_OFFSET = 10.0
+TILE_WIDTH = 160
+SPRITE_COLUMNS = 10
+
+POSTER = "poster.jpg"
+SPRITE = "sprite.jpg"
+CUES = "cues.json"
+
+
+class PreviewError(Exception):
+    pass
+
+
+def _cache_key(path: Path) -> str:
+    st = path.stat()
+    identity = f"{path}:{st.st_size}:{st.st_mtime_ns}:{st.st_ino}"
+    return hashlib.sha256(identity.encode()).hexdigest()
+
+
+def _plain_source(path: Path) -> tuple[Path, Callable[[], None]]:
+    if not is_encrypted_file(path):
+        return path, lambda: None
+    with NamedTemporaryFile(suffix=path.suffix, delete=False) as tmp:
+        for chunk in decrypt_stream(path):
+            tmp.write(chunk)
+    tmp_path = Path(tmp.name)
+    return tmp_path, lambda: tmp_path.unlink(missing_ok=True)
+
+
+async def _run(*cmd: str) -> bytes:
+    proc = await asyncio.create_subprocess_exec(
+        *cmd,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    out, err = await proc.communicate()
+    if proc.returncode != 0:
+        raise PreviewError(err.decode(errors="replace").strip() or cmd[0] + " failed")
+    return out
+
+
+async def _probe_duration(source: Path) -> float:
+    out = await _run(
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "json",
+        str(source),
+    )
+    try:
+        return max(0.0, float(json.loads(out)["format"]["duration"]))
+    except (KeyError, ValueError):
+        return 0.0
+
+
+async def _extract_frame(source: Path, seconds: float, width: int) -> bytes:
+    # Input seeking with only keyframes decoded: ffmpeg jumps to the keyframe
+    # at or before the timestamp instead of decoding from the start.
+    frame = await _run(
+        "ffmpeg",
+        "-v",
+        "error",
+        "-skip_frame",
+        "nokey",
+        "-noaccurate_seek",
+        "-ss",
+        f"{seconds:.3f}",
+        "-i",
+        str(source),
+        "-frames:v",
+        "1",
+        "-vf",
+        f"scale={width}:-2",
+        "-f",
+        "image2pipe",
+        "-c:v",
+        "mjpeg",
+        "-q:v",
+        "4",
+        "-",
+    )
+    if not frame:
+        raise PreviewError("ffmpeg produced no frame")
+    return frame
+
+
+def _compose_sprite(
+    frames: list[bytes], interval: float, duration: float
+) -> tuple[bytes, list[dict]]:
+    images = [Image.open(BytesIO(frame)).convert("RGB") for frame in frames]
+    width, height = images[0].size
+    columns = min(SPRITE_COLUMNS, len(images))
+    rows = math.ceil(len(images) / columns)
+    sheet = Image.new("RGB", (columns * width, rows * height))
+    cues = []
+    for index, image in enumerate(images):
+        x, y = (index % columns) * width, (index // columns) * height
+        if image.size != (width, height):
+            image = image.resize((width, height))
+        sheet.paste(image, (x, y))
+        cues.append(
+            {
+                "start": index * interval,
+                "end": min((index + 1) * interval, max(duration, interval)),
+                "x": x,
+                "y": y,
+                "width": width,
+                "height": height,
+            }
+        )
+    out = BytesIO()
+    sheet.save(out, "JPEG", quality=80)
+    return out.getvalue(), cues
+
+
+def _timestamp(seconds: float) -> str:
+    millis = round(seconds * 1000)
+    hours, millis = divmod(millis, 3600 * 1000)
+    minutes, millis = divmod(millis, 60 * 1000)
+    return f"{hours:02d}:{minutes:02d}:{millis // 1000:02d}.{millis % 1000:03d}"
+
+
+def webvtt(cues: list[dict], sprite_url: str) -> str:
+    lines = ["WEBVTT", ""]
+    for cue in cues:
+        lines.append(f"{_timestamp(cue['start'])} --> {_timestamp(cue['end'])}")
+        lines.append(
+            f"{sprite_url}#xywh={cue['x']},{cue['y']},{cue['width']},{cue['height']}"
+        )
+        lines.append("")
+    return "\n".join(lines)
+
+
+class _Generation:
+    def __init__(self):
+        self.poster: Optional[bytes] = None
+        self.poster_ready = asyncio.Event()
+        self.error: Optional[Exception] = None
+        self.task: Optional[asyncio.Task] = None
+
+
+# Posters, seek-bar sprite sheets and their cues, computed once per version of
+# a video and kept encrypted under the state directory. The video is
+# decrypted once per generation; the poster is released as soon as it exists
+# while the sprite continues in the background.
+class VideoPreviews:
+    def __init__(self, root: Path, max_bytes: int, concurrency: int):
+        self.root = root
+        self.max_bytes = max_bytes
+        self._ffmpeg = asyncio.Semaphore(concurrency)
+        self._generations: dict[str, _Generation] = {}
+
+    async def start(self) -> None:
+        await asyncio.to_thread(self.root.mkdir, parents=True, exist_ok=True)
+
+    async def stop(self) -> None:
+        tasks = [g.task for g in self._generations.values() if g.task is not None]
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def poster(self, path: Path) -> bytes:
+        key = await asyncio.to_thread(_cache_key, path)
+        poster = await asyncio.to_thread(self._load, key, POSTER)
+        record_cache("video_preview", poster is not None)
+        if poster is not None:
+            return poster
+
+        generation = self._generation(key, path)
+        await generation.poster_ready.wait()
+        if generation.poster is None:
+            raise PreviewError(str(generation.error))
+        return generation.poster
+
+    async def sprite(self, path: Path) -> tuple[bytes, list[dict]]:
+        key = await asyncio.to_thread(_cache_key, path)
+        cues = await asyncio.to_thread(self._load, key, CUES)
+        record_cache("video_preview", cues is not None)
+        if cues is None:
+            generation = self._generation(key, path)
+            await asyncio.shield(generation.task)
+            if generation.error is not None:
+                raise PreviewError(str(generation.error))
+            cues = await asyncio.to_thread(self._load, key, CUES)
+        sprite = await asyncio.to_thread(self._load, key, SPRITE)
+        if cues is None or sprite is None:
+            raise PreviewError("Preview was evicted while loading")
+        return sprite, json.loads(cues)
+
+    def _generation(self, key: str, path: Path) -> _Generation:
+        generation = self._generations.get(key)
+        if generation is None:
+            generation = _Generation()
+            generation.task = asyncio.create_task(self._generate(key, path, generation))
+            generation.task.add_done_callback(
+                lambda _: self._generations.pop(key, None)
+            )
+            self._generations[key] = generation
+        return generation
+
+    async def _generate(self, key: str, path: Path, generation: _Generation) -> None:
+        try:
+            source, cleanup = await asyncio.to_thread(_plain_source, path)
+            try:
+                duration = await _probe_duration(source)
+                async with self._ffmpeg:
+                    poster = await _extract_frame(
+                        source, min(duration * 0.1, POSTER_MAX_OFFSET), POSTER_WIDTH
+                    )
+                await asyncio.to_thread(self._store, key, POSTER, poster)
+                generation.poster = poster
+                generation.poster_ready.set()
+
+                interval = max(
+                    PREVIEW_SPRITE_INTERVAL, duration / PREVIEW_SPRITE_MAX_TILES
+                )
+                count = max(1, math.ceil(duration / interval))
+                frames = await asyncio.gather(
+                    *(self._tile(source, i * interval) for i in range(count))
+                )
+            finally:
+                await asyncio.to_thread(cleanup)
+
+            sprite, cues = await asyncio.to_thread(
+                _compose_sprite, frames, interval, duration
+            )
+            await asyncio.to_thread(self._store, key, SPRITE, sprite)
+            await asyncio.to_thread(self._store, key, CUES, json.dumps(cues).encode())
+            await asyncio.to_thread(self._prune)
+        except Exception as e:
+            logger.warning("Video preview failed for %s: %s", path.name, e)
+            generation.error = e
+        finally:
+            generation.poster_ready.set()
+
+    async def _tile(self, source: Path, seconds: float) -> bytes:
+        async with self._ffmpeg:
+            return await _extract_frame(source, seconds, TILE_WIDTH)
+
+    def _entry(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def _load(self, key: str, name: str) -> Optional[bytes]:
+        path = self._entry(key) / name
+        try:
+            data = decrypt_to_bytes(path)
+        except FileNotFoundError:
+            return None
+        os.utime(path.parent)
+        return data
+
+    def _store(self, key: str, name: str, data: bytes) -> None:
+        entry = self._entry(key)
+        entry.mkdir(parents=True, exist_ok=True)
+        tmp_path = entry / f".{name}.{uuid.uuid4().hex}"
+        with SegmentedWriter(tmp_path) as writer:
+            writer.write(data)
+        os.replace(tmp_path, entry / name)
+
+    def _prune(self) -> None:
+        entries = []
+        total = 0
+        for entry in self.root.glob("*/*"):
+            try:
+                size = sum(f.stat().st_size for f in entry.iterdir())
+                entries.append((entry.stat().st_mtime, size, entry))
+            except FileNotFoundError:
+                continue
+            total += size
+        for _, size, entry in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(entry, ignore_errors=True)
+            total -= size
+
+
+video_previews = VideoPreviews(
+    PREVIEW_CACHE_PATH, PREVIEW_CACHE_MAX_BYTES, PREVIEW_FFMPEG_CONCURRENCY
+)